@@ -0,0 +1,70 @@
+"""
+Steps per second of utils.Adbfgs.Adbfgs with the per-parameter loop, the torch._foreach
+path and the flat arenas on the FSNet model of exp_fsnet, as it is optimized there
+(all of model.parameters(), store_grad after every step), and a check that all three
+give bitwise identical params.
+
+    python -m benchmarks.bench_adbfgs --channels 7 --seq_len 60 --steps 200
+"""
+import argparse
+import copy
+import time
+import torch
+
+from exp.exp_fsnet import net
+from utils.Adbfgs import Adbfgs
+
+
+def run(model, mode, batches, device):
+    opt = Adbfgs(model.parameters(), lr=1e-3, foreach=mode != 'loop', flat=mode == 'flat')
+    # same dropout masks in every mode
+    torch.manual_seed(0)
+    # first step builds the state (and the arenas), keep it out of the timing
+    times = []
+    for x in batches:
+        opt.zero_grad()
+        model(x).pow(2).mean().backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        t = time.perf_counter()
+        opt.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - t)
+        model.store_grad()
+    if mode == 'flat':
+        assert opt._arenas and all(arena is not None for arena in opt._arenas.values()), 'the flat arenas were not used'
+    return sum(times[1:]) / max(len(times) - 1, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Adbfgs optimizer benchmark')
+    parser.add_argument('--channels', type=int, default=7)
+    parser.add_argument('--seq_len', type=int, default=60)
+    parser.add_argument('--pred_len', type=int, default=1)
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    base = net(argparse.Namespace(enc_in=args.channels, c_out=args.channels, pred_len=args.pred_len), device)
+    # the exp feeds the series and its 7 time features
+    batches = [torch.randn(1, args.seq_len, args.channels + 7, device=device) for _ in range(args.steps)]
+    trainable = [p for p in base.parameters() if p.requires_grad]
+    print('{} tensors ({} trainable), {} values, {} steps on {}'.format(
+        sum(1 for _ in base.parameters()), len(trainable), sum(p.numel() for p in trainable), args.steps, device))
+
+    models, cost = {}, {}
+    for mode in ('loop', 'foreach', 'flat'):
+        models[mode] = copy.deepcopy(base)
+        cost[mode] = run(models[mode], mode, batches, device)
+    for mode in ('foreach', 'flat'):
+        same = all(torch.equal(a, b) for a, b in zip(models['loop'].parameters(), models[mode].parameters()))
+        print('{} identical to loop: {}'.format(mode, same))
+    for mode, t in cost.items():
+        print('{:>8}: {:8.1f} steps/s ({:.2f}x)'.format(mode, 1 / t, cost['loop'] / t))
+
+
+if __name__ == '__main__':
+    main()
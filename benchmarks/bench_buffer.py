@@ -0,0 +1,115 @@
+"""
+Micro-benchmark of utils.buffer.Buffer against the previous per-example implementation.
+
+    python -m benchmarks.bench_buffer --device cpu --batch 1 32 --buffer_size 10 500
+"""
+import argparse
+import time
+import numpy as np
+import torch
+
+from utils.buffer import Buffer
+
+
+class LegacyBuffer:
+    """utils.buffer.Buffer before the vectorized rewrite, kept here as the baseline."""
+    def __init__(self, buffer_size, device):
+        self.buffer_size = buffer_size
+        self.device = device
+        self.num_seen_examples = 0
+        self.attributes = ['examples', 'labels', 'logits', 'task_labels']
+
+    def init_tensors(self, examples, labels, logits, task_labels):
+        for attr_str, attr in zip(self.attributes, (examples, labels, logits, task_labels)):
+            if attr is not None and not hasattr(self, attr_str):
+                setattr(self, attr_str, torch.zeros((self.buffer_size,
+                        *attr.shape[1:]), dtype=torch.float32, device=self.device))
+
+    def add_data(self, examples, labels=None, logits=None, task_labels=None):
+        if not hasattr(self, 'examples'):
+            self.init_tensors(examples, labels, logits, task_labels)
+
+        for i in range(examples.shape[0]):
+            index = self.num_seen_examples % self.buffer_size
+            self.num_seen_examples += 1
+            if index >= 0:
+                self.examples[index] = examples[i].to(self.device)
+                if labels is not None:
+                    self.labels[index] = labels[i].to(self.device)
+                if logits is not None:
+                    self.logits[index] = logits[i].to(self.device)
+                if task_labels is not None:
+                    self.task_labels[index] = task_labels[i].to(self.device)
+
+    def get_data(self, size, transform=None):
+        if size > min(self.num_seen_examples, self.examples.shape[0]):
+            size = min(self.num_seen_examples, self.examples.shape[0])
+
+        choice = np.random.choice(min(self.num_seen_examples, self.examples.shape[0]),
+                                  size=size, replace=False)
+        if transform is None: transform = lambda x: x
+        ret_tuple = (torch.stack([transform(ee.cpu())
+                            for ee in self.examples[choice]]).to(self.device),)
+        for attr_str in self.attributes[1:]:
+            if hasattr(self, attr_str):
+                attr = getattr(self, attr_str)
+                ret_tuple += (attr[choice],)
+        return ret_tuple
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def run(buffer, batch, args, device):
+    """Mean seconds per add_data and per get_data, the way the online loops call them."""
+    x = torch.randn(batch, args.seq_len, args.dim, device=device)
+    y = torch.randn(batch, args.pred_len * args.dim, device=device)
+    idx = torch.arange(batch, device=device)
+    mark = torch.randn(batch, args.seq_len, 4, device=device)
+    for _ in range(args.warmup):
+        buffer.add_data(examples=x, labels=y, logits=idx, task_labels=mark)
+        buffer.get_data(args.sample)
+
+    sync(device)
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        buffer.add_data(examples=x, labels=y, logits=idx, task_labels=mark)
+    sync(device)
+    add = (time.perf_counter() - start) / args.steps
+
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        out = buffer.get_data(args.sample)
+    sync(device)
+    get = (time.perf_counter() - start) / args.steps
+    return add, get
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Buffer micro-benchmark')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 32])
+    parser.add_argument('--buffer_size', type=int, nargs='+', default=[10, 500])
+    parser.add_argument('--sample', type=int, default=8, help='items drawn by get_data')
+    parser.add_argument('--seq_len', type=int, default=60)
+    parser.add_argument('--pred_len', type=int, default=24)
+    parser.add_argument('--dim', type=int, default=7)
+    parser.add_argument('--steps', type=int, default=1000)
+    parser.add_argument('--warmup', type=int, default=50)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    print('{:>6} {:>6} | {:>12} {:>12} | {:>12} {:>12}'.format(
+        'size', 'batch', 'add legacy', 'add ring', 'get legacy', 'get ring'))
+    for size in args.buffer_size:
+        for batch in args.batch:
+            legacy = run(LegacyBuffer(size, device), batch, args, device)
+            ring = run(Buffer(size, device), batch, args, device)
+            print('{:>6} {:>6} | {:>10.1f}us {:>10.1f}us | {:>10.1f}us {:>10.1f}us'.format(
+                size, batch, legacy[0] * 1e6, ring[0] * 1e6, legacy[1] * 1e6, ring[1] * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Eval forward cost of the FSNet TSEncoder with the calibration recomputed on every
+forward, cached between gradient updates, and folded into plain convs.
+
+    python -m benchmarks.bench_calibration --seq_len 60 --batch 32 --steps 50
+"""
+import argparse
+import copy
+import time
+import torch
+
+from models.ts2vec.fsnet import TSEncoder
+from models.ts2vec.fsnet_ import set_calibration_cache, freeze_calibration
+
+
+def timed(encoder, x, steps, device):
+    with torch.no_grad():
+        encoder(x.clone(), mask='all_true')
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        t = time.perf_counter()
+        for _ in range(steps):
+            out = encoder(x.clone(), mask='all_true')
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return out, (time.perf_counter() - t) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fsnet calibration cache benchmark')
+    parser.add_argument('--seq_len', type=int, default=60)
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--input_dims', type=int, default=14)
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    encoder = TSEncoder(input_dims=args.input_dims, output_dims=320, hidden_dims=64, depth=10).to(device).eval()
+    # one calibration step so that q_ema exists and every variant starts from the same state
+    with torch.no_grad():
+        encoder(torch.zeros(1, 2, args.input_dims, device=device), mask='all_true')
+    x = torch.randn(args.batch, args.seq_len, args.input_dims, device=device)
+
+    cached = copy.deepcopy(encoder)
+    set_calibration_cache(cached)
+    frozen = freeze_calibration(copy.deepcopy(cached))
+
+    _, plain_t = timed(copy.deepcopy(encoder), x, args.steps, device)
+    y_cached, cached_t = timed(cached, x, args.steps, device)
+    y_frozen, frozen_t = timed(frozen, x, args.steps, device)
+    print('recomputed: {:.2f}ms, cached: {:.2f}ms ({:.1f}x), frozen: {:.2f}ms ({:.1f}x)'.format(
+        plain_t * 1e3, cached_t * 1e3, plain_t / cached_t, frozen_t * 1e3, plain_t / frozen_t))
+    print('frozen vs cached max diff: {:.2e}'.format((y_cached - y_frozen).abs().max().item()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Online learning throughput on the CPU: steps/sec of the test-time update
+(forward, backward, optimizer step and FSNet's store_grad) for the FSNet based
+methods, and the cost of scoring a window alone under torch.inference_mode.
+
+    python -m benchmarks.bench_cpu_online --methods onenet_fsnet fsnet onenet_tcn --threads 4
+"""
+import argparse
+import time
+import torch
+
+from benchmarks.common import make_args, make_exp, synthetic_windows
+
+
+def score(exp, batch_x, batch_x_mark):
+    x, x_mark = batch_x.float().to(exp.device), batch_x_mark.float().to(exp.device)
+    if hasattr(exp.model, 'forward_weight'):
+        return exp.model.forward_weight(x, x_mark, 0.5, 0.5)[0]
+    return exp.model(torch.cat([x, x_mark], dim=-1))
+
+
+def run(method, args, windows, warmup):
+    torch.manual_seed(0)
+    exp = make_exp(make_args(method, **args))
+    for w in windows[:warmup]:
+        exp._process_one_batch(None, *w, mode='test')
+    t = time.perf_counter()
+    for w in windows[warmup:]:
+        exp._process_one_batch(None, *w, mode='test')
+    online_t = (time.perf_counter() - t) / (len(windows) - warmup)
+
+    with torch.inference_mode():
+        t = time.perf_counter()
+        for batch_x, _, batch_x_mark, _ in windows[warmup:]:
+            score(exp, batch_x, batch_x_mark)
+        score_t = (time.perf_counter() - t) / (len(windows) - warmup)
+    return online_t, score_t
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cpu online learning benchmark')
+    parser.add_argument('--methods', type=str, nargs='+', default=['onenet_fsnet', 'fsnet', 'onenet_tcn'])
+    parser.add_argument('--seq_len', type=int, default=60)
+    parser.add_argument('--enc_in', type=int, default=7)
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--calib_cache', action='store_true')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    exp_args = dict(features='M', seq_len=args.seq_len, enc_in=args.enc_in, c_out=args.enc_in, use_gpu=False,
+                    calib_cache=args.calib_cache)
+    windows = synthetic_windows(make_args(None, **exp_args), args.steps + args.warmup)
+    print('threads: {}'.format(torch.get_num_threads()))
+    for method in args.methods:
+        online_t, score_t = run(method, exp_args, windows, args.warmup)
+        print('{:>14}: online {:.1f} steps/s ({:.2f}ms), scoring {:.2f}ms'.format(
+            method, 1 / online_t, online_t * 1e3, score_t * 1e3))
+
+
+if __name__ == '__main__':
+    main()
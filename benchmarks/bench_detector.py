@@ -0,0 +1,108 @@
+"""
+Per-step cost of utils.detector.STEPD against the previous list-based implementation,
+and a check that both give the same (status, lr) on the same loss stream.
+
+    python -m benchmarks.bench_detector --steps 20000 --window 100
+"""
+import argparse
+import time
+import numpy as np
+import torch
+from scipy.stats import norm
+
+from utils.detector import STEPD
+
+
+class LegacySTEPD:
+    """utils.detector.STEPD before the incremental rewrite, kept here as the baseline."""
+    def __init__(self, new_window_size, alpha_w=0.05, alpha_d=0.003):
+        self.new_window_size = new_window_size
+        self.alpha_w = alpha_w
+        self.alpha_d = alpha_d
+        self.cnt, self.shift_cnt = 1, 0
+        self.data = []
+        self.data_visualize = None
+
+    def add_data(self, error_rate , x):
+        self.cnt += 1
+        if self.data_visualize is None:
+            self.data_visualize = x.cpu().detach()[0]
+        else:
+            self.data_visualize = torch.cat([self.data_visualize, x.cpu().detach()[0,-1,:].unsqueeze(0)], dim=0)
+        self.data.append(error_rate)
+
+    def reset(self):
+        self.shift_cnt += 1
+        self.data = []
+        self.cnt = 0
+        self.data_visualize = None
+
+    def run_test(self,):
+        if len(self.data) < self.new_window_size:
+            return 0, None
+        recent_window = self.data[-self.new_window_size:]
+        overall_window = self.data
+        mean_recent = np.mean(recent_window)
+        mean_overall = np.mean(overall_window)
+        std_dev_overall = np.std(overall_window)
+        n = len(self.data)
+        theta_stepd = (mean_recent - mean_overall) / (std_dev_overall / np.sqrt(n))
+        drift_threshold = norm.ppf(1 - self.alpha_d / 2)
+        if theta_stepd > drift_threshold:
+            return 1, 3e-3
+        else:
+            lr = 1e-4 + (3e-3 - 1e-4) * (theta_stepd / drift_threshold)
+            return 0, max(lr, 1e-4)
+
+
+def loss_stream(steps, seed=0):
+    """Noisy losses with a level shift every few thousand steps."""
+    rng = np.random.RandomState(seed)
+    level = np.repeat(rng.uniform(0.2, 2., steps // 3000 + 1), 3000)[:steps]
+    return level + 0.1 * rng.randn(steps) ** 2
+
+
+def drive(detector, losses, x, report):
+    """Runs the online loop of the d3a experiments, returns outputs and per-step seconds at the report points."""
+    outputs, times = [], {}
+    start = time.perf_counter()
+    for i, loss in enumerate(losses):
+        detector.add_data(float(loss), x)
+        outputs.append(detector.run_test())
+        if i + 1 in report:
+            # time a short burst at this stream length
+            t = time.perf_counter()
+            for _ in range(50):
+                detector.run_test()
+            times[i + 1] = (time.perf_counter() - t) / 50
+    return outputs, times, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='STEPD drift detector benchmark')
+    parser.add_argument('--steps', type=int, default=20000)
+    parser.add_argument('--window', type=int, default=100)
+    parser.add_argument('--alpha_w', type=float, default=0.0001)
+    parser.add_argument('--alpha_d', type=float, default=0.003)
+    args = parser.parse_args()
+
+    losses = loss_stream(args.steps)
+    x = torch.randn(1, 60, 7)
+    report = [n for n in (1000, 5000, 10000, 20000, 50000, 100000) if n <= args.steps]
+
+    # no resets, so the legacy detector sees the whole stream and its cost keeps growing
+    legacy, legacy_t, legacy_total = drive(LegacySTEPD(args.window, args.alpha_w, args.alpha_d), losses, x, report)
+    new, new_t, new_total = drive(STEPD(args.window, args.alpha_w, args.alpha_d), losses, x, report)
+
+    status_equal = all(a[0] == b[0] for a, b in zip(legacy, new))
+    lr_close = all(a[1] == b[1] or np.isclose(a[1], b[1], rtol=1e-6) for a, b in zip(legacy, new))
+    print('same drift flags: {}, same lr: {}'.format(status_equal, lr_close))
+    print('run_test cost by stream length')
+    print('{:>8} | {:>14} {:>14}'.format('steps', 'legacy', 'stepd'))
+    for n in report:
+        print('{:>8} | {:>12.1f}us {:>12.1f}us'.format(n, legacy_t[n] * 1e6, new_t[n] * 1e6))
+    print('total: legacy {:.2f}s, stepd {:.2f}s'.format(legacy_total, new_total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Latency of one online step of the causal FSNet TSEncoder: full re-encoding of the
+window against the incremental step over the newest bar, and a check that both give
+the same representation. They only can when the window covers the receptive field
+of the encoder (8189 bars at the exp's depth 10), shorter seq_lens are skipped.
+
+    python -m benchmarks.bench_incremental_encoder --seq_lens 8192 16384 --steps 50
+    python -m benchmarks.bench_incremental_encoder --depth 6 --seq_lens 512 2048 --steps 50
+"""
+import argparse
+import copy
+import time
+import torch
+
+from models.ts2vec.fsnet import TSEncoder
+
+
+def timed(fn, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    t = time.perf_counter()
+    out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return out, time.perf_counter() - t
+
+
+def main():
+    parser = argparse.ArgumentParser(description='incremental causal encoder benchmark')
+    parser.add_argument('--seq_lens', type=int, nargs='+', default=[8192, 16384])
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--input_dims', type=int, default=14)
+    parser.add_argument('--depth', type=int, default=10)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    encoder = TSEncoder(input_dims=args.input_dims, output_dims=320, hidden_dims=64,
+                        depth=args.depth, causal=True).to(device).eval()
+    receptive_field = encoder.feature_extractor.receptive_field
+    print('{:>8} | {:>12} {:>12} {:>8} | {:>10}'.format('seq_len', 'full', 'step', 'speedup', 'max diff'))
+    for seq_len in args.seq_lens:
+        if seq_len < receptive_field:
+            print('{:>8} | skipped, below the receptive field of {}'.format(seq_len, receptive_field))
+            continue
+        x = torch.randn(1, seq_len + args.steps, args.input_dims, device=device)
+        # the calibration state of the convs moves on every call, so both copies see the same calls
+        full, incremental = copy.deepcopy(encoder), copy.deepcopy(encoder)
+        full_t, step_t, diff = 0., 0., 0.
+        with torch.no_grad():
+            full(x[:, :seq_len].clone(), mask='all_true')
+            incremental.prime(x[:, :seq_len].clone(), mask='all_true')
+            for s in range(1, args.steps + 1):
+                # full recomputation of the current window, as the online phase does without the queues
+                y_full, t = timed(lambda: full(x[:, s:seq_len + s].clone(), mask='all_true')[:, -1], device)
+                full_t += t
+                y_step, t = timed(lambda: incremental.forward_step(x[:, seq_len + s - 1:seq_len + s].clone())[:, -1], device)
+                step_t += t
+                diff = max(diff, (y_full - y_step).abs().max().item())
+        assert torch.allclose(y_full, y_step, atol=1e-4), 'the incremental step diverged from the window: {:.2e}'.format(diff)
+        print('{:>8} | {:>10.2f}ms {:>10.2f}ms {:>7.1f}x | {:>10.2e}'.format(
+            seq_len, full_t / args.steps * 1e3, step_t / args.steps * 1e3, full_t / step_t, diff))
+
+
+if __name__ == '__main__':
+    main()
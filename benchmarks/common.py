@@ -0,0 +1,64 @@
+"""
+Shared helpers for the benchmarks that drive a whole experiment: the main.py
+arguments as a Namespace, synthetic windows and the optimizer setup that train()
+and test() leave behind before the online phase.
+"""
+import importlib
+import torch
+from torch import optim
+
+from main import get_parser, prepare_args
+
+
+def make_args(method, **overrides):
+    """
+    The arguments main.py runs method with by default (its parser's defaults and
+    what it derives from them, e.g. the dataset shapes), then overrides on top.
+    """
+    args = prepare_args(get_parser().parse_args([]))
+    args.method = method
+    for k, v in overrides.items():
+        setattr(args, k, v)
+    return args
+
+
+def make_exp(args):
+    """Builds exp/exp_{method}.py and sets up its optimizers as the online phase of test() expects."""
+    module = importlib.import_module('exp.exp_' + args.method)
+    exp = module.Exp_TS2VecSupervised(args)
+    exp._select_optimizer()
+    device = exp.device
+    if hasattr(exp, 'decision'):
+        exp.opt_bias = optim.Adam(exp.decision.parameters(), lr=args.learning_rate_bias)
+    if hasattr(exp, 'weight'):
+        n = args.c_out if args.individual else 1
+        exp.weight = torch.zeros(n, device=device, requires_grad=True)
+        exp.bias = torch.zeros(n, device=device)
+        exp.opt_w = optim.Adam([exp.weight], lr=args.learning_rate_w)
+        if args.fused_combiner and hasattr(exp, '_fuse_optimizers'):
+            exp.opt_fused = exp._fuse_optimizers()
+    exp.model.eval()
+    if hasattr(exp.model, 'reset_incremental'):
+        exp.model.incremental = args.incremental_encoder
+        exp.model.reset_incremental()
+    return exp
+
+
+def synthetic_windows(args, n, seed=0, n_marks=7):
+    """n random-walk windows laid out like the test loader's (batch_x, batch_y, x_mark, y_mark), batch size 1."""
+    g = torch.Generator().manual_seed(seed)
+    length = args.seq_len + args.pred_len + n
+    series = torch.randn(length, args.enc_in, generator=g).cumsum(0) * 0.1
+    marks = torch.randn(length, n_marks, generator=g)
+    windows = []
+    for i in range(n):
+        s_end = i + args.seq_len
+        r_begin = s_end - args.label_len
+        windows.append((series[i:s_end][None], series[r_begin:s_end + args.pred_len][None],
+                        marks[i:s_end][None], marks[r_begin:s_end + args.pred_len][None]))
+    return windows
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
@@ -0,0 +1,111 @@
+"""
+Regression check of a benchmarks.suite report against a stored one: every run
+present in both (same method, data, features, seq_len, pred_len and channels)
+is compared metric by metric, and a throughput drop or a latency / memory rise
+beyond the relative tolerance is a regression. A run that succeeded in the baseline and
+fails now is one too, and so is a run whose test mse diverged: not finite, or
+above --mse_ceiling times the mse of forecasting the training mean on the same
+windows. Exits with 1 if there is any, or if the baseline itself has a
+diverged run.
+
+    python -m benchmarks.compare benchmarks/baselines/cpu.json report.json --tolerance 0.15
+"""
+import sys
+import json
+import math
+import argparse
+
+from benchmarks.suite import THROUGHPUT, METRICS
+
+
+KEY = ('method', 'data', 'features', 'seq_len', 'pred_len', 'channels')
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report['meta'], {tuple(entry.get(k) for k in KEY): entry for entry in report['results']}
+
+
+def change(metric, old, new):
+    """Relative change of new over old, positive when it got worse."""
+    if not old:
+        return 0.
+    rel = (new - old) / old
+    return -rel if metric in THROUGHPUT else rel
+
+
+def diverged(entry, ceiling):
+    """True for a run whose mse is not finite or above ceiling times its mean_forecast_mse."""
+    mse = entry.get('mse')
+    if mse is None:
+        return False
+    if not math.isfinite(mse):
+        return True
+    reference = entry.get('mean_forecast_mse')
+    return reference is not None and mse > ceiling * reference
+
+
+def compare(baseline, current, tolerance, metrics=METRICS, mse_ceiling=2.):
+    """
+    Rows of (key, metric, old, new, change, regressed); metric None for a run that
+    now fails, 'mse' (old the mean forecast mse) for a run that diverged.
+    """
+    rows = []
+    for key, new in current.items():
+        if diverged(new, mse_ceiling):
+            rows.append((key, 'mse', new.get('mean_forecast_mse'), new['mse'], None, True))
+        old = baseline.get(key)
+        if old is None or 'error' in old:
+            continue
+        if 'error' in new:
+            rows.append((key, None, None, new['error'], None, True))
+            continue
+        for metric in metrics:
+            if metric in old and metric in new:
+                worse = change(metric, old[metric], new[metric])
+                rows.append((key, metric, old[metric], new[metric], worse, worse > tolerance))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare a benchmark report against a baseline')
+    parser.add_argument('baseline', type=str)
+    parser.add_argument('current', type=str)
+    parser.add_argument('--tolerance', type=float, default=0.15, help='relative change allowed before a metric regresses')
+    parser.add_argument('--metrics', type=str, nargs='+', default=list(METRICS), choices=METRICS)
+    parser.add_argument('--mse_ceiling', type=float, default=2., help='test mse, as a multiple of the mse of forecasting the training mean, above which a run diverged')
+    parser.add_argument('--all', action='store_true', help='print every metric, not only the regressions')
+    args = parser.parse_args()
+
+    base_meta, baseline = load(args.baseline)
+    meta, current = load(args.current)
+    for k in ('torch', 'cpus', 'threads', 'machine', 'learning_rate'):
+        if base_meta.get(k) != meta.get(k):
+            print('note: {} differs, baseline {} vs {}'.format(k, base_meta.get(k), meta.get(k)))
+    missing = [key for key in baseline if key not in current]
+    if missing:
+        print('{} baseline runs not in the current report'.format(len(missing)))
+    broken = [key for key, entry in baseline.items() if diverged(entry, args.mse_ceiling)]
+    for key in broken:
+        print('{:>14} {:>10}   diverged in the baseline: mse {:.4g}, re-record it'.format(key[0], key[1], baseline[key]['mse']))
+
+    rows = compare(baseline, current, args.tolerance, args.metrics, args.mse_ceiling)
+    regressions = [row for row in rows if row[-1]]
+    print('{:>14} {:>10} {:>22} {:>12} {:>12} {:>8}'.format('method', 'data', 'metric', 'baseline', 'current', 'change'))
+    for key, metric, old, new, worse, regressed in (rows if args.all else regressions):
+        if metric is None:
+            print('{:>14} {:>10}   failed: {}'.format(key[0], key[1], new))
+            continue
+        if metric == 'mse':
+            print('{:>14} {:>10}   diverged: mse {:.4g}, mean forecast mse {}'.format(
+                key[0], key[1], new, 'n/a' if old is None else '{:.4g}'.format(old)))
+            continue
+        print('{:>14} {:>10} {:>22} {:>12.3f} {:>12.3f} {:>+8.1%}{}'.format(
+            key[0], key[1], metric, old, new, worse, '  REGRESSION' if regressed else ''))
+    print('{} of {} comparisons regressed beyond {:.0%}'.format(len(regressions), len(rows), args.tolerance))
+    sys.exit(1 if regressions or broken else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Offline comparison of the drift detectors in utils.detector on loss streams.
+
+Streams are either logged by an online run (--detector_log in main.py, one loss per
+line) or synthetic with known change points. Each detector is replayed through the
+same control loop as exp_onenet_d3a / exp_fsnet_d3a: a sleep stage runs on drift or
+after 1000 steps without one, then the detector is reset. Reported per detector:
+mean detection delay and missed changes (only when change points are known), false
+alarms, sleep stages and the samples they retrain on, and detector time.
+
+    python -m benchmarks.replay_detectors
+    python -m benchmarks.replay_detectors --logs run1.log --changes 2500 6000
+"""
+import argparse
+import json
+import time
+import numpy as np
+import torch
+
+from utils.detector import DETECTORS, build_detector
+
+
+def read_log(path):
+    with open(path) as f:
+        return np.array([float(line) for line in f if line.strip() and line.strip() != 'reset'])
+
+
+def synthetic_streams(n_streams, length, seed=0):
+    """Squared-noise losses around a level that jumps at random change points."""
+    rng = np.random.RandomState(seed)
+    streams = []
+    for _ in range(n_streams):
+        changes = np.sort(rng.choice(np.arange(500, length - 500), size=length // 2500, replace=False))
+        level = np.empty(length)
+        for begin, end in zip(np.r_[0, changes], np.r_[changes, length]):
+            level[begin:end] = rng.uniform(0.2, 2.)
+        losses = level + 0.3 * level * rng.randn(length) ** 2
+        # only increases of the loss are drifts for the detectors
+        ups = [c for c in changes if level[c] > level[c - 1]]
+        streams.append((losses, ups))
+    return streams
+
+
+def replay(detector, losses, max_gap=1000):
+    """Returns the steps flagged as drift, the number of sleep stages and seconds spent in the detector."""
+    x = torch.zeros(1, 1, 1)
+    drifts, sleeps, spent = [], 0, 0.
+    for i, loss in enumerate(losses):
+        start = time.perf_counter()
+        detector.add_data(loss, x)
+        status, _ = detector.run_test()
+        spent += time.perf_counter() - start
+        if status == 1 or detector.cnt >= max_gap:
+            if status == 1:
+                drifts.append(i)
+            sleeps += 1
+            detector.reset()
+    return drifts, sleeps, spent
+
+
+def score(drifts, changes, tolerance):
+    """Detection delays of the changes found within tolerance, misses and false alarms."""
+    delays, used = [], set()
+    for c in changes:
+        hits = [d for d in drifts if c <= d < c + tolerance and d not in used]
+        if hits:
+            delays.append(hits[0] - c)
+            used.add(hits[0])
+    false_alarms = len([d for d in drifts if not any(c <= d < c + tolerance for c in changes)])
+    return delays, len(changes) - len(delays), false_alarms
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drift detector replay')
+    parser.add_argument('--logs', type=str, nargs='*', default=[], help='loss logs written with --detector_log')
+    parser.add_argument('--changes', type=int, nargs='*', default=None, help='known change points of the logs')
+    parser.add_argument('--detectors', type=str, nargs='+', default=list(DETECTORS))
+    parser.add_argument('--window', type=int, default=100, help='sleep_interval of the online run')
+    parser.add_argument('--sleep_epochs', type=int, default=1)
+    parser.add_argument('--alpha_w', type=float, default=0.0001)
+    parser.add_argument('--alpha_d', type=float, default=0.003)
+    parser.add_argument('--tolerance', type=int, default=500, help='steps after a change in which a drift counts as a detection')
+    parser.add_argument('--streams', type=int, default=5, help='synthetic streams when no log is given')
+    parser.add_argument('--length', type=int, default=20000)
+    parser.add_argument('--json', type=str, default=None, help='also write the results to this file')
+    args = parser.parse_args()
+
+    if args.logs:
+        streams = [(read_log(path), args.changes) for path in args.logs]
+    else:
+        streams = synthetic_streams(args.streams, args.length)
+
+    results = {}
+    for name in args.detectors:
+        total = {'steps': 0, 'delays': [], 'missed': 0, 'false_alarms': 0, 'drifts': 0, 'sleeps': 0, 'seconds': 0.}
+        for losses, changes in streams:
+            detector = build_detector(name, args.window, alpha_w=args.alpha_w, alpha_d=args.alpha_d)
+            drifts, sleeps, spent = replay(detector, losses)
+            total['steps'] += len(losses)
+            total['drifts'] += len(drifts)
+            total['sleeps'] += sleeps
+            total['seconds'] += spent
+            if changes is not None:
+                delays, missed, false_alarms = score(drifts, changes, args.tolerance)
+                total['delays'] += delays
+                total['missed'] += missed
+                total['false_alarms'] += false_alarms
+        known = streams[0][1] is not None
+        results[name] = {
+            'mean_delay': float(np.mean(total['delays'])) if total['delays'] else None,
+            'missed': total['missed'] if known else None,
+            'false_alarms_per_10k': 1e4 * total['false_alarms'] / total['steps'] if known else None,
+            'drifts': total['drifts'],
+            'sleep_stages': total['sleeps'],
+            'sleep_samples': total['sleeps'] * args.window * args.sleep_epochs,
+            'us_per_step': 1e6 * total['seconds'] / total['steps'],
+        }
+
+    fmt = lambda v, f: '-' if v is None else f.format(v)
+    print('{:>13} | {:>9} {:>7} {:>10} | {:>7} {:>7} {:>10} | {:>9}'.format(
+        'detector', 'delay', 'missed', 'FA/10k', 'drifts', 'sleeps', 'samples', 'us/step'))
+    for name, r in results.items():
+        print('{:>13} | {:>9} {:>7} {:>10} | {:>7} {:>7} {:>10} | {:>9.1f}'.format(
+            name, fmt(r['mean_delay'], '{:.1f}'), fmt(r['missed'], '{}'), fmt(r['false_alarms_per_10k'], '{:.2f}'),
+            r['drifts'], r['sleep_stages'], r['sleep_samples'], r['us_per_step']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
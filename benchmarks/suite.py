@@ -0,0 +1,281 @@
+"""
+End-to-end CPU benchmark of the exp methods: one training epoch through train()
+and the whole online phase through test(), on a synthetic series or a cut
+of a bundled dataset (ETTh1, finance.csv), with main.py's arguments (its
+defaults for everything not set here). Every (method, data) pair runs in its
+own process so that its peak RSS is its own and a failing method does not stop
+the suite. The report is JSON, see benchmarks/compare.py for the regression
+check against a stored one.
+
+The suite runs M by default, the setting the FSNet / OneNet tables use: under
+MS the time-axis branch of the OneNet models only learns from the target
+channel and its online phase blows up on these cuts. It runs at run.sh's
+learning rate of 1e-3: at main.py's 3e-3 the online AdamW steps of the
+cross-channel branch of onenet_tcn diverge on the synthetic series, with or
+without the time marks. fsnet runs on AdamW, not main.py's default Adbfgs: the
+curvature EMA of Adbfgs is never updated, so its steps are fixed-size sign
+steps that diverge here too (benchmarks.bench_adbfgs times it on its own). The
+d3a methods run with the D3A settings below, which turn on their detector and
+sleep stages.
+
+    python -m benchmarks.suite --out report.json
+    python -m benchmarks.suite --methods onenet_fsnet fsnet --data synthetic --channels 21 --features S --seq_len 60
+    python -m benchmarks.compare benchmarks/baselines/cpu.json report.json
+
+Reported per run: train_samples_per_sec (the epoch over the training split,
+including the validation pass and checkpoint train() does after it),
+online_steps_per_sec and step_p50_ms / step_p99_ms (the online update of one
+test window, without loading and metrics), test_seconds (all of test()), the
+final test mse and mean_forecast_mse (the mse of forecasting the training mean
+on the same windows), sleep_stages (the drift detections of the d3a methods),
+peak_rss_mb, param_mb (model and decision MLP parameters) and state_mb
+(buffers, optimizer moments and replay buffers).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import importlib
+import subprocess
+import numpy as np
+import pandas as pd
+import torch
+
+from main import get_parser
+from benchmarks.common import make_args
+from utils.profiler import LatencyHistogram
+from utils.snapshot import MODULES, OPTIMIZERS, OBJECTS
+
+
+METHODS = ['onenet_fsnet', 'fsnet', 'onenet_tcn', 'patch_tcn', 'er', 'derpp', 'ogd', 'naive', 'fsnet_d3a', 'onenet_d3a']
+DATA = ['synthetic', 'ETTh1', 'finance']
+# the d3a methods with main.py's defaults (--sleep_interval 1, --online_adjust 0) skip the
+# detector, the replay buffer and the sleep stage and run exactly like fsnet / onenet_fsnet;
+# a day of hourly bars between sleep stages and both adjustments turn them on
+D3A = dict(sleep_interval=24, online_adjust=0.5, offline_adjust=0.5)
+# bundled files, their target column and date column
+BUNDLED = {'ETTh1': ('ETTh1.csv', 'OT', 'date'), 'finance': ('finance.csv', 'Close', 'Date')}
+# higher is better for these, lower for every other metric
+THROUGHPUT = ('train_samples_per_sec', 'online_steps_per_sec')
+METRICS = THROUGHPUT + ('step_p50_ms', 'step_p99_ms', 'peak_rss_mb', 'param_mb', 'state_mb')
+
+
+def _bundled(file):
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', file)
+
+
+def n_channels(data, channels):
+    """Channels a run on data has: the requested ones for synthetic, the file's otherwise."""
+    if data == 'synthetic':
+        return channels
+    return len(pd.read_csv(_bundled(BUNDLED[data][0]), nrows=0).columns) - 1
+
+
+def write_data(data, root, rows, channels, seed=0):
+    """Writes the first `rows` rows of `data` as a custom dataset csv under root; returns (file, target, n columns)."""
+    path = os.path.join(root, data + '.csv')
+    if data == 'synthetic':
+        # a daily cycle per channel plus AR(1) noise, stationary so that the online phase
+        # stays in the range the scaler and the training split saw
+        rng = np.random.RandomState(seed)
+        t = np.arange(rows)[:, None]
+        noise = rng.randn(rows, channels) * 0.1
+        for i in range(1, rows):
+            noise[i] += 0.9 * noise[i - 1]
+        values = np.sin(2 * np.pi * t / 24 + rng.uniform(0, 2 * np.pi, channels)) + noise
+        df = pd.DataFrame(values, columns=['x{}'.format(k) for k in range(channels - 1)] + ['OT'])
+        df.insert(0, 'date', pd.date_range('2020-01-01', periods=rows, freq='h').astype(str))
+        target = 'OT'
+    else:
+        file, target, date = BUNDLED[data]
+        df = pd.read_csv(_bundled(file), nrows=rows)
+        df = df.rename(columns={date: 'date'})
+    df.to_csv(path, index=False)
+    return os.path.basename(path), target, df.shape[1] - 1
+
+
+def mean_forecast_mse(data, seq_len, pred_len, c_out):
+    """mse of forecasting the training mean (0 once scaled) of the c_out target columns over every test window of data."""
+    y = getattr(data, 'dataset', data).data_y[:, -c_out:]
+    n = len(y) - seq_len - pred_len + 1
+    future = np.stack([y[seq_len + k:seq_len + k + n] for k in range(pred_len)], 1)
+    return float(np.square(future).mean())
+
+
+def _tensor_bytes(obj, seen, depth=0):
+    """Bytes of the distinct tensor storages reachable from obj through containers and object attributes."""
+    if isinstance(obj, torch.Tensor):
+        # untyped_storage from torch 2.0 on, storage before
+        storage = obj.untyped_storage() if hasattr(obj, 'untyped_storage') else obj.storage()
+        key = storage.data_ptr()
+        if key in seen or obj.device.type == 'meta':
+            return 0
+        seen.add(key)
+        return storage.nbytes()
+    if depth > 4 or isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return 0
+    if isinstance(obj, torch.nn.Module):
+        return sum(_tensor_bytes(t, seen, depth + 1) for t in list(obj.parameters()) + list(obj.buffers()))
+    if isinstance(obj, torch.optim.Optimizer):
+        return _tensor_bytes(list(obj.state.values()), seen, depth + 1)
+    if isinstance(obj, dict):
+        return sum(_tensor_bytes(v, seen, depth + 1) for v in obj.values())
+    if isinstance(obj, (list, tuple, set)):
+        return sum(_tensor_bytes(v, seen, depth + 1) for v in obj)
+    if hasattr(obj, '__dict__'):
+        return _tensor_bytes(vars(obj), seen, depth + 1)
+    return 0
+
+
+def memory(exp):
+    seen = set()
+    params = sum(_tensor_bytes(list(getattr(exp, name).parameters()), seen)
+                 for name in MODULES if isinstance(getattr(exp, name, None), torch.nn.Module))
+    state = sum(_tensor_bytes(list(getattr(exp, name).buffers()), seen)
+                for name in MODULES if isinstance(getattr(exp, name, None), torch.nn.Module))
+    state += sum(_tensor_bytes(getattr(exp, name, None), seen) for name in OPTIMIZERS + OBJECTS)
+    return params / 2 ** 20, state / 2 ** 20
+
+
+def run_one(config):
+    """Trains and tests config['method'] in this process, returns its report entry."""
+    torch.set_num_threads(config['threads'])
+    torch.manual_seed(0)
+    np.random.seed(0)
+    work = config['work']
+    os.chdir(work)
+    data_path, target, n = write_data(config['data'], work, config['rows'], config['channels'])
+    # main.py's defaults otherwise
+    enc_in = 1 if config['features'] == 'S' else n
+    c_out = enc_in if config['features'] == 'M' else 1
+    args = make_args(config['method'], data='custom', root_path=work, data_path=data_path, target=target,
+                     features=config['features'], enc_in=enc_in, dec_in=enc_in, c_out=c_out,
+                     seq_len=config['seq_len'], pred_len=config['pred_len'], learning_rate=config['learning_rate'],
+                     train_epochs=1,
+                     checkpoints=os.path.join(work, 'checkpoints'), use_gpu=False, use_adbfgs=False,
+                     detector_log=os.path.join(work, 'detector.log'),
+                     **(D3A if config['method'].endswith('_d3a') else {}))
+    module = importlib.import_module('exp.exp_' + config['method'])
+    exp = module.Exp_TS2VecSupervised(args)
+    setting = '{}_{}'.format(config['method'], config['data'])
+
+    n_train = len(exp._get_data(flag='train')[0])
+    reference = mean_forecast_mse(exp._get_data(flag='test')[0], args.seq_len, args.pred_len, c_out)
+    t = time.perf_counter()
+    exp.train(setting)
+    train_time = time.perf_counter() - t
+
+    hist = LatencyHistogram()
+    process = exp._process_one_batch
+
+    def timed(*a, **kw):
+        if kw.get('mode') != 'test':
+            return process(*a, **kw)
+        t = time.perf_counter()
+        out = process(*a, **kw)
+        hist.add(time.perf_counter() - t)
+        return out
+    exp._process_one_batch = timed
+    t = time.perf_counter()
+    result = exp.test(setting)
+    test_time = time.perf_counter() - t
+
+    params, state = memory(exp)
+    return {
+        'train_samples_per_sec': n_train / train_time,
+        'online_steps_per_sec': hist.n / hist.total,
+        'step_p50_ms': 1e3 * hist.quantile(.5),
+        'step_p99_ms': 1e3 * hist.quantile(.99),
+        'test_seconds': test_time,
+        'online_steps': hist.n,
+        'mse': float(result[0][1]),
+        'mean_forecast_mse': reference,
+        'sleep_stages': getattr(getattr(exp, 'detector', None), 'shift_cnt', 0),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'param_mb': params,
+        'state_mb': state,
+    }
+
+
+def run(config, timeout):
+    """run_one in a fresh process; a failure is reported in the entry instead of raised."""
+    work = tempfile.mkdtemp(prefix='bench_')
+    config = dict(config, work=work)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        out = subprocess.run([sys.executable, '-m', 'benchmarks.suite', '--worker', json.dumps(config)], cwd=root,
+                             capture_output=True, text=True, timeout=timeout)
+        lines = [l for l in out.stdout.splitlines() if l.startswith('{')]
+        if out.returncode != 0 or not lines:
+            return {'error': (out.stderr.strip().splitlines() or ['exit code {}'.format(out.returncode)])[-1]}
+        return json.loads(lines[-1])
+    except subprocess.TimeoutExpired:
+        return {'error': 'timed out after {}s'.format(timeout)}
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cpu benchmark suite of the online learning methods')
+    parser.add_argument('--methods', type=str, nargs='+', default=METHODS)
+    parser.add_argument('--data', type=str, nargs='+', default=DATA, help='synthetic and/or bundled datasets: ' + ', '.join(BUNDLED))
+    parser.add_argument('--rows', type=int, default=1000, help='rows of the series; 20%% train, 5%% validation, 75%% online')
+    parser.add_argument('--channels', type=int, default=7, help='channels of the synthetic series, the bundled ones keep theirs')
+    parser.add_argument('--features', type=str, default='M', help='M, S or MS')
+    parser.add_argument('--seq_len', type=int, default=None, help='main.py\'s default if not given')
+    parser.add_argument('--pred_len', type=int, default=None, help='main.py\'s default if not given')
+    parser.add_argument('--learning_rate', type=float, default=1e-3,
+                        help='run.sh\'s, which only runs ECL at main.py\'s default of 3e-3')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--timeout', type=int, default=1800, help='seconds per run')
+    parser.add_argument('--out', type=str, default=None, help='json report, printed when not given')
+    parser.add_argument('--worker', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    defaults = get_parser().parse_args([])
+    for name in ('seq_len', 'pred_len'):
+        if getattr(args, name) is None:
+            setattr(args, name, getattr(defaults, name))
+
+    if args.worker:
+        # results and logs of the exp go to stdout too, the entry is the last line
+        print(json.dumps(run_one(json.loads(args.worker))))
+        return
+
+    report = {
+        'meta': {'torch': torch.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+                 'cpus': os.cpu_count(), 'threads': args.threads, 'rows': args.rows, 'features': args.features,
+                 'seq_len': args.seq_len, 'pred_len': args.pred_len, 'channels': args.channels,
+                 'learning_rate': args.learning_rate},
+        'results': [],
+    }
+    for data in args.data:
+        for method in args.methods:
+            config = dict(method=method, data=data, rows=args.rows, channels=args.channels, features=args.features,
+                          seq_len=args.seq_len, pred_len=args.pred_len, learning_rate=args.learning_rate,
+                          threads=args.threads)
+            t = time.time()
+            entry = dict(method=method, data=data, features=args.features, seq_len=args.seq_len, pred_len=args.pred_len,
+                         channels=n_channels(data, args.channels), **run(config, args.timeout))
+            report['results'].append(entry)
+            if 'error' in entry:
+                print('{:>14} {:>10}: failed: {}'.format(method, data, entry['error']))
+            else:
+                print('{:>14} {:>10}: train {:8.1f} samples/s | online {:6.2f} steps/s, p99 {:8.2f}ms | rss {:7.1f}MB, '
+                      'params {:6.2f}MB, state {:6.2f}MB | {:.0f}s'.format(
+                          method, data, entry['train_samples_per_sec'], entry['online_steps_per_sec'], entry['step_p99_ms'],
+                          entry['peak_rss_mb'], entry['param_mb'], entry['state_mb'], time.time() - t))
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+from utils.tools import StandardScaler
+
+# bump when the preprocessing in data_loader.py changes, so old entries are not reused
+CACHE_VERSION = 1
+_FIELDS = ['data_x', 'data_y', 'data_stamp', 'scaler_mean', 'scaler_std']
+_digests = {}
+
+
+def csv_digest(path):
+    """
+    sha1 of the source file. Memoized on (path, size, mtime) so the three splits
+    of one run hash the file only once.
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if key not in _digests:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+
+def cache_key(dataset):
+    """
+    Everything the preprocessed arrays depend on: the csv content, the dataset
+    class (it owns the border formula), the split and the feature options.
+    label_len/pred_len only change the windows, not the arrays, except for
+    Dataset_Pred which appends pred_len future time stamps.
+    """
+    config = {
+        'version': CACHE_VERSION,
+        'csv': csv_digest(os.path.join(dataset.root_path, dataset.data_path)),
+        'class': type(dataset).__name__,
+        'split': getattr(dataset, 'set_type', 'pred'),
+        'seq_len': dataset.seq_len,
+        'features': dataset.features,
+        'target': dataset.target,
+        'cols': getattr(dataset, 'cols', None),
+        'scale': dataset.scale,
+        'inverse': dataset.inverse,
+        'timeenc': dataset.timeenc,
+        'freq': dataset.freq,
+    }
+    if config['class'] == 'Dataset_Pred':
+        config['pred_len'] = dataset.pred_len
+    blob = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode()).hexdigest(), config
+
+
+def load_cached(dataset, key):
+    folder = os.path.join(dataset.cache_dir, key)
+    if not os.path.exists(os.path.join(folder, 'meta.json')):
+        return False
+    arrays = {name: np.load(os.path.join(folder, name + '.npy'), mmap_mode='r') for name in _FIELDS}
+    dataset.data_x = arrays['data_x']
+    dataset.data_y = arrays['data_y']
+    dataset.data_stamp = arrays['data_stamp']
+    dataset.scaler = StandardScaler()
+    dataset.scaler.mean = np.array(arrays['scaler_mean'])
+    dataset.scaler.std = np.array(arrays['scaler_std'])
+    return True
+
+
+def store_cached(dataset, key, config):
+    os.makedirs(dataset.cache_dir, exist_ok=True)
+    folder = os.path.join(dataset.cache_dir, key)
+    arrays = {
+        'data_x': dataset.data_x,
+        'data_y': dataset.data_y,
+        'data_stamp': dataset.data_stamp,
+        'scaler_mean': dataset.scaler.mean,
+        'scaler_std': dataset.scaler.std,
+    }
+    # write next to the final location and rename, concurrent runs never see a partial entry
+    tmp = tempfile.mkdtemp(prefix='.' + key, dir=dataset.cache_dir)
+    for name, value in arrays.items():
+        value = np.asarray(value)
+        if value.dtype == object:
+            value = value.astype(np.float64)
+        np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(value))
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(config, f, indent=1, default=str)
+    try:
+        os.rename(tmp, folder)
+    except OSError:
+        # another run stored the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def read_data(dataset):
+    """
+    Runs `dataset.__read_data__()` unless the scaled arrays for the same csv and
+    split config are already in `dataset.cache_dir`, in which case they are
+    memory-mapped from the .npy files instead.
+    """
+    if getattr(dataset, 'cache_dir', None) is None:
+        dataset.__read_data__()
+        return
+    key, config = cache_key(dataset)
+    if load_cached(dataset, key):
+        return
+    dataset.__read_data__()
+    store_cached(dataset, key, config)
+    load_cached(dataset, key)
@@ -3,11 +3,13 @@ import numpy as np
 import pandas as pd
 import pdb
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
+from numpy.lib.stride_tricks import as_strided
 from sklearn.preprocessing import StandardScaler as sklearn_StandardScaler
 
 from utils.tools import StandardScaler
 from utils.timefeatures import time_features
+from data.data_cache import read_data
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -15,7 +17,7 @@ warnings.filterwarnings('ignore')
 class Dataset_ETT_hour(Dataset):
     def __init__(self, root_path, flag='train', delay_fb=False, size=None, 
                  features='S', data_path='ETTh1.csv', 
-                 target='OT', scale=True, inverse=False, timeenc=0, freq='h', cols=None):
+                 target='OT', scale=True, inverse=False, timeenc=0, freq='h', cols=None, cache_dir=None):
         # size [seq_len, label_len, pred_len]
         # info
         if size == None:
@@ -40,7 +42,8 @@ class Dataset_ETT_hour(Dataset):
         
         self.root_path = root_path
         self.data_path = data_path
-        self.__read_data__()
+        self.cache_dir = cache_dir
+        read_data(self)
 
     def __read_data__(self):
         self.scaler = StandardScaler()
@@ -70,20 +73,14 @@ class Dataset_ETT_hour(Dataset):
         else:
             data = df_data.values
 
+        # encode the whole date column once (memoized across splits) and slice it
+        full_stamp = time_features(df_raw[['date']], timeenc=self.timeenc, freq=self.freq)
         if self.timeenc == 2:
-            train_df_stamp = df_raw[['date']][border1s[0]:border2s[0]]
-            train_df_stamp['date'] = pd.to_datetime(train_df_stamp.date)
-            train_date_stamp = time_features(train_df_stamp, timeenc=self.timeenc)
+            train_date_stamp = full_stamp[border1s[0]:border2s[0]]
             date_scaler = sklearn_StandardScaler().fit(train_date_stamp)
-
-            df_stamp = df_raw[['date']][border1:border2]
-            df_stamp['date'] = pd.to_datetime(df_stamp.date)
-            data_stamp = time_features(df_stamp, timeenc=self.timeenc, freq=self.freq)
-            data_stamp = date_scaler.transform(data_stamp)
+            data_stamp = date_scaler.transform(full_stamp[border1:border2])
         else:
-            df_stamp = df_raw[['date']][border1:border2]
-            df_stamp['date'] = pd.to_datetime(df_stamp.date)
-            data_stamp = time_features(df_stamp, timeenc=self.timeenc, freq=self.freq)
+            data_stamp = full_stamp[border1:border2]
 
         self.data_x = data[border1:border2]
         if self.inverse:
@@ -126,7 +123,7 @@ class Dataset_ETT_hour(Dataset):
 class Dataset_ETT_minute(Dataset):
     def __init__(self, root_path, flag='train', delay_fb=False, size=None, 
                  features='S', data_path='ETTm1.csv', 
-                 target='OT', scale=True, inverse=False, timeenc=0, freq='t', cols=None):
+                 target='OT', scale=True, inverse=False, timeenc=0, freq='t', cols=None, cache_dir=None):
         # size [seq_len, label_len, pred_len]
         # info
         if size == None:
@@ -151,7 +148,8 @@ class Dataset_ETT_minute(Dataset):
         
         self.root_path = root_path
         self.data_path = data_path
-        self.__read_data__()
+        self.cache_dir = cache_dir
+        read_data(self)
 
     def __read_data__(self):
         self.scaler = StandardScaler()
@@ -179,20 +177,14 @@ class Dataset_ETT_minute(Dataset):
         else:
             data = df_data.values
 
+        # encode the whole date column once (memoized across splits) and slice it
+        full_stamp = time_features(df_raw[['date']], timeenc=self.timeenc, freq=self.freq)
         if self.timeenc == 2:
-            train_df_stamp = df_raw[['date']][border1s[0]:border2s[0]]
-            train_df_stamp['date'] = pd.to_datetime(train_df_stamp.date)
-            train_date_stamp = time_features(train_df_stamp, timeenc=self.timeenc)
+            train_date_stamp = full_stamp[border1s[0]:border2s[0]]
             date_scaler = sklearn_StandardScaler().fit(train_date_stamp)
-
-            df_stamp = df_raw[['date']][border1:border2]
-            df_stamp['date'] = pd.to_datetime(df_stamp.date)
-            data_stamp = time_features(df_stamp, timeenc=self.timeenc, freq=self.freq)
-            data_stamp = date_scaler.transform(data_stamp)
+            data_stamp = date_scaler.transform(full_stamp[border1:border2])
         else:
-            df_stamp = df_raw[['date']][border1:border2]
-            df_stamp['date'] = pd.to_datetime(df_stamp.date)
-            data_stamp = time_features(df_stamp, timeenc=self.timeenc, freq=self.freq)
+            data_stamp = full_stamp[border1:border2]
         
         self.data_x = data[border1:border2]
         if self.inverse:
@@ -235,7 +227,7 @@ class Dataset_ETT_minute(Dataset):
 class Dataset_Custom(Dataset):
     def __init__(self, root_path, flag='train', delay_fb=False, size=None, 
                  features='S', data_path='ETTh1.csv', 
-                 target='OT', scale=True, inverse=False, timeenc=0, freq='h', cols=None):
+                 target='OT', scale=True, inverse=False, timeenc=0, freq='h', cols=None, cache_dir=None):
         # size [seq_len, label_len, pred_len]
         # info
         if size == None:
@@ -260,7 +252,8 @@ class Dataset_Custom(Dataset):
         self.cols=cols
         self.root_path = root_path
         self.data_path = data_path
-        self.__read_data__()
+        self.cache_dir = cache_dir
+        read_data(self)
 
     def __read_data__(self):
         self.scaler = StandardScaler()
@@ -299,9 +292,8 @@ class Dataset_Custom(Dataset):
         else:
             data = df_data.values
             
-        df_stamp = df_raw[['date']][border1:border2]
-        df_stamp['date'] = pd.to_datetime(df_stamp.date)
-        data_stamp = time_features(df_stamp, timeenc=self.timeenc, freq=self.freq)
+        full_stamp = time_features(df_raw[['date']], timeenc=self.timeenc, freq=self.freq)
+        data_stamp = full_stamp[border1:border2]
 
         self.data_x = data[border1:border2]
         if self.inverse:
@@ -344,7 +336,7 @@ class Dataset_Custom(Dataset):
 class Dataset_Pred(Dataset):
     def __init__(self, root_path, flag='pred',  delay_fb=False,  size=None, 
                  features='S', data_path='ETTh1.csv', 
-                 target='OT', scale=True, inverse=False, timeenc=0, freq='15min', cols=None):
+                 target='OT', scale=True, inverse=False, timeenc=0, freq='15min', cols=None, cache_dir=None):
         # size [seq_len, label_len, pred_len]
         # info
         if size == None:
@@ -367,7 +359,8 @@ class Dataset_Pred(Dataset):
         self.cols=cols
         self.root_path = root_path
         self.data_path = data_path
-        self.__read_data__()
+        self.cache_dir = cache_dir
+        read_data(self)
 
     def __read_data__(self):
         self.scaler = StandardScaler()
@@ -398,13 +391,15 @@ class Dataset_Pred(Dataset):
         else:
             data = df_data.values
             
-        tmp_stamp = df_raw[['date']][border1:border2]
-        tmp_stamp['date'] = pd.to_datetime(tmp_stamp.date)
-        pred_dates = pd.date_range(tmp_stamp.date.values[-1], periods=self.pred_len+1, freq=self.freq)
+        # the history part is the tail of the (memoized) full column encoding,
+        # only the future stamps are encoded here
+        full_stamp = time_features(df_raw[['date']], timeenc=self.timeenc, freq=self.freq[-1:])
+        last_date = pd.to_datetime(df_raw['date'].values[-1:])[0]
+        pred_dates = pd.date_range(last_date, periods=self.pred_len+1, freq=self.freq)
         
-        df_stamp = pd.DataFrame(columns = ['date'])
-        df_stamp.date = list(tmp_stamp.date.values) + list(pred_dates[1:])
-        data_stamp = time_features(df_stamp, timeenc=self.timeenc, freq=self.freq[-1:])
+        df_stamp = pd.DataFrame({'date': pred_dates[1:]})
+        pred_stamp = time_features(df_stamp, timeenc=self.timeenc, freq=self.freq[-1:])
+        data_stamp = np.concatenate([full_stamp[border1:border2], pred_stamp], 0)
 
         self.data_x = data[border1:border2]
         if self.inverse:
@@ -445,9 +440,12 @@ class Dataset_Pred(Dataset):
         return self.scaler.inverse_transform(data)
 
 class FinancialDataset(Dataset):
+    # the scaler only covers the feature columns, the target is kept raw
+    target_scaled = False
+
     def __init__(self, root_path, flag='train', size=None, 
                  features='MS', data_path='finance.csv', 
-                 target='Close', scale=True, inverse=False, timeenc=0, freq='b', cols = None):
+                 target='Close', scale=True, inverse=False, timeenc=0, freq='b', cols = None, cache_dir=None):
         # size [seq_len, label_len, pred_len]
         if size is None:
             self.seq_len = 24  # customize based on your needs
@@ -472,7 +470,8 @@ class FinancialDataset(Dataset):
         
         self.root_path = root_path
         self.data_path = data_path
-        self.__read_data__()
+        self.cache_dir = cache_dir
+        read_data(self)
 
     def __read_data__(self):
         self.scaler = StandardScaler()
@@ -602,4 +601,320 @@ class FinancialDataset(Dataset):
         return len(self.data_x) - self.seq_len - self.pred_len + 1
 
     def inverse_transform(self, data):
-        return self.scaler.inverse_transform(data)
\ No newline at end of file
+        return self.scaler.inverse_transform(data)
+
+
+# missing value marker of the preprocessed (ourpped) price files
+SENTINEL = -123321.
+_panels = {}
+
+
+def _find_dates(root_path, data_path):
+    """trading_dates.csv next to the ticker folder or in one of its parents below root_path."""
+    folder = os.path.abspath(os.path.join(root_path, data_path))
+    root = os.path.abspath(root_path)
+    while True:
+        path = os.path.join(folder, 'trading_dates.csv')
+        if os.path.exists(path):
+            return path
+        if folder == root or os.path.dirname(folder) == folder:
+            return None
+        folder = os.path.dirname(folder)
+
+
+def _read_ticker(path, n_dates):
+    """
+    Raw ticker csv, either with a Date column (any order, aligned later) or
+    header-less preprocessed rows that already follow trading_dates.csv.
+    """
+    with open(path) as f:
+        first = f.readline()
+    if 'Date' in first.split(','):
+        df = pd.read_csv(path)
+        df = df.loc[:, [c for c in df.columns if not c.startswith('Unnamed')]]
+        df['Date'] = pd.to_datetime(df['Date'])
+        return df.set_index('Date').sort_index()
+    df = pd.read_csv(path, header=None)
+    df.columns = [str(c) for c in df.columns]
+    assert n_dates is None or len(df) == n_dates, '{} is not aligned with trading_dates.csv'.format(path)
+    return df
+
+
+def load_panel(root_path, data_path, target, cols=None):
+    """
+    Stacks every ticker csv of a folder into one float32 array (ticker x time x feature),
+    target last, on the trading_dates.csv calendar (union of all ticker dates if there is
+    none). Missing days and sentinel values become NaN.
+    """
+    folder = os.path.join(root_path, data_path)
+    tickers = sorted(f[:-len('.csv')] for f in os.listdir(folder) if f.endswith('.csv'))
+    dates_path = _find_dates(root_path, data_path)
+    dates = pd.to_datetime(pd.read_csv(dates_path, header=None)[0]) if dates_path else None
+
+    frames = [_read_ticker(os.path.join(folder, t + '.csv'), None if dates is None else len(dates)) for t in tickers]
+    if isinstance(frames[0].index, pd.DatetimeIndex):
+        if dates is None:
+            dates = pd.DatetimeIndex(sorted(set().union(*[f.index for f in frames])))
+        frames = [f[~f.index.duplicated()].reindex(dates) for f in frames]
+    elif dates is None:
+        dates = pd.bdate_range('2000-01-03', periods=len(frames[0]))
+    dates = pd.DatetimeIndex(dates)
+
+    # some tickers carry extra columns, keep the ones every ticker has
+    common = [c for c in frames[0].columns if all(c in f.columns for f in frames)]
+    if target not in common:
+        raise ValueError('target {!r} is not a column of every ticker in {}, the common columns are {}'.format(
+            target, folder, common))
+    if not cols:
+        cols = [c for c in common if c != target]
+    panel = np.empty((len(tickers), len(dates), len(cols) + 1), dtype=np.float32)
+    for i, f in enumerate(frames):
+        panel[i] = f[cols + [target]].to_numpy(dtype=np.float32)
+    panel[panel == SENTINEL] = np.nan
+    return tickers, dates, cols, panel
+
+
+class PanelFinancialDataset(Dataset):
+    """
+    Multi-ticker version of FinancialDataset: data_path is a folder of ticker csvs
+    (e.g. kdd17/ourpped, stocknet-dataset/price/oraw).
+
+    All tickers are loaded once per process into a single float32 tensor in shared
+    memory, which the train/val/test splits and the DataLoader workers all reuse.
+    Features are scaled per ticker with train statistics, the target is kept raw.
+    A window is served only if every day in it is present for its ticker; samples
+    are ordered by time, then ticker, and `self.index[i]` is the (ticker, start)
+    pair of sample i.
+    """
+    target_scaled = False
+
+    def __init__(self, root_path, flag='train', size=None,
+                 features='MS', data_path='kdd17/ourpped',
+                 target='12', scale=True, inverse=False, timeenc=0, freq='b', cols=None, cache_dir=None):
+        # size [seq_len, label_len, pred_len]
+        if size is None:
+            self.seq_len = 24
+            self.label_len = 1
+            self.pred_len = 1
+        else:
+            self.seq_len = size[0]
+            self.label_len = size[1]
+            self.pred_len = size[2]
+
+        assert flag in ['train', 'test', 'val']
+        type_map = {'train': 0, 'val': 1, 'test': 2}
+        self.set_type = type_map[flag]
+
+        self.features = features
+        self.target = target
+        self.scale = scale
+        self.inverse = inverse
+        self.timeenc = timeenc
+        self.freq = freq
+        self.cols = cols
+
+        self.root_path = root_path
+        self.data_path = data_path
+        # the panel is already shared between splits, there is nothing to cache on disk
+        self.cache_dir = None
+        self.__read_data__()
+
+    def __read_data__(self):
+        key = (os.path.abspath(os.path.join(self.root_path, self.data_path)), self.target,
+               tuple(self.cols) if self.cols else None, self.scale, self.timeenc, self.freq)
+        if key not in _panels:
+            tickers, dates, cols, panel = load_panel(self.root_path, self.data_path, self.target, self.cols)
+            valid = ~np.isnan(panel).any(-1)
+            self.scaler = StandardScaler()
+            if self.scale:
+                train = panel[:, :int(len(dates)*0.7), :-1]
+                self.scaler.mean = np.nanmean(train, axis=1, keepdims=True)
+                std = np.nanstd(train, axis=1, keepdims=True)
+                self.scaler.std = np.where(std > 0, std, 1.).astype(np.float32)
+                panel[..., :-1] -= self.scaler.mean
+                panel[..., :-1] /= self.scaler.std
+            np.nan_to_num(panel, copy=False)
+            # the exp's time encoding, scaled on the train range as in Dataset_ETT_hour
+            stamp = time_features(pd.DataFrame({'date': dates}), timeenc=self.timeenc, freq=self.freq)
+            if self.timeenc == 2:
+                stamp = sklearn_StandardScaler().fit(stamp[:int(len(dates)*0.7)]).transform(stamp)
+            _panels[key] = {
+                'tickers': tickers, 'dates': dates, 'cols': cols, 'scaler': self.scaler,
+                'panel': torch.from_numpy(panel).share_memory_(),
+                'stamp': torch.from_numpy(stamp.astype(np.float32)).share_memory_(),
+                'valid': valid,
+            }
+        entry = _panels[key]
+        self.tickers, self.dates, self.scaler = entry['tickers'], entry['dates'], entry['scaler']
+        self.panel = entry['panel']
+        self.stamp = entry['stamp']
+
+        n = len(self.dates)
+        border1s = [0, int(n*0.7) - self.seq_len, int(n*0.9) - self.seq_len]
+        border2s = [int(n*0.7), int(n*0.9), n]
+        border1 = border1s[self.set_type]
+        border2 = border2s[self.set_type]
+
+        # window [s, s + seq_len + pred_len) is usable iff it holds no missing day
+        length = self.seq_len + self.pred_len
+        missing = np.zeros((len(self.tickers), n + 1), dtype=np.int64)
+        np.cumsum(~entry['valid'], axis=1, out=missing[:, 1:])
+        self.starts = np.arange(border1, border2 - length + 1)
+        self.ok = missing[:, self.starts + length] == missing[:, self.starts]
+        t, k = np.nonzero(self.ok.T)
+        self.index = np.stack([k, self.starts[t]], axis=1)
+
+    def __getitem__(self, index):
+        ticker, s_begin = self.index[index]
+        s_end = s_begin + self.seq_len
+        r_begin = s_end - self.label_len
+        r_end = r_begin + self.label_len + self.pred_len
+
+        # views into the shared panel, nothing is copied until collation
+        panel = self.panel[ticker].numpy()
+        stamp = self.stamp.numpy()
+        seq_x = panel[s_begin:s_end, :-1]
+        seq_y = panel[r_begin:r_end, -1:]
+        seq_x_mark = stamp[s_begin:s_end]
+        seq_y_mark = stamp[r_begin:r_end]
+
+        return seq_x, seq_y, seq_x_mark, seq_y_mark
+
+    def __len__(self):
+        return len(self.index)
+
+    def lockstep(self):
+        """
+        Yields every window start of the split with all tickers stacked on the first
+        axis: (seq_x, seq_y, seq_x_mark, seq_y_mark, mask), where mask flags the
+        tickers whose window has no missing day. The windows are slices of the
+        shared panel, nothing is copied.
+        """
+        n = len(self.tickers)
+        for j, s_begin in enumerate(self.starts):
+            s_end = s_begin + self.seq_len
+            r_begin = s_end - self.label_len
+            r_end = r_begin + self.label_len + self.pred_len
+
+            seq_x = self.panel[:, s_begin:s_end, :-1]
+            seq_y = self.panel[:, r_begin:r_end, -1:]
+            seq_x_mark = self.stamp[s_begin:s_end].expand(n, -1, -1)
+            seq_y_mark = self.stamp[r_begin:r_end].expand(n, -1, -1)
+
+            yield seq_x, seq_y, seq_x_mark, seq_y_mark, torch.from_numpy(self.ok[:, j])
+
+    def inverse_transform(self, data):
+        # the target is never scaled
+        return data
+
+
+def _windows(data, length):
+    # (n_windows, length, n_features) strided view, no data is copied
+    return as_strided(data, shape=(max(len(data) - length + 1, 0), length) + data.shape[1:],
+                      strides=data.strides[:1] + data.strides, writeable=False)
+
+
+class WindowBatches(Dataset):
+    """
+    Batched window source over one of the datasets above.
+
+    All windows of `data_x`, `data_y` and `data_stamp` are exposed as strided
+    views, so indexing with a slice of window indices returns the whole batch
+    as zero-copy views and indexing with an index array gathers the batch in a
+    single vectorized take instead of one Python slice per sample.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+        seq_len, label_len, pred_len = dataset.seq_len, dataset.label_len, dataset.pred_len
+        self.seq_len, self.label_len, self.pred_len = seq_len, label_len, pred_len
+        self.n = len(dataset)
+
+        # delayed feedback serves non-overlapping test windows
+        delay_fb = getattr(dataset, 'delay_fb', False) and getattr(dataset, 'set_type', None) == 2
+        self.stride = pred_len if delay_fb else 1
+        # Dataset_Pred only knows the label part of seq_y
+        y_len = label_len if isinstance(dataset, Dataset_Pred) else label_len + pred_len
+        inverse = getattr(dataset, 'inverse', False)
+
+        self.x_windows = _windows(dataset.data_x, seq_len)
+        self.x_mark_windows = _windows(dataset.data_stamp, seq_len)
+        self.y_mark_windows = _windows(dataset.data_stamp, label_len + pred_len)
+        if inverse and isinstance(dataset, Dataset_Pred):
+            self.y_windows, self.y_pred_windows = _windows(dataset.data_x, y_len), None
+        elif inverse and label_len > 0 and not isinstance(dataset, FinancialDataset):
+            # label part comes from the scaled inputs, horizon from the raw targets
+            self.y_windows = _windows(dataset.data_x, label_len)
+            self.y_pred_windows = _windows(dataset.data_y[label_len:], pred_len)
+        else:
+            self.y_windows, self.y_pred_windows = _windows(dataset.data_y, y_len), None
+
+    def _starts(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.n)
+            return slice(start * self.stride, stop * self.stride, step * self.stride)
+        index = np.asarray(index)
+        if index.ndim == 1 and len(index) > 1 and np.all(np.diff(index) == 1):
+            return slice(index[0] * self.stride, (index[-1] + 1) * self.stride, self.stride)
+        return index * self.stride
+
+    def __getitem__(self, index):
+        s_begin = self._starts(index)
+        if isinstance(s_begin, slice):
+            offset = self.seq_len - self.label_len
+            r_begin = slice(s_begin.start + offset, s_begin.stop + offset, s_begin.step)
+        else:
+            r_begin = s_begin + self.seq_len - self.label_len
+
+        seq_x = self.x_windows[s_begin]
+        seq_y = self.y_windows[r_begin]
+        if self.y_pred_windows is not None:
+            seq_y = np.concatenate([seq_y, self.y_pred_windows[r_begin]], axis=-2)
+        seq_x_mark = self.x_mark_windows[s_begin]
+        seq_y_mark = self.y_mark_windows[r_begin]
+
+        return seq_x, seq_y, seq_x_mark, seq_y_mark
+
+    def __len__(self):
+        return self.n
+
+    def inverse_transform(self, data):
+        return self.dataset.inverse_transform(data)
+
+
+class WindowBatchSampler(Sampler):
+    """
+    Yields one batch of window indices at a time for `WindowBatches`. Without
+    shuffling the batches are contiguous slices and are served as views.
+    """
+    def __init__(self, n, batch_size, shuffle=False, drop_last=False):
+        self.n = n
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        order = None
+        if self.shuffle:
+            # same draw as RandomSampler, so seeded runs see the same batches
+            generator = torch.Generator()
+            generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+            order = torch.randperm(self.n, generator=generator).numpy()
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            stop = min(start + self.batch_size, self.n)
+            yield order[start:stop] if self.shuffle else slice(start, stop)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n // self.batch_size
+        return (self.n + self.batch_size - 1) // self.batch_size
+
+
+def window_loader(data_set, batch_size, shuffle=False, drop_last=False, num_workers=0):
+    """
+    Drop-in replacement for `DataLoader(data_set, ...)` that serves whole batches
+    from `WindowBatches`. Automatic batching is disabled, so there is no
+    per-sample collate; the arrays are only wrapped as tensors.
+    """
+    windows = WindowBatches(data_set)
+    sampler = WindowBatchSampler(len(windows), batch_size, shuffle=shuffle, drop_last=drop_last)
+    return DataLoader(windows, batch_size=None, sampler=sampler, num_workers=num_workers)
@@ -0,0 +1,154 @@
+import os
+import stat
+import time
+import socket
+import numpy as np
+import pandas as pd
+from torch.utils.data import IterableDataset
+
+
+def follow_file(path, poll=0.5, follow=True):
+    """
+    Yields the lines of a csv that is being appended to, like `tail -f`. A named
+    pipe is read until the writer closes it.
+    """
+    is_pipe = stat.S_ISFIFO(os.stat(path).st_mode)
+    with open(path, 'r') as f:
+        pending = ''
+        while True:
+            line = f.readline()
+            if not line:
+                if is_pipe or not follow:
+                    break
+                time.sleep(poll)
+                continue
+            pending += line
+            # a writer may flush half a line, wait for the rest of it
+            if not pending.endswith('\n'):
+                continue
+            yield pending
+            pending = ''
+
+
+def socket_lines(path):
+    """Yields the lines sent over a unix stream socket until the peer closes it."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    with sock, sock.makefile('r') as f:
+        for line in f:
+            yield line
+
+
+def open_source(source, poll=0.5, follow=True):
+    """`unix:<path>` reads from a unix socket, anything else is a csv file or a named pipe."""
+    if source.startswith('unix:'):
+        return socket_lines(source[len('unix:'):])
+    return follow_file(source, poll=poll, follow=follow)
+
+
+class RollingScaler():
+    """
+    Mean/std over the last `window` rows, updated in O(features) per row with a
+    windowed Welford update. The rows themselves are kept in a ring of size
+    `window`, so memory is bounded.
+    """
+    def __init__(self, window, n_features):
+        self.window = window
+        self.ring = np.zeros((window, n_features))
+        self.n = 0
+        self.pos = 0
+        self.mean = np.zeros(n_features)
+        self.m2 = np.zeros(n_features)
+
+    def update(self, row):
+        if self.n < self.window:
+            self.n += 1
+            delta = row - self.mean
+            self.mean += delta / self.n
+            self.m2 += delta * (row - self.mean)
+        else:
+            old = self.ring[self.pos]
+            old_mean = self.mean.copy()
+            self.mean += (row - old) / self.n
+            self.m2 += (row - old) * (row - self.mean + old - old_mean)
+            np.maximum(self.m2, 0, out=self.m2)
+        self.ring[self.pos] = row
+        self.pos = (self.pos + 1) % self.window
+
+    @property
+    def std(self):
+        std = np.sqrt(self.m2 / max(self.n, 1))
+        return np.where(std > 0, std, 1.)
+
+    def transform(self, data):
+        return (data - self.mean) / self.std
+
+
+class BarStream(IterableDataset):
+    """
+    Online counterpart of FinancialDataset for live feeds.
+
+    Bars are consumed one at a time from `source` (see `open_source`); the csv
+    header is the first line. The last seq_len + pred_len bars live in a ring
+    buffer, and once it is full every new bar yields the window whose horizon
+    has just been observed, laid out exactly like FinancialDataset samples:
+    the non-target columns scaled with rolling statistics as seq_x, the raw
+    target as seq_y and [day_of_week, day_of_month, month_of_year] as marks.
+    """
+    def __init__(self, source, size, target='Close', cols=None, date_col='Date',
+                 scale=True, scale_window=256, poll=0.5, follow=True):
+        self.seq_len, self.label_len, self.pred_len = size
+        self.source = source
+        self.target = target
+        self.cols = cols
+        self.date_col = date_col
+        self.scale = scale
+        self.scale_window = scale_window
+        self.poll = poll
+        self.follow = follow
+
+    def _parse_header(self, line):
+        header = [c.strip() for c in line.strip().split(',')]
+        cols = self.cols if self.cols else [c for c in header if c not in (self.date_col, self.target)]
+        self.x_idx = np.array([header.index(c) for c in cols])
+        self.y_idx = header.index(self.target)
+        self.date_idx = header.index(self.date_col)
+        self.n_fields = len(header)
+        return len(cols)
+
+    def __iter__(self):
+        lines = open_source(self.source, poll=self.poll, follow=self.follow)
+        n_x = self._parse_header(next(lines))
+        length = self.seq_len + self.pred_len
+        # every row is written twice, so the current window is always one contiguous slice
+        x_ring = np.zeros((2 * length, n_x))
+        y_ring = np.zeros((2 * length, 1))
+        mark_ring = np.zeros((2 * length, 3), dtype=np.int64)
+        scaler = RollingScaler(self.scale_window, n_x)
+        count = 0
+
+        for line in lines:
+            fields = line.strip().split(',')
+            # blank or truncated line, e.g. the tail of a feed that was cut off
+            if len(fields) < self.n_fields:
+                continue
+            date = pd.Timestamp(fields[self.date_idx])
+            row = np.array([float(fields[i]) for i in self.x_idx])
+            if self.scale:
+                scaler.update(row)
+                row = scaler.transform(row)
+
+            pos = count % length
+            for p in (pos, pos + length):
+                x_ring[p] = row
+                y_ring[p] = float(fields[self.y_idx])
+                mark_ring[p] = (date.dayofweek, date.day, date.month)
+            count += 1
+            if count < length:
+                continue
+
+            start = count % length
+            s_end = start + self.seq_len
+            r_begin = s_end - self.label_len
+            yield (x_ring[start:s_end].copy(), y_ring[r_begin:start + length].copy(),
+                   mark_ring[start:s_end].copy(), mark_ring[r_begin:start + length].copy())
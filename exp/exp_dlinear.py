@@ -10,7 +10,8 @@ import math
 import numpy as np
 from tqdm import tqdm
 from utils.tools import EarlyStopping, adjust_learning_rate
-from utils.metrics import metric, cumavg
+from utils.metrics import StreamingMetrics
+from utils.results import PredictionSink
 import pdb
 import numpy as np
 from einops import rearrange
@@ -273,28 +274,20 @@ class Exp_TS2VecSupervised(Exp_Basic):
             for p in self.model.parameters():
                 p.requires_grad = False
         
-        preds = []
-        trues = []
+        sink = PredictionSink('./results/' + setting + '/', len(test_data), self.args.sink_chunk)
         start = time.time()
-        maes,mses,rmses,mapes,mspes = [],[],[],[],[]
+        metrics = StreamingMetrics(self.args.metrics_sync, test_data if self.args.inverse_metrics else None, self.args.c_out)
 
         #for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(test_loader): batch_y is the predicted label
         for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(tqdm(test_loader)):
             pred, true = self._process_one_batch(
                 test_data, batch_x, batch_y, batch_x_mark, batch_y_mark, mode='test')
-            preds.append(pred.detach().cpu())
-            trues.append(true.detach().cpu())
-            mae, mse, rmse, mape, mspe = metric(pred.detach().cpu().numpy(), true.detach().cpu().numpy())
-            maes.append(mae)
-            mses.append(mse)
-            rmses.append(rmse)
-            mapes.append(mape)
-            mspes.append(mspe)
-
-        preds = torch.cat(preds, dim=0).numpy()
-        trues = torch.cat(trues, dim=0).numpy()
+            sink.append(pred, true)
+            metrics.update(pred, true)
+
+        preds, trues = sink.close(method=self.args.method, setting=setting)
         print('test shape:', preds.shape, trues.shape)
-        MAE, MSE, RMSE, MAPE, MSPE = cumavg(maes), cumavg(mses), cumavg(rmses), cumavg(mapes), cumavg(mspes)
+        MAE, MSE, RMSE, MAPE, MSPE = metrics.curves()
         mae, mse, rmse, mape, mspe = MAE[-1], MSE[-1], RMSE[-1], MAPE[-1], MSPE[-1]
 
         end = time.time()
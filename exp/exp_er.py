@@ -4,8 +4,9 @@ from models.ts2vec.encoder import TSEncoder, GlobalLocalMultiscaleTSEncoder
 from models.ts2vec.losses import hierarchical_contrastive_loss
 from tqdm import tqdm
 from utils.tools import EarlyStopping, adjust_learning_rate
-from utils.metrics import metric, cumavg
-from utils.buffer import Buffer
+from utils.metrics import StreamingMetrics
+from utils.results import PredictionSink
+from utils.buffer import Buffer, PrioritizedBuffer
 import pdb
 import numpy as np
 from einops import rearrange
@@ -65,7 +66,10 @@ class Exp_TS2VecSupervised(Exp_Basic):
         self.opt_str = args.opt
         self.model = net(args, device = self.device)
  
-        self.buffer = Buffer(500, self.device)       
+        if args.replay_priority:
+            self.buffer = PrioritizedBuffer(500, self.device, alpha=args.priority_alpha, beta=args.priority_beta)
+        else:
+            self.buffer = Buffer(500, self.device)
         self.count = 0
         if args.finetune:
             inp_var = 'univar' if args.features == 'S' else 'multivar'
@@ -241,28 +245,20 @@ class Exp_TS2VecSupervised(Exp_Basic):
             for p in self.model.parameters():
                 p.requires_grad = False
         
-        preds = []
-        trues = []
+        sink = PredictionSink('./results/' + setting + '/', len(test_data), self.args.sink_chunk)
         start = time.time()
-        maes,mses,rmses,mapes,mspes = [],[],[],[],[]
+        metrics = StreamingMetrics(self.args.metrics_sync, test_data if self.args.inverse_metrics else None, self.args.c_out)
 
         #for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(test_loader):
         for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(tqdm(test_loader)):
             pred, true = self._process_one_batch(
                 test_data, batch_x, batch_y, batch_x_mark, batch_y_mark, mode='test')
-            preds.append(pred.detach().cpu())
-            trues.append(true.detach().cpu())
-            mae, mse, rmse, mape, mspe = metric(pred.detach().cpu().numpy(), true.detach().cpu().numpy())
-            maes.append(mae)
-            mses.append(mse)
-            rmses.append(rmse)
-            mapes.append(mape)
-            mspes.append(mspe)
-
-        preds = torch.cat(preds, dim=0).numpy()
-        trues = torch.cat(trues, dim=0).numpy()
+            sink.append(pred, true)
+            metrics.update(pred, true)
+
+        preds, trues = sink.close(method=self.args.method, setting=setting)
         print('test shape:', preds.shape, trues.shape)
-        MAE, MSE, RMSE, MAPE, MSPE = cumavg(maes), cumavg(mses), cumavg(rmses), cumavg(mapes), cumavg(mspes)
+        MAE, MSE, RMSE, MAPE, MSPE = metrics.curves()
         mae, mse, rmse, mape, mspe = MAE[-1], MSE[-1], RMSE[-1], MAPE[-1], MSPE[-1]
 
         end = time.time()
@@ -303,7 +299,12 @@ class Exp_TS2VecSupervised(Exp_Basic):
             if not self.buffer.is_empty():
                 buff_x, buff_y, idx = self.buffer.get_data(8)
                 out = self.model(buff_x)
-                loss += 0.2* criterion(out, buff_y)
+                if self.args.replay_priority:
+                    replay = ((out - buff_y) ** 2).mean(-1)
+                    loss += 0.2* (self.buffer.last_weights * replay).mean()
+                    self.buffer.update_priorities(self.buffer.last_indices, replay)
+                else:
+                    loss += 0.2* criterion(out, buff_y)
             loss.backward()
             self.opt.step()       
             
@@ -313,6 +314,9 @@ class Exp_TS2VecSupervised(Exp_Basic):
         batch_y = batch_y[:,-self.args.pred_len:,f_dim:].to(self.device)
         idx = self.count +  torch.arange(batch_y.size(0)).to(self.device)
         self.count += batch_y.size(0)
-        self.buffer.add_data(examples = x, labels = true, logits = idx)
+        if self.args.replay_priority:
+            self.buffer.add_data(examples = x, labels = true, logits = idx, losses = (outputs.detach() - true) ** 2)
+        else:
+            self.buffer.add_data(examples = x, labels = true, logits = idx)
         return outputs, rearrange(batch_y, 'b t d -> b (t d)')
 
@@ -1,12 +1,16 @@
-from data.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Pred
+from data.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Pred, window_loader
 from exp.exp_basic import Exp_Basic
 from models.ts2vec.fsnet import TSEncoder, GlobalLocalMultiscaleTSEncoder
+from models.ts2vec.fsnet_ import PadConvRegistry
 from models.ts2vec.losses import hierarchical_contrastive_loss
 from tqdm import tqdm
 from utils.tools import EarlyStopping, adjust_learning_rate
-from utils.metrics import metric, cumavg
+from utils.metrics import StreamingMetrics
+from utils.results import PredictionSink
 import pdb
 from utils.Adbfgs import Adbfgs
+from utils.snapshot import OnlineSnapshots
+from utils.checkpoint import CheckpointWriter
 import numpy as np
 from einops import rearrange
 from collections import OrderedDict, defaultdict
@@ -49,18 +53,19 @@ class net(nn.Module):
         
         #self.regressor = nn.Sequential(nn.Linear(320, 320), nn.ReLU(), nn.Linear(320, self.dim)).to(self.device)
         self.regressor = nn.Linear(320, self.dim).to(self.device)
+        self.registry = PadConvRegistry(self.encoder)
         
     def forward(self, x):
         rep = self.encoder(x)
         y = self.regressor(rep)
         return y
     def store_grad(self):
-        for name, layer in self.encoder.named_modules():    
-            if 'PadConv' in type(layer).__name__:
-                #print('{} - {}'.format(name, type(layer).__name__))
-                layer.store_grad()
+        self.registry.store_grad()
         
 class Exp_TS2VecSupervised(Exp_Basic):
+    # test() saves and restores its online state, see utils.snapshot.OnlineSnapshots
+    online_snapshots = True
+
     def __init__(self, args):
         self.args = args
         self.device = self._acquire_device()
@@ -130,21 +135,31 @@ class Exp_TS2VecSupervised(Exp_Basic):
             inverse=args.inverse,
             timeenc=timeenc,
             freq=freq,
-            cols=args.cols
+            cols=args.cols,
+            cache_dir=args.data_cache
         )
         print(flag, len(data_set))
-        data_loader = DataLoader(
-            data_set,
-            batch_size=batch_size,
-            shuffle=shuffle_flag,
-            num_workers=args.num_workers,
-            drop_last=drop_last)
+        if args.batched_windows:
+            data_loader = window_loader(
+                data_set,
+                batch_size=batch_size,
+                shuffle=shuffle_flag,
+                drop_last=drop_last,
+                num_workers=args.num_workers)
+        else:
+            data_loader = DataLoader(
+                data_set,
+                batch_size=batch_size,
+                shuffle=shuffle_flag,
+                num_workers=args.num_workers,
+                drop_last=drop_last)
 
         return data_set, data_loader
 
     def _select_optimizer(self):
         if self.args.use_adbfgs:
-            self.opt = Adbfgs(self.model.parameters(), lr=self.args.learning_rate)
+            self.opt = Adbfgs(self.model.parameters(), lr=self.args.learning_rate,
+                              flat=self.args.adbfgs_flat)
         else:
             self.opt = optim.AdamW(self.model.parameters(), lr=self.args.learning_rate)
         return self.opt
@@ -165,7 +180,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
         time_now = time.time()
 
         train_steps = len(train_loader)
-        early_stopping = EarlyStopping(patience=self.args.patience, verbose=True)
+        writer = CheckpointWriter() if self.args.async_checkpoint else None
+        early_stopping = EarlyStopping(patience=self.args.patience, verbose=True, writer=writer)
 
         self.opt = self._select_optimizer()
         criterion = self._select_criterion()
@@ -219,6 +235,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
 
             adjust_learning_rate(self.opt, epoch + 1, self.args)
 
+        if writer is not None:
+            writer.close()
         best_model_path = path + '/' + 'checkpoint.pth'
         self.model.load_state_dict(torch.load(best_model_path))
 
@@ -247,27 +265,24 @@ class Exp_TS2VecSupervised(Exp_Basic):
             for p in self.model.parameters():
                 p.requires_grad = False
         
-        preds = []
-        trues = []
+        sink = PredictionSink('./results/' + setting + '/', len(test_data), self.args.sink_chunk)
         start = time.time()
-        maes,mses,rmses,mapes,mspes = [],[],[],[],[]
+        metrics = StreamingMetrics(self.args.metrics_sync, test_data if self.args.inverse_metrics else None, self.args.c_out)
+        snapshots = OnlineSnapshots(self, setting, (sink, metrics))
         for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(tqdm(test_loader)):
+            if snapshots.skip(i):
+                continue
             pred, true = self._process_one_batch(
                 test_data, batch_x, batch_y, batch_x_mark, batch_y_mark, mode='test')
-            preds.append(pred.detach().cpu())
-            trues.append(true.detach().cpu())
-            mae, mse, rmse, mape, mspe = metric(pred.detach().cpu().numpy(), true.detach().cpu().numpy())
-            maes.append(mae)
-            mses.append(mse)
-            rmses.append(rmse)
-            mapes.append(mape)
-            mspes.append(mspe)
-
-        preds = torch.cat(preds, dim=0).numpy()
-        trues = torch.cat(trues, dim=0).numpy()
+            sink.append(pred, true)
+            metrics.update(pred, true)
+            snapshots.step(i)
+        snapshots.close()
+
+        preds, trues = sink.close(method=self.args.method, setting=setting)
         print('test shape:', preds.shape, trues.shape)
         
-        MAE, MSE, RMSE, MAPE, MSPE = cumavg(maes), cumavg(mses), cumavg(rmses), cumavg(mapes), cumavg(mspes)
+        MAE, MSE, RMSE, MAPE, MSPE = metrics.curves()
         mae, mse, rmse, mape, mspe = MAE[-1], MSE[-1], RMSE[-1], MAPE[-1], MSPE[-1]
 
         end = time.time()
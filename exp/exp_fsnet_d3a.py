@@ -1,10 +1,12 @@
 from data.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Pred
 from exp.exp_basic import Exp_Basic
 from models.ts2vec.fsnet import TSEncoder, GlobalLocalMultiscaleTSEncoder
+from models.ts2vec.fsnet_ import PadConvRegistry
 from models.ts2vec.losses import hierarchical_contrastive_loss
 from tqdm import tqdm
 from utils.tools import EarlyStopping, adjust_learning_rate
-from utils.metrics import metric, cumavg
+from utils.metrics import StreamingMetrics
+from utils.results import PredictionSink
 from scipy.stats import norm
 import numpy as np
 from einops import rearrange
@@ -16,6 +18,9 @@ from torch import optim
 from torch.utils.data import DataLoader
 
 from utils.buffer import Buffer
+from utils.snapshot import OnlineSnapshots
+from utils.checkpoint import CheckpointWriter
+from utils.sleep import BackgroundSleep
 
 import os
 import time
@@ -49,6 +54,7 @@ class net(nn.Module):
         
         #self.regressor = nn.Sequential(nn.Linear(320, 320), nn.ReLU(), nn.Linear(320, self.dim)).to(self.device)
         self.regressor = nn.Linear(320, self.dim).to(self.device)
+        self.registry = PadConvRegistry(self.encoder)
         
     def forward(self, x, return_feature=False):
         rep = self.encoder(x)
@@ -57,12 +63,12 @@ class net(nn.Module):
             return y, rep
         return y
     def store_grad(self):
-        for name, layer in self.encoder.named_modules():    
-            if 'PadConv' in type(layer).__name__:
-                #print('{} - {}'.format(name, type(layer).__name__))
-                layer.store_grad()
+        self.registry.store_grad()
         
 class Exp_TS2VecSupervised(Exp_Basic):
+    # test() saves and restores its online state, see utils.snapshot.OnlineSnapshots
+    online_snapshots = True
+
     def __init__(self, args):
         self.args = args
         self.device = self._acquire_device()
@@ -78,8 +84,9 @@ class Exp_TS2VecSupervised(Exp_Basic):
         buff_size = args.sleep_interval if args.sleep_interval > 0 else 100
         self.buffer = Buffer(buff_size, self.device, mode='fifo')  # FIFO
         self.count, self.buffer_adjust, self.ema_model = 0, Buffer(256, self.device, mode='fifo'), None
-        from utils.detector import STEPD
-        self.detector = STEPD(new_window_size=buff_size, alpha_w=args.alpha_w, alpha_d=args.alpha_d)
+        from utils.detector import build_detector
+        self.detector = build_detector(args.detector, new_window_size=buff_size, alpha_w=args.alpha_w, alpha_d=args.alpha_d, log_path=args.detector_log)
+        self.sleeper = BackgroundSleep(args.sleep_merge) if args.sleep_async else None
             
         if args.finetune:
             inp_var = 'univar' if args.features == 'S' else 'multivar'
@@ -174,7 +181,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
         time_now = time.time()
 
         train_steps = len(train_loader)
-        early_stopping = EarlyStopping(patience=self.args.patience, verbose=True)
+        writer = CheckpointWriter() if self.args.async_checkpoint else None
+        early_stopping = EarlyStopping(patience=self.args.patience, verbose=True, writer=writer)
 
         self.opt = self._select_optimizer()
         criterion = self._select_criterion()
@@ -228,6 +236,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
 
             adjust_learning_rate(self.opt, epoch + 1, self.args)
 
+        if writer is not None:
+            writer.close()
         best_model_path = path + '/' + 'checkpoint.pth'
         self.model.load_state_dict(torch.load(best_model_path))
         return self.model
@@ -255,27 +265,27 @@ class Exp_TS2VecSupervised(Exp_Basic):
         #     for p in self.model.parameters():
         #         p.requires_grad = False
         
-        preds = []
-        trues = []
+        sink = PredictionSink('./results/' + setting + '/', len(test_data), self.args.sink_chunk)
         start = time.time()
-        maes,mses,rmses,mapes,mspes = [],[],[],[],[]
+        metrics = StreamingMetrics(self.args.metrics_sync, test_data if self.args.inverse_metrics else None, self.args.c_out)
+        snapshots = OnlineSnapshots(self, setting, (sink, metrics))
         for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(tqdm(test_loader)):
+            if snapshots.skip(i):
+                continue
             pred, true = self._process_one_batch(
                 test_data, batch_x, batch_y, batch_x_mark, batch_y_mark, mode='test')
-            preds.append(pred.detach().cpu())
-            trues.append(true.detach().cpu())
-            mae, mse, rmse, mape, mspe = metric(pred.detach().cpu().numpy(), true.detach().cpu().numpy())
-            maes.append(mae)
-            mses.append(mse)
-            rmses.append(rmse)
-            mapes.append(mape)
-            mspes.append(mspe)
-
-        preds = torch.cat(preds, dim=0).numpy()
-        trues = torch.cat(trues, dim=0).numpy()
+            sink.append(pred, true)
+            metrics.update(pred, true)
+            snapshots.step(i)
+        snapshots.close()
+        if self.sleeper is not None:
+            self.sleeper.close(self.model)
+        self.detector.close()
+
+        preds, trues = sink.close(method=self.args.method, setting=setting)
         print('test shape:', preds.shape, trues.shape)
         
-        MAE, MSE, RMSE, MAPE, MSPE = cumavg(maes), cumavg(mses), cumavg(rmses), cumavg(mapes), cumavg(mspes)
+        MAE, MSE, RMSE, MAPE, MSPE = metrics.curves()
         mae, mse, rmse, mape, mspe = MAE[-1], MSE[-1], RMSE[-1], MAPE[-1], MSPE[-1]
 
         end = time.time()
@@ -306,6 +316,27 @@ class Exp_TS2VecSupervised(Exp_Basic):
         return ema_model
 
     def sleep_stage(self,):
+        if self.sleeper is not None:
+            self._sleep_async()
+            return
+        self._sleep_train(self.model, self.opt, self.buffer, self.buffer_adjust)
+        self.buffer_adjust = self.buffer
+        self.buffer = Buffer(self.sleep_interval, self.device)  
+
+    def _sleep_async(self):
+        """sleep_stage on a copy of the model in the background (--sleep_async), merged back by _ol_one_batch."""
+        if self.sleeper.busy():
+            self.sleeper.stats['skipped'] += 1
+            return
+        # the worker owns the full buffer, the foreground starts filling a new one
+        buffer, buffer_adjust = self.buffer, self.buffer_adjust
+        self.sleeper.start(self.model, self.opt,
+                           lambda model, opt, generator: self._sleep_train(model, opt, buffer, buffer_adjust, generator))
+        self.buffer_adjust = self.buffer
+        self.buffer = Buffer(self.sleep_interval, self.device)
+
+    def _sleep_train(self, model, opt, buffer, buffer_adjust, generator=None):
+        """Replay training of a sleep stage on `buffer`, with `buffer_adjust` for the offline adjustment."""
         criterion = self._select_criterion()
         
         batch_size = min(self.args.batch_size, self.args.sleep_interval)
@@ -313,16 +344,16 @@ class Exp_TS2VecSupervised(Exp_Basic):
         for e in range(self.args.sleep_epochs):
             losses, losses_cons = [], []
             for _ in range(steps):
-                buff_x, buff_y, logits = self.buffer.get_data(batch_size)
+                buff_x, buff_y, logits = buffer.get_data(batch_size, generator=generator)
                 
-                out = self.model(buff_x.detach())
+                out = model(buff_x.detach())
                 
-                if self.args.offline_adjust != 0 and not self.buffer_adjust.is_empty():
-                    buff_x_prev, buff_y_prev, logits_prev = self.buffer_adjust.get_data(batch_size)
-                    x_edit, y_edit = self.get_adjust_data(buff_x, buff_y, buff_x_prev, buff_y_prev)
+                if self.args.offline_adjust != 0 and not buffer_adjust.is_empty():
+                    buff_x_prev, buff_y_prev, logits_prev = buffer_adjust.get_data(batch_size, generator=generator)
+                    x_edit, y_edit = self.get_adjust_data(buff_x, buff_y, buff_x_prev, buff_y_prev, generator)
                     y_edit = rearrange(y_edit, 'b t d -> b (t d)').float()
                     # y_edit = self.get_adjust_data(torch.cat([true, buff_y], dim=0), is_label=True)
-                    logits = self.model(x_edit.detach())
+                    logits = model(x_edit.detach())
                     loss_adjust = criterion(logits, y_edit)
                     del logits, x_edit, buff_x_prev, buff_y_prev, y_edit
                 else:
@@ -338,16 +369,13 @@ class Exp_TS2VecSupervised(Exp_Basic):
                 
                 # out = rearrange(out, 'b t d -> b (t d)')
                 loss.backward()
-                self.opt.step() 
-                self.model.store_grad()
-                self.opt.zero_grad()
+                opt.step() 
+                model.store_grad()
+                opt.zero_grad()
 
             print(f'Sleep stage: epoch {e} loss {np.mean(losses)} loss_consistence {np.mean(losses_cons)}')
-
-        self.buffer_adjust = self.buffer
-        self.buffer = Buffer(self.sleep_interval, self.device)  
     
-    def get_adjust_data(self, x, y, buff_x, buff_y):
+    def get_adjust_data(self, x, y, buff_x, buff_y, generator=None):
         n1, n2 = x.shape[0], buff_x.shape[0]
         l, h = x.shape[1], y.shape[1]
         x_data, x_date = x[:,:,:self.args.enc_in], x[:,:,self.args.enc_in:]
@@ -364,7 +392,7 @@ class Exp_TS2VecSupervised(Exp_Basic):
         mean_x = mean_x.repeat(n2,1,1)
         stdev_x = stdev_x.repeat(n2,1,1)
         
-        U = torch.normal(0, stdev_x)
+        U = torch.normal(0, stdev_x, generator=generator)
         buff_x_data = buff_x_data + self.args.var_weight * U
         
         x_edit = torch.cat([buff_x_data[:,:l,:], buff_x_date], dim=-1)
@@ -400,6 +428,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
         plt.close()
     
     def _ol_one_batch(self,dataset_object, batch_x, batch_y, batch_x_mark, batch_y_mark):
+        if self.sleeper is not None:
+            self.sleeper.poll(self.model)
         true = rearrange(batch_y, 'b t d -> b (t d)').float().to(self.device)
         criterion = self._select_criterion()
         
@@ -1,10 +1,12 @@
 from data.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Pred
 from exp.exp_basic import Exp_Basic
 from models.ts2vec.fsnet import TSEncoder, GlobalLocalMultiscaleTSEncoder
+from models.ts2vec.fsnet_ import PadConvRegistry
 from models.ts2vec.losses import hierarchical_contrastive_loss
 from tqdm import tqdm
 from utils.tools import EarlyStopping, adjust_learning_rate
-from utils.metrics import metric, cumavg
+from utils.metrics import StreamingMetrics
+from utils.results import PredictionSink
 import pdb
 import numpy as np
 from einops import rearrange
@@ -14,7 +16,11 @@ import torch
 import torch.nn as nn
 from torch import optim
 from torch.utils.data import DataLoader
-from utils.buffer import Buffer
+from utils.buffer import Buffer, PrioritizedBuffer
+from utils.snapshot import OnlineSnapshots
+from utils.checkpoint import CheckpointWriter
+from utils.sleep import BackgroundSleep
+from utils.profiler import StepProfiler
 
 from sklearn.linear_model import Ridge
 from sklearn.model_selection import GridSearchCV, train_test_split
@@ -46,6 +52,8 @@ class net(nn.Module):
                              depth=10) 
         self.encoder_time = TS2VecEncoderWrapper(encoder, mask='all_true').to(self.device)
         self.regressor_time = nn.Linear(320, args.pred_len).to(self.device)
+        # forecasts every input channel, under MS only the last c_out (the target) are kept
+        self.c_out = args.c_out
         
         encoder = TSEncoder(input_dims=args.enc_in + 7,
                              output_dims=320,  # standard ts2vec backbone value
@@ -56,10 +64,13 @@ class net(nn.Module):
         self.dim = args.c_out * args.pred_len
         
         self.regressor = nn.Linear(320, self.dim).to(self.device)
+        self.registry = PadConvRegistry(self.encoder, self.encoder_time)
+        # the exp's StepProfiler during the online phase
+        self.profiler = StepProfiler()
 
     def forward_individual(self, x, x_mark):
         rep = self.encoder_time.encoder.forward_time(x)
-        y = self.regressor_time(rep).transpose(1, 2)
+        y = self.regressor_time(rep).transpose(1, 2)[..., -self.c_out:]
         y0 = rearrange(y, 'b t d -> b (t d)')
         
         
@@ -70,27 +81,25 @@ class net(nn.Module):
         return y0, y2
     
     def forward_weight(self, x, x_mark, g0, g2):
-        rep = self.encoder_time.encoder.forward_time(x)
-        y = self.regressor_time(rep).transpose(1, 2)
-        y0 = rearrange(y, 'b t d -> b (t d)')
+        with self.profiler.phase('encoder_time'):
+            rep = self.encoder_time.encoder.forward_time(x)
+            y = self.regressor_time(rep).transpose(1, 2)[..., -self.c_out:]
+            y0 = rearrange(y, 'b t d -> b (t d)')
         
-        x = torch.cat([x, x_mark], dim=-1)
-        rep2 = self.encoder(x)[:, -1]
-        y2 = self.regressor(rep2)
+        with self.profiler.phase('encoder'):
+            x = torch.cat([x, x_mark], dim=-1)
+            rep2 = self.encoder(x)[:, -1]
+            y2 = self.regressor(rep2)
     
         return y0 * g0 + y2 * g2, y0, y2
         
     def store_grad(self):
-        for name, layer in self.encoder.named_modules():    
-            if 'PadConv' in type(layer).__name__:
-                #print('{} - {}'.format(name, type(layer).__name__))
-                layer.store_grad()
-        for name, layer in self.encoder_time.named_modules():    
-            if 'PadConv' in type(layer).__name__:
-                #print('{} - {}'.format(name, type(layer).__name__))
-                layer.store_grad()
+        self.registry.store_grad()
         
 class Exp_TS2VecSupervised(Exp_Basic):
+    # test() saves and restores its online state, see utils.snapshot.OnlineSnapshots
+    online_snapshots = True
+
     def __init__(self, args):
         self.args = args
         self.device = self._acquire_device()
@@ -104,10 +113,12 @@ class Exp_TS2VecSupervised(Exp_Basic):
         self.sleep_kl_pre = args.sleep_kl_pre
         
         buff_size = args.sleep_interval if args.sleep_interval > 0 else 100
-        self.buffer = Buffer(buff_size, self.device, mode='fifo')  # FIFO
+        self.buffer = self._replay_buffer(buff_size)  # FIFO
         self.count, self.buffer_adjust, self.ema_model = 0, Buffer(256, self.device, mode='fifo'), None
-        from utils.detector import STEPD
-        self.detector = STEPD(new_window_size=buff_size, alpha_w=args.alpha_w, alpha_d=args.alpha_d)
+        from utils.detector import build_detector
+        self.detector = build_detector(args.detector, new_window_size=buff_size, alpha_w=args.alpha_w, alpha_d=args.alpha_d, log_path=args.detector_log)
+        self.sleeper = BackgroundSleep(args.sleep_merge) if args.sleep_async else None
+        self.profiler = StepProfiler.from_args(args, self.device)
          
         if args.finetune:
             inp_var = 'univar' if args.features == 'S' else 'multivar'
@@ -201,7 +212,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
         time_now = time.time()
 
         train_steps = len(train_loader)
-        early_stopping = EarlyStopping(patience=self.args.patience, verbose=True)
+        writer = CheckpointWriter() if self.args.async_checkpoint else None
+        early_stopping = EarlyStopping(patience=self.args.patience, verbose=True, writer=writer)
 
         self.opt = self._select_optimizer()
         criterion = self._select_criterion()
@@ -255,6 +267,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
 
             adjust_learning_rate(self.opt, epoch + 1, self.args)
 
+        if writer is not None:
+            writer.close()
         best_model_path = path + '/' + 'checkpoint.pth'
         self.model.load_state_dict(torch.load(best_model_path))
 
@@ -285,27 +299,30 @@ class Exp_TS2VecSupervised(Exp_Basic):
             for p in self.model.parameters():
                 p.requires_grad = False
 
-        preds = []
-        trues = []
+        sink = PredictionSink('./results/' + setting + '/', len(test_data), self.args.sink_chunk)
         start = time.time()
-        maes,mses,rmses,mapes,mspes = [],[],[],[],[]
+        metrics = StreamingMetrics(self.args.metrics_sync, test_data if self.args.inverse_metrics else None, self.args.c_out)
+        snapshots = OnlineSnapshots(self, setting, (sink, metrics))
+        self.model.profiler = self.profiler
         for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(tqdm(test_loader)):
-            pred, true = self._process_one_batch(
-                test_data, batch_x, batch_y, batch_x_mark, batch_y_mark, mode='test')
-            preds.append(pred.detach().cpu())
-            trues.append(true.detach().cpu())
-            mae, mse, rmse, mape, mspe = metric(pred.detach().cpu().numpy(), true.detach().cpu().numpy())
-            maes.append(mae)
-            mses.append(mse)
-            rmses.append(rmse)
-            mapes.append(mape)
-            mspes.append(mspe)
-
-        preds = torch.cat(preds, dim=0).numpy()
-        trues = torch.cat(trues, dim=0).numpy()
+            if snapshots.skip(i):
+                continue
+            with self.profiler.step():
+                pred, true = self._process_one_batch(
+                    test_data, batch_x, batch_y, batch_x_mark, batch_y_mark, mode='test')
+            sink.append(pred, true)
+            metrics.update(pred, true)
+            snapshots.step(i)
+        snapshots.close()
+        if self.sleeper is not None:
+            self.sleeper.close(self.model)
+        self.detector.close()
+        self.profiler.report('./results/' + setting + '/profile.json')
+
+        preds, trues = sink.close(method=self.args.method, setting=setting)
         print('test shape:', preds.shape, trues.shape)
         
-        MAE, MSE, RMSE, MAPE, MSPE = cumavg(maes), cumavg(mses), cumavg(rmses), cumavg(mapes), cumavg(mspes)
+        MAE, MSE, RMSE, MAPE, MSPE = metrics.curves()
         mae, mse, rmse, mape, mspe = MAE[-1], MSE[-1], RMSE[-1], MAPE[-1], MSPE[-1]
 
         end = time.time()
@@ -328,24 +345,56 @@ class Exp_TS2VecSupervised(Exp_Basic):
         batch_y = batch_y[:,-self.args.pred_len:,f_dim:].to(self.device)
         return [y0, y1], rearrange(batch_y, 'b t d -> b (t d)')
     
+    def _replay_buffer(self, size):
+        if self.args.replay_priority:
+            return PrioritizedBuffer(size, self.device, mode='fifo', alpha=self.args.priority_alpha, beta=self.args.priority_beta)
+        return Buffer(size, self.device, mode='fifo')
+
     def sleep_stage(self,):
+        if self.sleeper is not None:
+            self._sleep_async()
+            return
+        self._sleep_train(self.model, self.opt, self.buffer, self.buffer_adjust)
+        self.buffer_adjust = self.buffer
+        self.buffer = self._replay_buffer(self.sleep_interval)
+        torch.cuda.empty_cache()
+
+    def _sleep_async(self):
+        """sleep_stage on a copy of the model in the background (--sleep_async), merged back by _ol_one_batch."""
+        if self.sleeper.busy():
+            self.sleeper.stats['skipped'] += 1
+            return
+        # the worker owns the full buffer, the foreground starts filling a new one
+        buffer, buffer_adjust = self.buffer, self.buffer_adjust
+        self.sleeper.start(self.model, self.opt,
+                           lambda model, opt, generator: self._sleep_train(model, opt, buffer, buffer_adjust, generator))
+        self.buffer_adjust = self.buffer
+        self.buffer = self._replay_buffer(self.sleep_interval)
+
+    def _sleep_train(self, model, opt, buffer, buffer_adjust, generator=None):
+        """Replay training of a sleep stage on `buffer`, with `buffer_adjust` for the offline adjustment."""
         criterion = self._select_criterion()
         batch_size = min(self.args.batch_size, self.args.sleep_interval)
         steps = self.sleep_interval // batch_size
         for e in range(self.args.sleep_epochs):
             losses, losses_cons = [], []
             for _ in range(steps):
-                buff_x, buff_y, logits = self.buffer.get_data(batch_size)
-                outputs, y1, y2 = self.model.forward_weight(buff_x[:,:,:self.args.enc_in], buff_x[:,:,self.args.enc_in:], 0.5, 0.5)
+                buff_x, buff_y, logits = buffer.get_data(batch_size, generator=generator)
+                outputs, y1, y2 = model.forward_weight(buff_x[:,:,:self.args.enc_in], buff_x[:,:,self.args.enc_in:], 0.5, 0.5)
                 buff_y_target = rearrange(buff_y, 'b t d -> b (t d)').float()
-                loss = criterion(y1, buff_y_target) + criterion(y2, buff_y_target)
+                if self.args.replay_priority:
+                    replay = ((y1 - buff_y_target) ** 2).mean(-1) + ((y2 - buff_y_target) ** 2).mean(-1)
+                    loss = (buffer.last_weights * replay).mean()
+                    buffer.update_priorities(buffer.last_indices, replay)
+                else:
+                    loss = criterion(y1, buff_y_target) + criterion(y2, buff_y_target)
                 losses.append(loss.item())
                 
-                if self.args.offline_adjust != 0 and not self.buffer_adjust.is_empty():
-                    buff_x_prev, buff_y_prev, logits_prev = self.buffer_adjust.get_data(batch_size)
-                    x_edit, y_edit = self.get_adjust_data(buff_x, buff_y, buff_x_prev, buff_y_prev)
+                if self.args.offline_adjust != 0 and not buffer_adjust.is_empty():
+                    buff_x_prev, buff_y_prev, logits_prev = buffer_adjust.get_data(batch_size, generator=generator)
+                    x_edit, y_edit = self.get_adjust_data(buff_x, buff_y, buff_x_prev, buff_y_prev, generator)
                     y_edit = rearrange(y_edit, 'b t d -> b (t d)').float()
-                    logits, y1, y2 = self.model.forward_weight(x_edit[:,:,:self.args.enc_in], x_edit[:,:,self.args.enc_in:], 0.5, 0.5)
+                    logits, y1, y2 = model.forward_weight(x_edit[:,:,:self.args.enc_in], x_edit[:,:,self.args.enc_in:], 0.5, 0.5)
                     loss_adjust = self.args.online_adjust_var * criterion(y1, y_edit) + criterion(y2, y_edit)
                     del logits, x_edit, buff_x_prev, buff_y_prev, y_edit, logits_prev, outputs
                 else:
@@ -356,17 +405,13 @@ class Exp_TS2VecSupervised(Exp_Basic):
                 
                 # out = rearrange(out, 'b t d -> b (t d)')
                 loss.backward()
-                self.opt.step() 
-                self.model.store_grad()
-                self.opt.zero_grad()
+                opt.step() 
+                model.store_grad()
+                opt.zero_grad()
 
             print(f'Sleep stage: epoch {e} loss {np.mean(losses)} loss_consistence {np.mean(losses_cons)}')
-
-        self.buffer_adjust = self.buffer
-        self.buffer = Buffer(self.sleep_interval, self.device)  
-        torch.cuda.empty_cache()
     
-    def get_adjust_data(self, x, y, buff_x, buff_y):
+    def get_adjust_data(self, x, y, buff_x, buff_y, generator=None):
         n1, n2 = x.shape[0], buff_x.shape[0]
         l, h = x.shape[1], y.shape[1]
         x_data, x_date = x[:,:,:self.args.enc_in], x[:,:,self.args.enc_in:]
@@ -383,7 +428,7 @@ class Exp_TS2VecSupervised(Exp_Basic):
         mean_x = mean_x.repeat(n2,1,1)
         stdev_x = stdev_x.repeat(n2,1,1)
         
-        U = torch.normal(0, stdev_x)
+        U = torch.normal(0, stdev_x, generator=generator)
         buff_x_data = buff_x_data + self.args.var_weight * U
         
         x_edit = torch.cat([buff_x_data[:,:l,:], buff_x_date], dim=-1)
@@ -391,21 +436,28 @@ class Exp_TS2VecSupervised(Exp_Basic):
         return x_edit, y_edit
     
     def _ol_one_batch(self,dataset_object, batch_x, batch_y, batch_x_mark, batch_y_mark):
-        true = rearrange(batch_y, 'b t d -> b (t d)').float().to(self.device)
+        f_dim = -1 if self.args.features=='MS' else 0
+        batch_y = batch_y[:,-self.args.pred_len:,f_dim:]
+        prof = self.profiler
+        if self.sleeper is not None:
+            with prof.phase('sleep'):
+                self.sleeper.poll(self.model)
         criterion = self._select_criterion()
-        
-        x = batch_x.float().to(self.device)
-        batch_x_mark = batch_x_mark.float().to(self.device)
-        batch_y = batch_y.float().to(self.device)
+        with prof.phase('h2d'):
+            true = rearrange(batch_y, 'b t d -> b (t d)').float().to(self.device)
+            x = batch_x.float().to(self.device)
+            batch_x_mark = batch_x_mark.float().to(self.device)
+            batch_y = batch_y.float().to(self.device)
 
         if self.args.online_adjust != 0 and not self.buffer.is_empty():
-            buff_x, buff_y, logits = self.buffer.get_data(self.args.batch_size)
-            x_edit, y_edit = self.get_adjust_data(torch.cat([x, batch_x_mark], dim=-1), batch_y, buff_x, buff_y)
-            y_edit = rearrange(y_edit, 'b t d -> b (t d)').float()
-            # y_edit = self.get_adjust_data(torch.cat([true, buff_y], dim=0), is_label=True)
-            logits, y1, y2 = self.model.forward_weight(x_edit[:,:,:self.args.enc_in], x_edit[:,:,self.args.enc_in:], 0.5, 0.5)
-            loss_adjust = self.args.online_adjust_var * criterion(y1, y_edit) + criterion(y2, y_edit)
-            del logits, x_edit, buff_x, buff_y, y1, y2
+            with prof.phase('replay'):
+                buff_x, buff_y, logits = self.buffer.get_data(self.args.batch_size)
+                x_edit, y_edit = self.get_adjust_data(torch.cat([x, batch_x_mark], dim=-1), batch_y, buff_x, buff_y)
+                y_edit = rearrange(y_edit, 'b t d -> b (t d)').float()
+                # y_edit = self.get_adjust_data(torch.cat([true, buff_y], dim=0), is_label=True)
+                logits, y1, y2 = self.model.forward_weight(x_edit[:,:,:self.args.enc_in], x_edit[:,:,self.args.enc_in:], 0.5, 0.5)
+                loss_adjust = self.args.online_adjust_var * criterion(y1, y_edit) + criterion(y2, y_edit)
+                del logits, x_edit, buff_x, buff_y, y1, y2
         else:
             loss_adjust = 0
 
@@ -415,20 +467,31 @@ class Exp_TS2VecSupervised(Exp_Basic):
         loss = l1 + l2 + self.args.online_adjust * loss_adjust
         
         if self.online != 'none':
-            loss.backward()
-            self.opt.step()    
-            self.model.store_grad()
+            with prof.phase('backward'):
+                loss.backward()
+            with prof.phase('optimizer'):
+                self.opt.step()    
+            with prof.phase('store_grad'):
+                self.model.store_grad()
             self.opt.zero_grad()
 
         f_dim = -1 if self.args.features=='MS' else 0
         batch_y = batch_y[:,-self.args.pred_len:,f_dim:].to(self.device)
         if self.sleep_interval > 1  or self.args.online_adjust > 0:
-            self.detector.add_data(loss.item(), batch_x)
+            with prof.phase('detector'):
+                self.detector.add_data(loss.item(), batch_x)
             self.count += batch_y.size(0)
-            self.buffer.add_data(examples = torch.cat([x, batch_x_mark], dim=-1), labels = batch_y, logits = outputs.data)
-            status, name = self.detector.run_test()
+            with prof.phase('buffer'):
+                if self.args.replay_priority:
+                    self.buffer.add_data(examples = torch.cat([x, batch_x_mark], dim=-1), labels = batch_y, logits = outputs.data,
+                                         losses = (y1.detach() - true) ** 2 + (y2.detach() - true) ** 2)
+                else:
+                    self.buffer.add_data(examples = torch.cat([x, batch_x_mark], dim=-1), labels = batch_y, logits = outputs.data)
+            with prof.phase('detector'):
+                status, name = self.detector.run_test()
             if (status == 1 or self.detector.cnt >= 1000) and self.sleep_interval > 1:
-                self.sleep_stage()
+                with prof.phase('sleep'):
+                    self.sleep_stage()
                 self.detector.reset()
         torch.cuda.empty_cache()
         return outputs, rearrange(batch_y, 'b t d -> b (t d)')
\ No newline at end of file
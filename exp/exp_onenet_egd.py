@@ -1,10 +1,12 @@
 from data.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Pred
 from exp.exp_basic import Exp_Basic
 from models.ts2vec.fsnet import TSEncoder, GlobalLocalMultiscaleTSEncoder
+from models.ts2vec.fsnet_ import PadConvRegistry
 from models.ts2vec.losses import hierarchical_contrastive_loss
 from tqdm import tqdm
 from utils.tools import EarlyStopping, adjust_learning_rate
-from utils.metrics import metric, cumavg
+from utils.metrics import StreamingMetrics
+from utils.results import PredictionSink
 import math
 import numpy as np
 from einops import rearrange
@@ -46,6 +48,8 @@ class net(nn.Module):
                              depth=10) 
         self.encoder_time = TS2VecEncoderWrapper(encoder, mask='all_true').to(self.device)
         self.regressor_time = nn.Linear(320, args.pred_len).to(self.device)
+        # forecasts every input channel, under MS only the last c_out (the target) are kept
+        self.c_out = args.c_out
         
         encoder = TSEncoder(input_dims=args.enc_in + 7,
                              output_dims=320,  # standard ts2vec backbone value
@@ -56,6 +60,7 @@ class net(nn.Module):
         self.dim = args.c_out * args.pred_len
         
         self.regressor = nn.Linear(320, self.dim).to(self.device)
+        self.registry = PadConvRegistry(self.encoder, self.encoder_time)
         
         self.w_gate = nn.Linear(self.dim * 2, 2, bias=False).to(self.device)
         self.softmax = nn.Softmax(dim=-1)
@@ -63,7 +68,7 @@ class net(nn.Module):
     
     def forward_individual(self, x, x_mark):
         rep = self.encoder_time.encoder.forward_time(x)
-        y = self.regressor_time(rep).transpose(1, 2)
+        y = self.regressor_time(rep).transpose(1, 2)[..., -self.c_out:]
         y1 = rearrange(y, 'b t d -> b (t d)')
         
         x = torch.cat([x, x_mark], dim=-1)
@@ -74,7 +79,7 @@ class net(nn.Module):
     
     def forward_weight(self, x, x_mark, g1, g2):
         rep = self.encoder_time.encoder.forward_time(x)
-        y = self.regressor_time(rep).transpose(1, 2)
+        y = self.regressor_time(rep).transpose(1, 2)[..., -self.c_out:]
         y1 = rearrange(y, 'b t d -> b (t d)')
         
         x = torch.cat([x, x_mark], dim=-1)
@@ -84,14 +89,7 @@ class net(nn.Module):
         return y1 * g1 + y2 * g2, y1, y2
         
     def store_grad(self):
-        for name, layer in self.encoder.named_modules():    
-            if 'PadConv' in type(layer).__name__:
-                #print('{} - {}'.format(name, type(layer).__name__))
-                layer.store_grad()
-        for name, layer in self.encoder_time.named_modules():    
-            if 'PadConv' in type(layer).__name__:
-                #print('{} - {}'.format(name, type(layer).__name__))
-                layer.store_grad()
+        self.registry.store_grad()
         
 class Exp_TS2VecSupervised(Exp_Basic):
     def __init__(self, args):
@@ -283,27 +281,19 @@ class Exp_TS2VecSupervised(Exp_Basic):
             for p in self.model.parameters():
                 p.requires_grad = False
         
-        preds = []
-        trues = []
+        sink = PredictionSink('./results/' + setting + '/', len(test_data), self.args.sink_chunk)
         start = time.time()
-        maes,mses,rmses,mapes,mspes = [],[],[],[],[]
+        metrics = StreamingMetrics(self.args.metrics_sync, test_data if self.args.inverse_metrics else None, self.args.c_out)
         for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(tqdm(test_loader)):
             pred, true = self._process_one_batch(
                 test_data, batch_x, batch_y, batch_x_mark, batch_y_mark, mode='test')
-            preds.append(pred.detach().cpu())
-            trues.append(true.detach().cpu())
-            mae, mse, rmse, mape, mspe = metric(pred.detach().cpu().numpy(), true.detach().cpu().numpy())
-            maes.append(mae)
-            mses.append(mse)
-            rmses.append(rmse)
-            mapes.append(mape)
-            mspes.append(mspe)
-
-        preds = torch.cat(preds, dim=0).numpy()
-        trues = torch.cat(trues, dim=0).numpy()
+            sink.append(pred, true)
+            metrics.update(pred, true)
+
+        preds, trues = sink.close(method=self.args.method, setting=setting)
         print('test shape:', preds.shape, trues.shape)
         
-        MAE, MSE, RMSE, MAPE, MSPE = cumavg(maes), cumavg(mses), cumavg(rmses), cumavg(mapes), cumavg(mspes)
+        MAE, MSE, RMSE, MAPE, MSPE = metrics.curves()
         mae, mse, rmse, mape, mspe = MAE[-1], MSE[-1], RMSE[-1], MAPE[-1], MSPE[-1]
 
         end = time.time()
@@ -329,6 +319,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
         return [y1, y2], rearrange(batch_y, 'b t d -> b (t d)')
     
     def _ol_one_batch(self,dataset_object, batch_x, batch_y, batch_x_mark, batch_y_mark):
+        f_dim = -1 if self.args.features=='MS' else 0
+        batch_y = batch_y[:,-self.args.pred_len:,f_dim:]
         true = rearrange(batch_y, 'b t d -> b (t d)').float().to(self.device)
         criterion = self._select_criterion()
         
@@ -1,10 +1,14 @@
-from data.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Pred, FinancialDataset
+from data.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Pred, FinancialDataset, PanelFinancialDataset, window_loader
+from data.data_stream import BarStream
 from exp.exp_basic import Exp_Basic
 from models.ts2vec.fsnet import TSEncoder, GlobalLocalMultiscaleTSEncoder
+from models.ts2vec.fsnet_ import set_calibration_cache, PadConvRegistry, SamePadConv
 from models.ts2vec.losses import hierarchical_contrastive_loss
 from tqdm import tqdm
 from utils.tools import EarlyStopping, adjust_learning_rate
-from utils.metrics import metric, cumavg
+from utils.metrics import StreamingMetrics
+from utils.results import PredictionSink
+from utils.profiler import StepProfiler
 import pdb
 import numpy as np
 from einops import rearrange
@@ -15,8 +19,20 @@ import torch.nn as nn
 from torch import optim
 from torch.utils.data import DataLoader
 from utils.buffer import Buffer
+from utils.snapshot import OnlineSnapshots
+from utils.checkpoint import CheckpointWriter
 import wandb
 import torch.nn.functional as F
+import copy
+import threading
+from contextlib import nullcontext
+from utils.delayed import DelayedFeedback
+try:
+    from torch.func import vmap, functional_call
+except ImportError:
+    # torch 1.13
+    from functorch import vmap
+    from torch.nn.utils.stateless import functional_call
 
 import os
 import time
@@ -52,6 +68,107 @@ class MLP(nn.Module):
         # x = F.sigmoid(x)
         return x
 
+class StackedLinear(nn.Module):
+    """n independent copies of a trained nn.Linear, copy i is applied to x[i]."""
+    def __init__(self, layer, n):
+        super(StackedLinear, self).__init__()
+        self.weight = nn.Parameter(layer.weight.detach().unsqueeze(0).repeat(n, 1, 1))
+        self.bias = nn.Parameter(layer.bias.detach().unsqueeze(0).repeat(n, 1))
+
+    def forward(self, x):
+        n = x.size(0)
+        out = torch.baddbmm(self.bias.unsqueeze(1), x.reshape(n, -1, x.size(-1)), self.weight.transpose(1, 2))
+        return out.view(*x.shape[:-1], -1)
+
+class StackedMLP(MLP):
+    """Per-ticker copies of a trained MLP, see StackedLinear."""
+    def __init__(self, mlp, n):
+        nn.Module.__init__(self)
+        self.input = StackedLinear(mlp.input, n)
+        self.dropout = mlp.dropout
+        self.hiddens = nn.ModuleList([StackedLinear(hidden, n) for hidden in mlp.hiddens])
+        self.output = StackedLinear(mlp.output, n)
+        self.n_outputs = mlp.n_outputs
+        self.act = mlp.act
+
+class StackedAdam():
+    """
+    The Adam / AdamW steps of a trained optimizer over per-ticker copies of its
+    parameters, stacked on a first ticker axis, each copy starting from the state
+    of its original. The step count is kept per ticker: step(mask) updates the rows,
+    moments and step count of the tickers in mask and leaves the others as they were.
+    """
+    def __init__(self, opt, params, stacked):
+        assert isinstance(opt, (optim.Adam, optim.AdamW)), 'per-ticker steps are implemented for Adam and AdamW'
+        self.decoupled = isinstance(opt, optim.AdamW)
+        group_of = {p: group for group in opt.param_groups for p in group['params']}
+        self.params, self.groups, self.state = [], [], []
+        for p, q in zip(params, stacked):
+            group = group_of[p]
+            assert not group['amsgrad'] and not group.get('maximize', False)
+            n = q.size(0)
+            state = opt.state.get(p, {})
+            step = float(state['step']) if 'step' in state else 0.
+            repeat = lambda v: v.detach().unsqueeze(0).repeat(n, *[1] * v.dim()) if v is not None else torch.zeros_like(q)
+            self.params.append(q)
+            self.groups.append(group)
+            self.state.append({'step': torch.full((n,), step, device=q.device),
+                               'exp_avg': repeat(state.get('exp_avg')),
+                               'exp_avg_sq': repeat(state.get('exp_avg_sq'))})
+
+    @torch.no_grad()
+    def step(self, mask):
+        for p, group, state in zip(self.params, self.groups, self.state):
+            if p.grad is None:
+                continue
+            lr, (beta1, beta2), eps, weight_decay = group['lr'], group['betas'], group['eps'], group['weight_decay']
+            rows = mask.view(-1, *[1] * (p.dim() - 1))
+            state['step'] += mask
+            step = state['step'].clamp(min=1).view_as(rows)
+            grad, param = p.grad, p
+            if weight_decay != 0:
+                if self.decoupled:
+                    param = param * (1 - lr * weight_decay)
+                else:
+                    grad = grad + weight_decay * param
+            exp_avg = torch.where(rows, state['exp_avg'] * beta1 + grad * (1 - beta1), state['exp_avg'])
+            exp_avg_sq = torch.where(rows, state['exp_avg_sq'] * beta2 + grad * grad * (1 - beta2), state['exp_avg_sq'])
+            denom = exp_avg_sq.sqrt() / (1 - beta2 ** step).sqrt() + eps
+            param = param - lr / (1 - beta1 ** step) * exp_avg / denom
+            p.copy_(torch.where(rows, param, p))
+            state['exp_avg'], state['exp_avg_sq'] = exp_avg, exp_avg_sq
+
+    def zero_grad(self):
+        for p in self.params:
+            p.grad = None
+
+class TickerStep(nn.Module):
+    """
+    forward_individual of one ticker's copy of net, with that ticker's FSNet conv
+    state (gradient EMAs, smoothed controller outputs and memory triggers) passed in.
+    Run through functional_call with the ticker's parameters, under vmap over the
+    tickers. Returns both forecasts, the new q_ema of every conv and the new memory
+    W of the triggered ones.
+    """
+    def __init__(self, model):
+        super(TickerStep, self).__init__()
+        self.model = model
+        self.convs = [(name, layer) for name, layer in model.named_modules() if isinstance(layer, SamePadConv)]
+
+    def forward(self, grads, q_ema, trigger, x, x_mark):
+        q_new, W_new = {}, {}
+        try:
+            for name, layer in self.convs:
+                w, b, f, q_new[name], W = layer.chunks(grads[name], q_ema.get(name), trigger.get(name, 0))
+                if name in trigger:
+                    W_new[name] = W
+                layer.calib_given = (layer.conv.weight * w, layer.bias * b, f)
+            y1, y2 = self.model.forward_individual(x, x_mark)
+        finally:
+            for _, layer in self.convs:
+                layer.calib_given = None
+        return y1, y2, q_new, W_new
+
 class TS2VecEncoderWrapper(nn.Module):
     def __init__(self, encoder, mask):
         super().__init__()
@@ -72,21 +189,30 @@ class net(nn.Module):
                              depth=depth) 
         self.encoder_time = TS2VecEncoderWrapper(encoder, mask='all_true').to(self.device)
         self.regressor_time = nn.Linear(320, args.pred_len).to(self.device)
+        # forecasts every input channel, under MS only the last c_out (the target) are kept
+        self.c_out = args.c_out
         
         encoder = TSEncoder(input_dims=args.enc_in + 7,
                              output_dims=320,  # standard ts2vec backbone value
                              hidden_dims=64, # standard ts2vec backbone value
-                             depth=depth) 
+                             depth=depth, causal=args.causal_conv) 
         self.encoder = TS2VecEncoderWrapper(encoder, mask='all_true').to(self.device)
+        # set by the online phase: consecutive windows only feed their newest bar to self.encoder
+        self.incremental = False
         
         self.dim = args.c_out * args.pred_len
         
         self.regressor = nn.Linear(320, self.dim).to(self.device)
+        if args.calib_cache:
+            set_calibration_cache(self)
+        self.registry = PadConvRegistry(self.encoder, self.encoder_time)
+        # the exp's StepProfiler during the online phase
+        self.profiler = StepProfiler()
         
     
     def forward_individual(self, x, x_mark):
         rep = self.encoder_time.encoder.forward_time(x)
-        y = self.regressor_time(rep).transpose(1, 2)
+        y = self.regressor_time(rep).transpose(1, 2)[..., -self.c_out:]
         y1 = rearrange(y, 'b t d -> b (t d)')
         
         x = torch.cat([x, x_mark], dim=-1)
@@ -96,47 +222,78 @@ class net(nn.Module):
         return y1, y2
     
     def forward_weight(self, x, x_mark, g1, g2):
-        rep = self.encoder_time.encoder.forward_time(x)
-        y = self.regressor_time(rep).transpose(1, 2)
-        y1 = rearrange(y, 'b t d -> b (t d)')
-        
-        x = torch.cat([x, x_mark], dim=-1)
-        rep2 = self.encoder(x)[:, -1]
-        y2 = self.regressor(rep2)
+        with self.profiler.phase('encoder_time'):
+            y1 = self.forward_branch(1, x, x_mark)
+        with self.profiler.phase('encoder'):
+            y2 = self.forward_branch(2, x, x_mark)
     
         return y1.detach() * g1 + y2.detach() * g2, y1, y2
-        
-    def store_grad(self):
-        for name, layer in self.encoder.named_modules():    
-            if 'PadConv' in type(layer).__name__:
-                #print('{} - {}'.format(name, type(layer).__name__))
-                layer.store_grad()
-        for name, layer in self.encoder_time.named_modules():    
-            if 'PadConv' in type(layer).__name__:
-                #print('{} - {}'.format(name, type(layer).__name__))
-                layer.store_grad()
+
+    def forward_branch(self, branch, x, x_mark):
+        # 1: encoder_time over the time axis, 2: encoder over the features and time marks
+        if branch == 1:
+            rep = self.encoder_time.encoder.forward_time(x)
+            y = self.regressor_time(rep).transpose(1, 2)[..., -self.c_out:]
+            return rearrange(y, 'b t d -> b (t d)')
+        x = torch.cat([x, x_mark], dim=-1)
+        if self.incremental:
+            return self.regressor(self.forward_incremental(x))
+        rep2 = self.encoder(x)[:, -1]
+        return self.regressor(rep2)
+
+    def forward_incremental(self, x):
+        # the window is the previous one shifted by one bar, the causal encoder only steps over the new bar
+        encoder = self.encoder.encoder
+        if encoder.feature_extractor.primed(x.size(0)):
+            return encoder.forward_step(x[:, -1:])[:, -1]
+        return encoder.prime(x, mask=self.encoder.mask)[:, -1]
+
+    def reset_incremental(self):
+        self.encoder.encoder.feature_extractor.reset()
+
+    def store_grad(self, branch=None):
+        # branch: only the encoder of that branch has gradients, see forward_branch
+        self.registry.store_grad(None if branch is None else [2 - branch])
         
 class Exp_TS2VecSupervised(Exp_Basic):
+    # test() saves and restores its online state, see utils.snapshot.OnlineSnapshots
+    online_snapshots = True
+
     def __init__(self, args):
         self.args = args
         self.device = self._acquire_device()
         self.online = args.online_learning
         assert self.online in ['none', 'full', 'regressor']
+        # the incremental encoder takes each test window as the previous one shifted by one bar,
+        # and every forward pushes that bar into its queues, so a window is encoded once
+        assert not args.incremental_encoder or args.n_inner == 1, \
+            '--incremental_encoder encodes each window once: --n_inner 1'
+        assert not args.incremental_encoder or args.stream_source or (args.test_bsz == 1 and not args.delay_fb), \
+            '--incremental_encoder needs consecutive test windows: --test_bsz 1 and no --delay_fb'
         self.n_inner = args.n_inner
         self.opt_str = args.opt
         self.individual = args.individual
         self.model = net(args, device = self.device)
+        receptive_field = self.model.encoder.encoder.feature_extractor.receptive_field
+        if args.incremental_encoder and receptive_field > args.seq_len:
+            # forward zero-pads what lies before the window, the queues would carry it on
+            raise ValueError('--incremental_encoder needs --seq_len >= {}, the receptive field of the '
+                             'feature encoder, to match encoding the window'.format(receptive_field))
         self.buffer = Buffer(10, self.device)       
         self.count = 0
         if self.individual:
             self.decision = MLP(n_inputs=args.pred_len * 3, n_outputs=1, mlp_width=32, mlp_depth=3, mlp_dropout=0.1, act=nn.Tanh()).to(self.device)
-            self.weight = torch.zeros(args.enc_in, device = self.device)
-            self.bias = torch.zeros(args.enc_in, device = self.device)
+            self.weight = torch.zeros(args.c_out, device = self.device)
+            self.bias = torch.zeros(args.c_out, device = self.device)
         else:
             self.decision = MLP(n_inputs=(args.c_out * args.pred_len) * 3, n_outputs=1, mlp_width=32, mlp_depth=3, mlp_dropout=0.1, act=nn.Tanh()).to(self.device)
             self.weight = torch.zeros(1, device = self.device)
             self.bias = torch.zeros(1, device = self.device)
         self.weight.requires_grad = True
+        self.lazy = {'steps': 0, 'skipped': 0, 'cold': 0, 'refresh_err': 0., 'refreshes': 0}
+        self.profiler = StepProfiler.from_args(args, self.device)
+        # predict-now / update-later pipeline of the online phase, see _start_delayed
+        self.delayed = None
          
         if args.finetune:
             inp_var = 'univar' if args.features == 'S' else 'multivar'
@@ -162,6 +319,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
             'Solar': Dataset_Custom,
             'custom': Dataset_Custom,
             'finance': FinancialDataset,
+            'kdd17': PanelFinancialDataset,
+            'stocknet': PanelFinancialDataset,
         }
         data_dict = defaultdict(lambda: Dataset_Custom, data_dict_)
         Data = data_dict[self.args.data]
@@ -199,15 +358,24 @@ class Exp_TS2VecSupervised(Exp_Basic):
             inverse=args.inverse,
             timeenc=timeenc,
             freq=freq,
-            cols=args.cols
+            cols=args.cols,
+            cache_dir=args.data_cache
         )
         print(flag, len(data_set))
-        data_loader = DataLoader(
-            data_set,
-            batch_size=batch_size,
-            shuffle=shuffle_flag,
-            num_workers=args.num_workers,
-            drop_last=drop_last)
+        if args.batched_windows:
+            data_loader = window_loader(
+                data_set,
+                batch_size=batch_size,
+                shuffle=shuffle_flag,
+                drop_last=drop_last,
+                num_workers=args.num_workers)
+        else:
+            data_loader = DataLoader(
+                data_set,
+                batch_size=batch_size,
+                shuffle=shuffle_flag,
+                num_workers=args.num_workers,
+                drop_last=drop_last)
 
         return data_set, data_loader
 
@@ -215,6 +383,21 @@ class Exp_TS2VecSupervised(Exp_Basic):
         self.opt = optim.AdamW(self.model.parameters(), lr=self.args.learning_rate)
         return self.opt
 
+    def _fuse_optimizers(self):
+        """
+        One optimizer over the param groups of self.opt, self.opt_bias and self.opt_w,
+        sharing their state. The Adam groups keep weight_decay=0, for which the AdamW
+        update is the Adam update.
+        """
+        groups, state = [], {}
+        for opt in (self.opt, self.opt_bias, self.opt_w):
+            groups += [dict(group) for group in opt.param_groups]
+            # opt.state is a defaultdict, so params without state yet get a dict both optimizers fill in
+            state.update({p: opt.state[p] for group in opt.param_groups for p in group['params']})
+        fused = type(self.opt)(groups)
+        fused.state.update(state)
+        return fused
+
     def _select_criterion(self):
         criterion = nn.MSELoss()
         return criterion
@@ -242,7 +425,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
         time_now = time.time()
 
         train_steps = len(train_loader)
-        early_stopping = EarlyStopping(patience=self.args.patience, verbose=True)
+        writer = CheckpointWriter() if self.args.async_checkpoint else None
+        early_stopping = EarlyStopping(patience=self.args.patience, verbose=True, writer=writer)
 
         self.opt = self._select_optimizer()
         self.opt_w = optim.Adam([self.weight], lr=self.args.learning_rate_w)
@@ -305,6 +489,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
             # adjust_learning_rate(self.opt_w, epoch + 1, self.args)
             # adjust_learning_rate(self.opt_bias, epoch + 1, self.args)
 
+        if writer is not None:
+            writer.close()
         best_model_path = path + '/' + 'checkpoint.pth'
         self.model.load_state_dict(torch.load(best_model_path))
 
@@ -324,9 +510,11 @@ class Exp_TS2VecSupervised(Exp_Basic):
         return total_loss
 
     def test(self, setting):
+        if self.args.lockstep:
+            return self.test_lockstep(setting)
         if self.individual:
-            self.weight = torch.zeros(self.args.enc_in, device = self.device)
-            self.bias = torch.zeros(self.args.enc_in, device = self.device)
+            self.weight = torch.zeros(self.args.c_out, device = self.device)
+            self.bias = torch.zeros(self.args.c_out, device = self.device)
         else:
             self.weight = torch.zeros(1, device = self.device)
             self.bias = torch.zeros(1, device = self.device)
@@ -337,6 +525,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
         test_data, test_loader = self._get_data(flag='test')
 
         self.model.eval()
+        self.model.incremental = self.args.incremental_encoder
+        self.model.reset_incremental()
         if self.online == 'regressor':
             for p in self.model.encoder.parameters():
                 p.requires_grad = False 
@@ -344,27 +534,32 @@ class Exp_TS2VecSupervised(Exp_Basic):
             for p in self.model.parameters():
                 p.requires_grad = False
         
-        preds = []
-        trues = []
+        sink = PredictionSink('./results/' + setting + '/', len(test_data), self.args.sink_chunk)
         start = time.time()
-        maes,mses,rmses,mapes,mspes = [],[],[],[],[]
+        metrics = StreamingMetrics(self.args.metrics_sync, test_data if self.args.inverse_metrics else None, self.args.c_out)
+        snapshots = OnlineSnapshots(self, setting, (sink, metrics))
+        if self.args.fused_combiner:
+            self.opt_fused = self._fuse_optimizers()
+        self._start_delayed()
+        self.model.profiler = self.profiler
         for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(tqdm(test_loader)):
-            pred, true = self._process_one_batch(
-                test_data, batch_x, batch_y, batch_x_mark, batch_y_mark, mode='test')
-            preds.append(pred.detach().cpu())
-            trues.append(true.detach().cpu())
-            mae, mse, rmse, mape, mspe = metric(pred.detach().cpu().numpy(), true.detach().cpu().numpy())
-            maes.append(mae)
-            mses.append(mse)
-            rmses.append(rmse)
-            mapes.append(mape)
-            mspes.append(mspe)
-
-        preds = torch.cat(preds, dim=0).numpy()
-        trues = torch.cat(trues, dim=0).numpy()
+            if snapshots.skip(i):
+                continue
+            with self.profiler.step():
+                pred, true = self._process_one_batch(
+                    test_data, batch_x, batch_y, batch_x_mark, batch_y_mark, mode='test')
+            sink.append(pred, true)
+            metrics.update(pred, true)
+            snapshots.step(i)
+        snapshots.close()
+        if self.delayed is not None:
+            self.delayed.close()
+        self.profiler.report('./results/' + setting + '/profile.json')
+
+        preds, trues = sink.close(method=self.args.method, setting=setting)
         print('test shape:', preds.shape, trues.shape)
         
-        MAE, MSE, RMSE, MAPE, MSPE = cumavg(maes), cumavg(mses), cumavg(rmses), cumavg(mapes), cumavg(mspes)
+        MAE, MSE, RMSE, MAPE, MSPE = metrics.curves()
         mae, mse, rmse, mape, mspe = MAE[-1], MSE[-1], RMSE[-1], MAPE[-1], MSPE[-1]
 
         end = time.time()
@@ -373,9 +568,134 @@ class Exp_TS2VecSupervised(Exp_Basic):
         print('mse:{}, mae:{}, time:{}'.format(mse, mae, exp_time))
         return [mae, mse, rmse, mape, mspe, exp_time], MAE, MSE, preds, trues
 
+    def test_lockstep(self, setting):
+        """
+        Online phase over a panel dataset with every ticker advancing in lockstep: the
+        independent runs of _ol_one_batch over each ticker, done as one batched step.
+        Every ticker has its own copy of the trained model, FSNet conv state included,
+        of the decision MLP and combination weight/bias and of their optimizer state,
+        stacked on a first ticker axis. The model runs under vmap/functional_call
+        (TickerStep) and the loss is the sum of the tickers' losses, so each copy only
+        gets its own gradient; StackedAdam keeps a step count per ticker. A ticker
+        masked out at a step (a missing day in its window) is forecast, but its copy,
+        state and step count are left as they were.
+        """
+        test_data, _ = self._get_data(flag='test')
+        assert hasattr(test_data, 'lockstep'), '--lockstep needs a panel dataset (--data kdd17 / stocknet)'
+        n = len(test_data.tickers)
+        stack = lambda v: v.detach().unsqueeze(0).repeat(n, *[1] * v.dim())
+
+        self.model.eval()
+        if self.online == 'regressor':
+            for p in self.model.encoder.parameters():
+                p.requires_grad = False
+        elif self.online == 'none':
+            for p in self.model.parameters():
+                p.requires_grad = False
+
+        self.ticker_step = TickerStep(self.model)
+        self.ticker_params = {'model.' + name: stack(p).requires_grad_(p.requires_grad) for name, p in self.model.named_parameters()}
+        self.ticker_state = {
+            'grads': {name: stack(layer.grads) for name, layer in self.ticker_step.convs},
+            'f_grads': {name: stack(layer.f_grads) for name, layer in self.ticker_step.convs},
+            'q_ema': {name: stack(layer.q_ema) for name, layer in self.ticker_step.convs if layer.q_ema is not None},
+            'trigger': {name: torch.full((n,), bool(layer.trigger), device=self.device) for name, layer in self.ticker_step.convs},
+        }
+        trainable = [(name, p) for name, p in self.model.named_parameters() if p.requires_grad]
+        self.opt = StackedAdam(self.opt, [p for _, p in trainable], [self.ticker_params['model.' + name] for name, _ in trainable])
+
+        dim = self.args.c_out if self.individual else 1
+        weight = torch.zeros(dim, device = self.device)
+        self.weight = stack(weight).requires_grad_(True)
+        self.bias = torch.zeros(n, dim, device = self.device)
+        self.opt_w = StackedAdam(optim.Adam([weight], lr=self.args.learning_rate_w), [weight], [self.weight])
+
+        self.decision_stacked = StackedMLP(self.decision, n).to(self.device)
+        self.opt_bias = StackedAdam(self.opt_bias, list(self.decision.parameters()), list(self.decision_stacked.parameters()))
+
+        sink = PredictionSink('./results/' + setting + '/', len(test_data.starts), self.args.sink_chunk)
+        start = time.time()
+        metrics = StreamingMetrics(self.args.metrics_sync, test_data if self.args.inverse_metrics else None, self.args.c_out)
+        for i, (batch_x, batch_y, batch_x_mark, batch_y_mark, mask) in enumerate(tqdm(test_data.lockstep(), total=len(test_data.starts))):
+            pred, true = self._ol_lockstep_batch(batch_x, batch_y, batch_x_mark, batch_y_mark, mask)
+            pred, true = pred.detach().cpu(), true.detach().cpu()
+            pred[~mask] = float('nan')
+            sink.append(pred[None], true[None])
+            if mask.any():
+                metrics.update(pred[mask], true[mask])
+
+        preds, trues = sink.close(method=self.args.method, setting=setting)
+        print('test shape:', preds.shape, trues.shape)
+
+        MAE, MSE, RMSE, MAPE, MSPE = metrics.curves()
+        mae, mse, rmse, mape, mspe = MAE[-1], MSE[-1], RMSE[-1], MAPE[-1], MSPE[-1]
+
+        end = time.time()
+        exp_time = end - start
+        self._lazy_report()
+        print('mse:{}, mae:{}, time:{}'.format(mse, mae, exp_time))
+        return [mae, mse, rmse, mape, mspe, exp_time], MAE, MSE, preds, trues
+
+    def stream(self, setting):
+        """
+        Online phase on a live feed (args.stream_source) instead of the test split.
+        Every bar that completes a forecast horizon triggers one `_ol_one_batch`
+        update; only running metrics are kept so memory stays bounded.
+        """
+        if self.individual:
+            self.weight = torch.zeros(self.args.c_out, device = self.device)
+            self.bias = torch.zeros(self.args.c_out, device = self.device)
+        else:
+            self.weight = torch.zeros(1, device = self.device)
+            self.bias = torch.zeros(1, device = self.device)
+        self.weight.requires_grad = True
+        self.opt_w = optim.Adam([self.weight], lr=self.args.learning_rate_w)
+        if self.args.fused_combiner:
+            self.opt_fused = self._fuse_optimizers()
+
+        stream_data = BarStream(
+            self.args.stream_source,
+            size=[self.args.seq_len, self.args.label_len, self.args.pred_len],
+            target=self.args.target,
+            cols=self.args.cols,
+            scale_window=self.args.stream_scale_window,
+            poll=self.args.stream_poll
+        )
+        stream_loader = DataLoader(stream_data, batch_size=1)
+
+        self.model.eval()
+        self.model.incremental = self.args.incremental_encoder
+        self.model.reset_incremental()
+        if self.online == 'regressor':
+            for p in self.model.encoder.parameters():
+                p.requires_grad = False
+        elif self.online == 'none':
+            for p in self.model.parameters():
+                p.requires_grad = False
+
+        start = time.time()
+        n, mae, mse = 0, 0., 0.
+        for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(stream_loader):
+            pred, true = self._ol_one_batch(
+                stream_data, batch_x, batch_y, batch_x_mark, batch_y_mark)
+            err = (pred.detach() - true).cpu()
+            n += 1
+            mae += (err.abs().mean().item() - mae) / n
+            mse += ((err ** 2).mean().item() - mse) / n
+            if (i + 1) % self.args.stream_log_every == 0:
+                print('\tbars: {0} | mse: {1:.7f} mae: {2:.7f} | {3:.1f} bars/s'.format(
+                    i + 1, mse, mae, n / (time.time() - start)))
+
+        exp_time = time.time() - start
+        self._lazy_report()
+        print('stream mse:{}, mae:{}, bars:{}, time:{}'.format(mse, mae, n, exp_time))
+        return [mae, mse, exp_time]
+
     def _process_one_batch(self, dataset_object, batch_x, batch_y, batch_x_mark, batch_y_mark, mode='train'):
         # print(self.weight[0], self.bias[0])
         if mode =='test' and self.online != 'none':
+            if self.delayed is not None:
+                return self._ol_delayed_batch(batch_x, batch_y, batch_x_mark, batch_y_mark)
             return self._ol_one_batch(dataset_object, batch_x, batch_y, batch_x_mark, batch_y_mark)
 
         x = batch_x.float().to(self.device) #torch.cat([batch_x.float(), batch_x_mark.float()], dim=-1).to(self.device)
@@ -391,7 +711,16 @@ class Exp_TS2VecSupervised(Exp_Basic):
             loss1 = rearrange(loss1, 'b t d -> b (t d)')
         else:
             loss1 = F.sigmoid(self.weight)  
-        outputs, y1, y2 = self.model.forward_weight(x, batch_x_mark, loss1, 1 - loss1)
+        if mode == 'vali':
+            # only the combination weight and the decision MLP learn during validation
+            with torch.inference_mode():
+                y1 = self.model.forward_branch(1, x, batch_x_mark)
+                y2 = self.model.forward_branch(2, x, batch_x_mark)
+            # inference tensors can not be saved for the weight's backward
+            y1, y2 = y1.clone(), y2.clone()
+            outputs = y1 * loss1 + y2 * (1 - loss1)
+        else:
+            outputs, y1, y2 = self.model.forward_weight(x, batch_x_mark, loss1, 1 - loss1)
         f_dim = -1 if self.args.features=='MS' else 0
         batch_y = batch_y[:,-self.args.pred_len:,f_dim:].to(self.device)
         
@@ -442,13 +771,170 @@ class Exp_TS2VecSupervised(Exp_Basic):
     
     
     def _ol_one_batch(self,dataset_object, batch_x, batch_y, batch_x_mark, batch_y_mark, return_loss=False):
-        b, t, d = batch_y.shape
+        f_dim = -1 if self.args.features=='MS' else 0
+        batch_y = batch_y[:,-self.args.pred_len:,f_dim:]
+        hot = None
+        if self.args.lazy_threshold > 0:
+            self.lazy['steps'] += 1
+            hot = self._hot_branch()
+            if hot is not None and self.lazy['cold'] < self.args.lazy_refresh:
+                self.lazy['cold'] += 1
+                self.lazy['skipped'] += 1
+                return self._ol_lazy_batch(hot, batch_x, batch_y, batch_x_mark, batch_y_mark)
+            self.lazy['cold'] = 0
+        if self.args.fused_combiner:
+            outputs, true = self._ol_fused_batch(batch_x, batch_y, batch_x_mark, batch_y_mark)
+        else:
+            outputs, true = self._ol_full_batch(batch_x, batch_y, batch_x_mark, batch_y_mark)
+        if hot is not None:
+            # refresh step: how far the hot branch alone is from the combined forecast
+            self.lazy['refreshes'] += 1
+            self.lazy['refresh_err'] += (self.last_branches[hot - 1] - outputs.detach()).abs().mean().item()
+        return outputs, true
+
+    def _hot_branch(self):
+        """1 or 2 when the gate puts at least args.lazy_threshold on that branch for every channel, else None."""
+        with torch.no_grad():
+            g1 = F.sigmoid(self.weight + self.bias)
+            if g1.min().item() >= self.args.lazy_threshold:
+                return 1
+            if g1.max().item() <= 1 - self.args.lazy_threshold:
+                return 2
+        return None
+
+    def _lazy_report(self):
+        if self.args.lazy_threshold <= 0 or self.lazy['steps'] == 0:
+            return
+        print('lazy branches: skipped {} of {} steps ({:.1%}), hot branch vs combined mae on {} refreshes: {:.6f}'.format(
+            self.lazy['skipped'], self.lazy['steps'], self.lazy['skipped'] / self.lazy['steps'],
+            self.lazy['refreshes'], self.lazy['refresh_err'] / max(self.lazy['refreshes'], 1)))
+
+    def _start_delayed(self):
+        """
+        With args.delayed_update the online phase forecasts every window at once and
+        trains on it pred_len windows later, when its horizon has been observed. With
+        args.update_thread the updates run on a background thread on a shadow copy of
+        the model, combiner and optimizers, which is published to the serving model
+        after every update under self.swap_lock.
+        """
+        self.delayed = None
+        if not self.args.delayed_update:
+            return
+        if self.args.update_thread:
+            self.swap_lock = threading.Lock()
+            shadow = self._shadow()
+            update = lambda window: self._ol_shadow_update(shadow, window)
+        else:
+            self.swap_lock = nullcontext()
+            update = self._ol_delayed_update
+        self.delayed = DelayedFeedback(self._ol_predict, update, delay=self.args.pred_len,
+                                       background=self.args.update_thread, max_backlog=self.args.update_backlog)
+
+    def _ol_delayed_batch(self, batch_x, batch_y, batch_x_mark, batch_y_mark):
+        pred = self.delayed.step((batch_x, batch_y, batch_x_mark, batch_y_mark))
+        f_dim = -1 if self.args.features=='MS' else 0
+        batch_y = batch_y[:,-self.args.pred_len:,f_dim:].float().to(self.device)
+        return pred, rearrange(batch_y, 'b t d -> b (t d)')
+
+    def _ol_predict(self, window):
+        """The forecast of _ol_one_batch for a window, without its update."""
+        batch_x, _, batch_x_mark, _ = window
+        x = batch_x.float().to(self.device)
+        batch_x_mark = batch_x_mark.float().to(self.device)
+        b, t = x.size(0), self.args.pred_len
+        with self.swap_lock, torch.no_grad():
+            hot = self._hot_branch() if self.args.lazy_threshold > 0 else None
+            if hot is not None:
+                return self.model.forward_branch(hot, x, batch_x_mark)
+            if self.individual:
+                d = self.weight.size(0)
+                weight = self.weight.view(1, 1, -1).repeat(b, t, 1)
+                bias = self.bias.view(-1, 1, d)
+                loss1 = F.sigmoid(weight + bias.repeat(1, t, 1)).view(b, t, d)
+                loss1 = rearrange(loss1, 'b t d -> b (t d)')
+            else:
+                loss1 = F.sigmoid(self.weight + self.bias)
+            return self.model.forward_weight(x, batch_x_mark, loss1, 1-loss1)[0]
+
+    def _ol_delayed_update(self, window):
+        # the window is pred_len bars old, the incremental encoder queues belong to the newest one
+        incremental, self.model.incremental = self.model.incremental, False
+        try:
+            self._ol_one_batch(None, *window)
+        finally:
+            self.model.incremental = incremental
+
+    def _shadow(self):
+        """Copy of the exp with its own model, combiner and optimizers, for the update thread."""
+        names = [name for name in ('model', 'decision', 'weight', 'bias', 'opt', 'opt_bias', 'opt_w', 'opt_fused')
+                 if getattr(self, name, None) is not None]
+        # one deepcopy, so the optimizers of the copy hold the copied parameters
+        copies = copy.deepcopy({name: getattr(self, name) for name in names})
+        shadow = copy.copy(self)
+        for name, value in copies.items():
+            setattr(shadow, name, value)
+        shadow.model.incremental = False
+        shadow.delayed = None
+        # the update thread runs outside the profiled online steps
+        shadow.profiler = StepProfiler()
+        return shadow
+
+    def _ol_shadow_update(self, shadow, window):
+        # the encoders mask their input in place, the serving thread must not bump the versions autograd saved
+        shadow._ol_one_batch(None, *[t.clone() for t in window])
+        shadow_buffers = dict(shadow.model.named_buffers())
+        with self.swap_lock, torch.no_grad():
+            self.model.load_state_dict(shadow.model.state_dict())
+            # the fsnet gradient EMAs drive the calibration; q_ema and the memory trigger follow each model's own forwards
+            for name, buf in self.model.named_buffers():
+                if name.rsplit('.', 1)[-1] in ('grads', 'f_grads'):
+                    buf.copy_(shadow_buffers[name])
+            self.decision.load_state_dict(shadow.decision.state_dict())
+            self.weight.copy_(shadow.weight)
+            self.bias = shadow.bias.detach().clone()
+
+    def _ol_lazy_batch(self, hot, batch_x, batch_y, batch_x_mark, batch_y_mark):
+        """
+        Online step while the gate is saturated on branch `hot`: the cold branch is neither
+        run nor trained, the forecast is the hot branch alone, and the weight and decision
+        MLP wait for the next full step (every args.lazy_refresh lazy steps).
+        """
         true = rearrange(batch_y, 'b t d -> b (t d)').float().to(self.device)
         criterion = self._select_criterion()
-        
+        opt = self.opt_fused if self.args.fused_combiner else self.opt
+
         x = batch_x.float().to(self.device)
         batch_x_mark = batch_x_mark.float().to(self.device)
         batch_y = batch_y.float().to(self.device)
+        if hot == 1 and self.model.incremental:
+            # the skipped bars never reach the encoder queues, start over on the next full step
+            self.model.reset_incremental()
+        for _ in range(self.n_inner):
+            # the cold branch must not be stepped with stale or zero grads
+            opt.zero_grad(set_to_none=True)
+            y = self.model.forward_branch(hot, x, batch_x_mark)
+            loss = criterion(y, true)
+            loss.backward()
+            opt.step()
+            self.model.store_grad(branch=hot)
+            opt.zero_grad(set_to_none=True)
+
+        f_dim = -1 if self.args.features=='MS' else 0
+        batch_y = batch_y[:,-self.args.pred_len:,f_dim:].to(self.device)
+        idx = self.count +  torch.arange(batch_y.size(0)).to(self.device)
+        self.count += batch_y.size(0)
+        self.buffer.add_data(examples = x, labels = true, logits = idx, task_labels=batch_x_mark)
+        return y.detach(), rearrange(batch_y, 'b t d -> b (t d)')
+
+    def _ol_full_batch(self, batch_x, batch_y, batch_x_mark, batch_y_mark):
+        b, t, d = batch_y.shape
+        criterion = self._select_criterion()
+        prof = self.profiler
+        with prof.phase('h2d'):
+            true = rearrange(batch_y, 'b t d -> b (t d)').float().to(self.device)
+            x = batch_x.float().to(self.device)
+            batch_x_mark = batch_x_mark.float().to(self.device)
+            batch_y = batch_y.float().to(self.device)
         for _ in range(self.n_inner):
             
             if self.individual:
@@ -461,28 +947,189 @@ class Exp_TS2VecSupervised(Exp_Basic):
                 loss1 = F.sigmoid(self.weight + self.bias)
                 
             outputs, y1, y2 = self.model.forward_weight(x, batch_x_mark, loss1, 1-loss1)
+            self.last_branches = (y1.detach(), y2.detach())
 
             l1, l2 = criterion(y1, true), criterion(y2, true)
             loss = l1 + l2
-            loss.backward()
-            self.opt.step()    
-            self.model.store_grad()
+            with prof.phase('backward'):
+                loss.backward()
+            with prof.phase('optimizer'):
+                self.opt.step()    
+            with prof.phase('store_grad'):
+                self.model.store_grad()
             self.opt.zero_grad()
             
+            with prof.phase('decision'):
+                if self.individual:
+                    y1_w, y2_w = y1.view(b, t, d).detach(), y2.view(b, t, d).detach()
+                    true_w = batch_y.view(b, t, d).detach()
+                    loss1 = F.sigmoid(self.weight).view(1, 1, -1)
+                    loss1 = loss1.repeat(b, t, 1)
+                    inputs_decision = torch.cat([loss1*y1_w, (1-loss1)*y2_w, true_w], dim=1)
+                    self.bias = self.decision(inputs_decision.permute(0,2,1))
+                    weight = self.weight.view(1, 1, -1)
+                    weight = weight.repeat(b, t, 1)
+                    bias = self.bias.view(b, 1, -1)
+                    loss1 = F.sigmoid(weight + bias.repeat(1, t, 1))
+                    loss1 = rearrange(loss1, 'b t d -> b (t d)')
+                    loss2 = 1 - loss1
+                
+                    y1_w = rearrange(y1_w, 'b t d -> b (t d)')
+                    y2_w = rearrange(y2_w, 'b t d -> b (t d)')
+                    true_w = rearrange(true_w, 'b t d -> b (t d)')
+                else:
+                    y1_w, y2_w = y1.view(b, t * d).detach(), y2.view(b, t * d).detach()
+                    true_w = batch_y.view(b, t * d).detach()
+                    loss1 = F.sigmoid(self.weight)
+                    inputs_decision = torch.cat([loss1*y1_w, (1-loss1)*y2_w, true_w], dim=1)
+                    self.bias = self.decision(inputs_decision)
+                    loss1 = F.sigmoid(self.weight + self.bias)
+                    loss2 = 1 - loss1
+            
+                outputs_bias = loss1 * y1_w + loss2 * y2_w
+                loss_bias = criterion(outputs_bias, true_w)
+                loss_bias.backward()
+                self.opt_bias.step()   
+                self.opt_bias.zero_grad()
+            
+            with prof.phase('combiner'):
+                if self.individual:
+                    loss1 = F.sigmoid(self.weight).view(1, 1, -1)
+                    loss1 = loss1.repeat(b, t, 1)
+                    loss1 = rearrange(loss1, 'b t d -> b (t d)')
+                else:
+                    loss1 = F.sigmoid(self.weight)  
+                loss_w = criterion(loss1 * y1.detach() + (1 - loss1) * y2.detach(), rearrange(batch_y, 'b t d -> b (t d)'))
+                loss_w.backward()
+                self.opt_w.step()   
+                self.opt_w.zero_grad()
+            
+        f_dim = -1 if self.args.features=='MS' else 0
+        batch_y = batch_y[:,-self.args.pred_len:,f_dim:].to(self.device)
+        idx = self.count +  torch.arange(batch_y.size(0)).to(self.device)
+        self.count += batch_y.size(0)
+        with prof.phase('buffer'):
+            self.buffer.add_data(examples = x, labels = true, logits = idx, task_labels=batch_x_mark)
+        return outputs, rearrange(batch_y, 'b t d -> b (t d)')
+
+    def _ol_fused_batch(self, batch_x, batch_y, batch_x_mark, batch_y_mark):
+        """
+        _ol_one_batch with one backward and one optimizer step. The model, decision and
+        weight losses only share detached tensors, so the backward of their sum gives
+        every parameter the gradient of its own pass (the weight gets both the decision
+        and the weight loss, as in the three pass version) and self.opt_fused steps them.
+        In the individual case the gates stay (b, 1, d) and broadcast over the horizon.
+        """
+        b, t, d = batch_y.shape
+        criterion = self._select_criterion()
+        prof = self.profiler
+        with prof.phase('h2d'):
+            true = rearrange(batch_y, 'b t d -> b (t d)').float().to(self.device)
+            x = batch_x.float().to(self.device)
+            batch_x_mark = batch_x_mark.float().to(self.device)
+            batch_y = batch_y.float().to(self.device)
+        for _ in range(self.n_inner):
+
+            if self.individual:
+                loss1 = F.sigmoid(self.weight.view(1, 1, -1) + self.bias.view(-1, 1, d)).expand(b, t, d)
+                loss1 = rearrange(loss1, 'b t d -> b (t d)')
+            else:
+                loss1 = F.sigmoid(self.weight + self.bias)
+
+            outputs, y1, y2 = self.model.forward_weight(x, batch_x_mark, loss1, 1-loss1)
+            self.last_branches = (y1.detach(), y2.detach())
+            loss = criterion(y1, true) + criterion(y2, true)
+
+            with prof.phase('decision'):
+                if self.individual:
+                    y1_w, y2_w = y1.view(b, t, d).detach(), y2.view(b, t, d).detach()
+                    true_w = batch_y.view(b, t, d)
+                    w = F.sigmoid(self.weight).view(1, 1, -1)
+                    inputs_decision = torch.cat([w*y1_w, (1-w)*y2_w, true_w], dim=1)
+                    self.bias = self.decision(inputs_decision.permute(0,2,1))
+                    loss1 = F.sigmoid(self.weight.view(1, 1, -1) + self.bias.view(b, 1, -1))
+                else:
+                    y1_w, y2_w = y1.view(b, t * d).detach(), y2.view(b, t * d).detach()
+                    true_w = batch_y.view(b, t * d)
+                    w = F.sigmoid(self.weight)
+                    inputs_decision = torch.cat([w*y1_w, (1-w)*y2_w, true_w], dim=1)
+                    self.bias = self.decision(inputs_decision)
+                    loss1 = F.sigmoid(self.weight + self.bias)
+
+            loss_bias = criterion(loss1 * y1_w + (1 - loss1) * y2_w, true_w)
+            loss_w = criterion(w * y1_w + (1 - w) * y2_w, true_w)
+            with prof.phase('backward'):
+                (loss + loss_bias + loss_w).backward()
+            with prof.phase('optimizer'):
+                self.opt_fused.step()
+            with prof.phase('store_grad'):
+                self.model.store_grad()
+            self.opt_fused.zero_grad()
+
+        f_dim = -1 if self.args.features=='MS' else 0
+        batch_y = batch_y[:,-self.args.pred_len:,f_dim:].to(self.device)
+        idx = self.count +  torch.arange(batch_y.size(0)).to(self.device)
+        self.count += batch_y.size(0)
+        with prof.phase('buffer'):
+            self.buffer.add_data(examples = x, labels = true, logits = idx, task_labels=batch_x_mark)
+        return outputs, rearrange(batch_y, 'b t d -> b (t d)')
+
+    def _ol_lockstep_batch(self, batch_x, batch_y, batch_x_mark, batch_y_mark, mask):
+        """_ol_one_batch for one window per ticker, each on its own copy of test_lockstep."""
+        f_dim = -1 if self.args.features=='MS' else 0
+        batch_y = batch_y[:,-self.args.pred_len:,f_dim:]
+        b, t, d = batch_y.shape
+        true = rearrange(batch_y, 'b t d -> b (t d)').float().to(self.device)
+        mask = mask.to(self.device)
+        valid = mask.float()
+        # mse per ticker summed over tickers, masked tickers contribute nothing
+        criterion = lambda pred, target: (((pred - target) ** 2).mean(-1) * valid).sum()
+
+        x = batch_x.float().to(self.device)
+        batch_x_mark = batch_x_mark.float().to(self.device)
+        batch_y = batch_y.float().to(self.device)
+        # nobody to learn from at this step
+        n_inner = self.n_inner if mask.any() else 0
+        if not n_inner:
+            with torch.no_grad():
+                if self.individual:
+                    loss1 = F.sigmoid(self.weight.view(b, 1, -1) + self.bias.view(b, 1, d)).expand(b, t, d)
+                    loss1 = rearrange(loss1, 'b t d -> b (t d)')
+                else:
+                    loss1 = F.sigmoid(self.weight + self.bias)
+                y1, y2 = self._ticker_forward(x, batch_x_mark, mask)
+                outputs = y1 * loss1 + y2 * (1 - loss1)
+        for _ in range(n_inner):
+
+            if self.individual:
+                loss1 = F.sigmoid(self.weight.view(b, 1, -1) + self.bias.view(b, 1, d)).expand(b, t, d)
+                loss1 = rearrange(loss1, 'b t d -> b (t d)')
+            else:
+                loss1 = F.sigmoid(self.weight + self.bias)
+
+            y1, y2 = self._ticker_forward(x, batch_x_mark, mask)
+            outputs = y1.detach() * loss1 + y2.detach() * (1 - loss1)
+
+            l1, l2 = criterion(y1, true), criterion(y2, true)
+            loss = l1 + l2
+            if loss.requires_grad:
+                loss.backward()
+                self.opt.step(mask)
+                self._ticker_store_grad(mask)
+                self.opt.zero_grad()
+
             if self.individual:
                 y1_w, y2_w = y1.view(b, t, d).detach(), y2.view(b, t, d).detach()
                 true_w = batch_y.view(b, t, d).detach()
-                loss1 = F.sigmoid(self.weight).view(1, 1, -1)
-                loss1 = loss1.repeat(b, t, 1)
+                loss1 = F.sigmoid(self.weight).view(b, 1, -1).expand(b, t, d)
                 inputs_decision = torch.cat([loss1*y1_w, (1-loss1)*y2_w, true_w], dim=1)
-                self.bias = self.decision(inputs_decision.permute(0,2,1))
-                weight = self.weight.view(1, 1, -1)
-                weight = weight.repeat(b, t, 1)
-                bias = self.bias.view(b, 1, -1)
-                loss1 = F.sigmoid(weight + bias.repeat(1, t, 1))
+                bias = self.decision_stacked(inputs_decision.permute(0,2,1))
+                # a masked ticker keeps the bias of the last window it saw
+                self.bias = torch.where(mask.view(-1, 1, 1), bias, self.bias.detach().view_as(bias))
+                loss1 = F.sigmoid(self.weight.view(b, 1, -1) + self.bias.view(b, 1, -1)).expand(b, t, d)
                 loss1 = rearrange(loss1, 'b t d -> b (t d)')
                 loss2 = 1 - loss1
-                
+
                 y1_w = rearrange(y1_w, 'b t d -> b (t d)')
                 y2_w = rearrange(y2_w, 'b t d -> b (t d)')
                 true_w = rearrange(true_w, 'b t d -> b (t d)')
@@ -491,31 +1138,72 @@ class Exp_TS2VecSupervised(Exp_Basic):
                 true_w = batch_y.view(b, t * d).detach()
                 loss1 = F.sigmoid(self.weight)
                 inputs_decision = torch.cat([loss1*y1_w, (1-loss1)*y2_w, true_w], dim=1)
-                self.bias = self.decision(inputs_decision)
+                bias = self.decision_stacked(inputs_decision)
+                self.bias = torch.where(mask.view(-1, 1), bias, self.bias.detach().view_as(bias))
                 loss1 = F.sigmoid(self.weight + self.bias)
                 loss2 = 1 - loss1
-            
+
             outputs_bias = loss1 * y1_w + loss2 * y2_w
             loss_bias = criterion(outputs_bias, true_w)
             loss_bias.backward()
-            self.opt_bias.step()   
-            self.opt_bias.zero_grad()   
-            
+            self.opt_bias.step(mask)
+            self.opt_bias.zero_grad()
+
             if self.individual:
-                loss1 = F.sigmoid(self.weight).view(1, 1, -1)
-                loss1 = loss1.repeat(b, t, 1)
+                loss1 = F.sigmoid(self.weight).view(b, 1, -1).expand(b, t, d)
                 loss1 = rearrange(loss1, 'b t d -> b (t d)')
             else:
-                loss1 = F.sigmoid(self.weight)  
-            loss_w = criterion(loss1 * y1.detach() + (1 - loss1) * y2.detach(), rearrange(batch_y, 'b t d -> b (t d)'))
+                loss1 = F.sigmoid(self.weight)
+            loss_w = criterion(loss1 * y1.detach() + (1 - loss1) * y2.detach(), true)
             loss_w.backward()
-            self.opt_w.step()   
-            self.opt_w.zero_grad()   
-            
+            self.opt_w.step(mask)
+            self.opt_w.zero_grad()
+
         f_dim = -1 if self.args.features=='MS' else 0
         batch_y = batch_y[:,-self.args.pred_len:,f_dim:].to(self.device)
-        idx = self.count +  torch.arange(batch_y.size(0)).to(self.device)
-        self.count += batch_y.size(0)
-        self.buffer.add_data(examples = x, labels = true, logits = idx, task_labels=batch_x_mark)
+        idx = self.count +  torch.arange(int(mask.sum())).to(self.device)
+        self.count += int(mask.sum())
+        self.buffer.add_data(examples = x[mask], labels = true[mask], logits = idx, task_labels=batch_x_mark[mask])
         return outputs, rearrange(batch_y, 'b t d -> b (t d)')
 
+    def _ticker_call(self, params, *args):
+        return functional_call(self.ticker_step, params, args)
+
+    def _ticker_forward(self, x, x_mark, mask):
+        """Both branch forecasts of every ticker's copy of the model, one window per ticker."""
+        state = self.ticker_state
+        # the triggers set by the last store_grad, with one host sync for all the convs
+        names = list(state['trigger'])
+        fired = torch.stack([state['trigger'][name] for name in names]).any(1).tolist()
+        trigger = {name: state['trigger'][name] for name, on in zip(names, fired) if on}
+        y1, y2, q_ema, W = vmap(self._ticker_call)(self.ticker_params, state['grads'], state['q_ema'], trigger,
+                                                    x.unsqueeze(1), x_mark.unsqueeze(1))
+        # fw_chunks' state updates, for the tickers that saw this window
+        with torch.no_grad():
+            for name, q in q_ema.items():
+                old = state['q_ema'].get(name)
+                state['q_ema'][name] = q.detach() if old is None else torch.where(mask.view(-1, 1), q.detach(), old)
+            for name, new in W.items():
+                p = self.ticker_params['model.' + name + '.W']
+                p.data = torch.where(mask.view(-1, 1, 1), new.detach(), p.data)
+                state['trigger'][name] = state['trigger'][name] & ~mask
+        return y1.squeeze(1), y2.squeeze(1)
+
+    def _ticker_store_grad(self, mask):
+        """SamePadConv.store_grad of every conv of every ticker's copy, for the tickers in mask."""
+        state = self.ticker_state
+        rows = mask.view(-1, 1)
+        with torch.no_grad():
+            for name, layer in self.ticker_step.convs:
+                grad = self.ticker_params['model.' + name + '.conv.weight'].grad
+                if grad is None:
+                    # frozen layer, e.g. the encoder with online_learning='regressor'
+                    continue
+                grad = F.normalize(grad, dim=2).flatten(1)
+                f_grads = layer.f_gamma * state['f_grads'][name] + (1-layer.f_gamma) * grad
+                if not layer.training:
+                    e = F.cosine_similarity(f_grads, state['grads'][name], dim=1, eps=layer.cos.eps)
+                    state['trigger'][name] = state['trigger'][name] | ((e < -layer.tau) & mask)
+                grads = layer.gamma * state['grads'][name] + (1-layer.gamma) * grad
+                state['f_grads'][name] = torch.where(rows, f_grads, state['f_grads'][name])
+                state['grads'][name] = torch.where(rows, grads, state['grads'][name])
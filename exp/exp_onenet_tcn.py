@@ -1,10 +1,11 @@
-from data.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Pred
+from data.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Pred, window_loader
 from exp.exp_basic import Exp_Basic
 from models.ts2vec.ncca import TSEncoder, GlobalLocalMultiscaleTSEncoder, TSEncoderTime
 from models.ts2vec.losses import hierarchical_contrastive_loss
 from tqdm import tqdm
 from utils.tools import EarlyStopping, adjust_learning_rate
-from utils.metrics import metric, cumavg
+from utils.metrics import StreamingMetrics
+from utils.results import PredictionSink
 import pdb
 import numpy as np
 from einops import rearrange
@@ -72,6 +73,8 @@ class net(nn.Module):
                              depth=depth) 
         self.encoder_time = TS2VecEncoderWrapper(encoder, mask='all_true').to(self.device)
         self.regressor_time = nn.Linear(320, args.pred_len).to(self.device)
+        # forecasts every input channel, under MS only the last c_out (the target) are kept
+        self.c_out = args.c_out
         
         encoder = TSEncoder(input_dims=args.enc_in + 7,
                              output_dims=320,  # standard ts2vec backbone value
@@ -85,7 +88,7 @@ class net(nn.Module):
         
     def forward_weight(self, x, x_mark, g1, g2):
         rep = self.encoder_time.encoder(x)
-        y = self.regressor_time(rep).transpose(1, 2)
+        y = self.regressor_time(rep).transpose(1, 2)[..., -self.c_out:]
         y1 = rearrange(y, 'b t d -> b (t d)')
         
         x = torch.cat([x, x_mark], dim=-1)
@@ -108,8 +111,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
         self.count = 0
         if self.individual:
             self.decision = MLP(n_inputs=args.pred_len * 3, n_outputs=1, mlp_width=32, mlp_depth=3, mlp_dropout=0.1, act=nn.Tanh()).to(self.device)
-            self.weight = torch.zeros(args.enc_in, device = self.device)
-            self.bias = torch.zeros(args.enc_in, device = self.device)
+            self.weight = torch.zeros(args.c_out, device = self.device)
+            self.bias = torch.zeros(args.c_out, device = self.device)
         else:
             self.decision = MLP(n_inputs=(args.c_out * args.pred_len) * 3, n_outputs=1, mlp_width=32, mlp_depth=3, mlp_dropout=0.1, act=nn.Tanh()).to(self.device)
             self.weight = torch.zeros(1, device = self.device)
@@ -176,15 +179,24 @@ class Exp_TS2VecSupervised(Exp_Basic):
             inverse=args.inverse,
             timeenc=timeenc,
             freq=freq,
-            cols=args.cols
+            cols=args.cols,
+            cache_dir=args.data_cache
         )
         print(flag, len(data_set))
-        data_loader = DataLoader(
-            data_set,
-            batch_size=batch_size,
-            shuffle=shuffle_flag,
-            num_workers=args.num_workers,
-            drop_last=drop_last)
+        if args.batched_windows:
+            data_loader = window_loader(
+                data_set,
+                batch_size=batch_size,
+                shuffle=shuffle_flag,
+                drop_last=drop_last,
+                num_workers=args.num_workers)
+        else:
+            data_loader = DataLoader(
+                data_set,
+                batch_size=batch_size,
+                shuffle=shuffle_flag,
+                num_workers=args.num_workers,
+                drop_last=drop_last)
 
         return data_set, data_loader
 
@@ -301,8 +313,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
 
     def test(self, setting):
         if self.individual:
-            self.weight = torch.zeros(self.args.enc_in, device = self.device)
-            self.bias = torch.zeros(self.args.enc_in, device = self.device)
+            self.weight = torch.zeros(self.args.c_out, device = self.device)
+            self.bias = torch.zeros(self.args.c_out, device = self.device)
         else:
             self.weight = torch.zeros(1, device = self.device)
             self.bias = torch.zeros(1, device = self.device)
@@ -320,27 +332,19 @@ class Exp_TS2VecSupervised(Exp_Basic):
             for p in self.model.parameters():
                 p.requires_grad = False
         
-        preds = []
-        trues = []
+        sink = PredictionSink('./results/' + setting + '/', len(test_data), self.args.sink_chunk)
         start = time.time()
-        maes,mses,rmses,mapes,mspes = [],[],[],[],[]
+        metrics = StreamingMetrics(self.args.metrics_sync, test_data if self.args.inverse_metrics else None, self.args.c_out)
         for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(tqdm(test_loader)):
             pred, true = self._process_one_batch(
                 test_data, batch_x, batch_y, batch_x_mark, batch_y_mark, mode='test')
-            preds.append(pred.detach().cpu())
-            trues.append(true.detach().cpu())
-            mae, mse, rmse, mape, mspe = metric(pred.detach().cpu().numpy(), true.detach().cpu().numpy())
-            maes.append(mae)
-            mses.append(mse)
-            rmses.append(rmse)
-            mapes.append(mape)
-            mspes.append(mspe)
-
-        preds = torch.cat(preds, dim=0).numpy()
-        trues = torch.cat(trues, dim=0).numpy()
+            sink.append(pred, true)
+            metrics.update(pred, true)
+
+        preds, trues = sink.close(method=self.args.method, setting=setting)
         print('test shape:', preds.shape, trues.shape)
         
-        MAE, MSE, RMSE, MAPE, MSPE = cumavg(maes), cumavg(mses), cumavg(rmses), cumavg(mapes), cumavg(mspes)
+        MAE, MSE, RMSE, MAPE, MSPE = metrics.curves()
         mae, mse, rmse, mape, mspe = MAE[-1], MSE[-1], RMSE[-1], MAPE[-1], MSPE[-1]
 
         end = time.time()
@@ -417,6 +421,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
     
     
     def _ol_one_batch(self,dataset_object, batch_x, batch_y, batch_x_mark, batch_y_mark, return_loss=False):
+        f_dim = -1 if self.args.features=='MS' else 0
+        batch_y = batch_y[:,-self.args.pred_len:,f_dim:]
         b, t, d = batch_y.shape
         true = rearrange(batch_y, 'b t d -> b (t d)').float().to(self.device)
         criterion = self._select_criterion()
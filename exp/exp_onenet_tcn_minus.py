@@ -4,7 +4,8 @@ from models.ts2vec.ncca import TSEncoder, GlobalLocalMultiscaleTSEncoder, TSEnco
 from models.ts2vec.losses import hierarchical_contrastive_loss
 from tqdm import tqdm
 from utils.tools import EarlyStopping, adjust_learning_rate
-from utils.metrics import metric, cumavg
+from utils.metrics import StreamingMetrics
+from utils.results import PredictionSink
 import pdb
 import numpy as np
 from einops import rearrange
@@ -72,17 +73,19 @@ class net(nn.Module):
                              depth=depth) 
         self.encoder_time = TS2VecEncoderWrapper(encoder, mask='all_true').to(self.device)
         self.regressor_time = nn.Linear(320, args.pred_len).to(self.device)
+        # forecasts every input channel, under MS only the last c_out (the target) are kept
+        self.c_out = args.c_out
         
         self.patchtst = PatchTST(args, device = self.device)
         
         
     def forward_weight(self, x, x_mark, g1, g2):
         rep = self.encoder_time.encoder(x)
-        y = self.regressor_time(rep).transpose(1, 2)
+        y = self.regressor_time(rep).transpose(1, 2)[..., -self.c_out:]
         y1 = rearrange(y, 'b t d -> b (t d)')
         
         x = torch.cat([x, x_mark], dim=-1)
-        y2 = self.patchtst(x)
+        y2 = self.patchtst(x)[..., -self.c_out:]
         y2 = rearrange(y2, 'b t d -> b (t d)')
     
         return y1.detach() * g1 + y2.detach() * g2, y1, y2
@@ -101,8 +104,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
         self.count = 0
         if self.individual:
             self.decision = MLP(n_inputs=args.pred_len * 3, n_outputs=1, mlp_width=32, mlp_depth=3, mlp_dropout=0.1, act=nn.Tanh()).to(self.device)
-            self.weight = torch.zeros(args.enc_in, device = self.device)
-            self.bias = torch.zeros(args.enc_in, device = self.device)
+            self.weight = torch.zeros(args.c_out, device = self.device)
+            self.bias = torch.zeros(args.c_out, device = self.device)
         else:
             self.decision = MLP(n_inputs=(args.c_out * args.pred_len) * 3, n_outputs=1, mlp_width=32, mlp_depth=3, mlp_dropout=0.1, act=nn.Tanh()).to(self.device)
             self.weight = torch.zeros(1, device = self.device)
@@ -294,8 +297,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
 
     def test(self, setting):
         if self.individual:
-            self.weight = torch.zeros(self.args.enc_in, device = self.device)
-            self.bias = torch.zeros(self.args.enc_in, device = self.device)
+            self.weight = torch.zeros(self.args.c_out, device = self.device)
+            self.bias = torch.zeros(self.args.c_out, device = self.device)
         else:
             self.weight = torch.zeros(1, device = self.device)
             self.bias = torch.zeros(1, device = self.device)
@@ -313,27 +316,19 @@ class Exp_TS2VecSupervised(Exp_Basic):
             for p in self.model.parameters():
                 p.requires_grad = False
         
-        preds = []
-        trues = []
+        sink = PredictionSink('./results/' + setting + '/', len(test_data), self.args.sink_chunk)
         start = time.time()
-        maes,mses,rmses,mapes,mspes = [],[],[],[],[]
+        metrics = StreamingMetrics(self.args.metrics_sync, test_data if self.args.inverse_metrics else None, self.args.c_out)
         for i, (batch_x, batch_y, batch_x_mark, batch_y_mark) in enumerate(tqdm(test_loader)):
             pred, true = self._process_one_batch(
                 test_data, batch_x, batch_y, batch_x_mark, batch_y_mark, mode='test')
-            preds.append(pred.detach().cpu())
-            trues.append(true.detach().cpu())
-            mae, mse, rmse, mape, mspe = metric(pred.detach().cpu().numpy(), true.detach().cpu().numpy())
-            maes.append(mae)
-            mses.append(mse)
-            rmses.append(rmse)
-            mapes.append(mape)
-            mspes.append(mspe)
-
-        preds = torch.cat(preds, dim=0).numpy()
-        trues = torch.cat(trues, dim=0).numpy()
+            sink.append(pred, true)
+            metrics.update(pred, true)
+
+        preds, trues = sink.close(method=self.args.method, setting=setting)
         print('test shape:', preds.shape, trues.shape)
         
-        MAE, MSE, RMSE, MAPE, MSPE = cumavg(maes), cumavg(mses), cumavg(rmses), cumavg(mapes), cumavg(mspes)
+        MAE, MSE, RMSE, MAPE, MSPE = metrics.curves()
         mae, mse, rmse, mape, mspe = MAE[-1], MSE[-1], RMSE[-1], MAPE[-1], MSPE[-1]
 
         end = time.time()
@@ -410,6 +405,8 @@ class Exp_TS2VecSupervised(Exp_Basic):
     
     
     def _ol_one_batch(self,dataset_object, batch_x, batch_y, batch_x_mark, batch_y_mark, return_loss=False):
+        f_dim = -1 if self.args.features=='MS' else 0
+        batch_y = batch_y[:,-self.args.pred_len:,f_dim:]
         b, t, d = batch_y.shape
         true = rearrange(batch_y, 'b t d -> b (t d)').float().to(self.device)
         criterion = self._select_criterion()
@@ -1,4 +1,4 @@
-from data.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Pred, FinancialDataset
+from data.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Pred, FinancialDataset, PanelFinancialDataset
 from exp.exp_basic import Exp_Basic
 from models.ts2vec.encoder import TSEncoder
 from models.ts2vec.losses import hierarchical_contrastive_loss
@@ -79,6 +79,8 @@ class Exp_TS2Vec(Exp_Basic):
             'Solar': Dataset_Custom,
             'custom': Dataset_Custom,
             'finance': FinancialDataset,
+            'kdd17': PanelFinancialDataset,
+            'stocknet': PanelFinancialDataset,
         }
         Data = data_dict[self.args.data]
         timeenc = 2 if args.timeenc else 0
@@ -379,7 +379,7 @@ class Flatten_Head_TCN(nn.Module):
             x_out = []
             for i in range(self.n_vars):
                 z = self.flattens[i](x[:,i,:,:])          # z: [bs x d_model * patch_num]
-                z = torch.cat([x, z_tcn[:,i,:]], dim=1)
+                z = torch.cat([z, z_tcn[:,i,:]], dim=1)
                 z = self.linears[i](z)                    # z: [bs x target_window]
                 z = self.dropouts[i](z)
                 x_out.append(z)
@@ -62,137 +62,168 @@ def init_dl_program(
 
     return devices if len(devices) > 1 else devices[0]
 
-parser = argparse.ArgumentParser(description='[Informer] Long Sequences Forecasting')
-
-parser.add_argument('--data', type=str, default='finance', help='data')
-parser.add_argument('--root_path', type=str, default='./data/', help='root path of the data file')
-parser.add_argument('--data_path', type=str, default='finance.csv', help='data file')    
-parser.add_argument('--features', type=str, default='MS', help='forecasting task, options:[M, S, MS]; M:multivariate predict multivariate, S:univariate predict univariate, MS:multivariate predict univariate')
-parser.add_argument('--target', type=str, default='Close', help='target feature in S or MS task')
-parser.add_argument('--freq', type=str, default='b', help='freq for time features encoding, options:[s:secondly, t:minutely, h:hourly, d:daily, b:business days, w:weekly, m:monthly], you can also use more detailed freq like 15min or 3h')
-parser.add_argument('--checkpoints', type=str, default='./checkpoints/', help='location of model checkpoints')
-
-parser.add_argument('--seq_len', type=int, default=96, help='input sequence length of Informer encoder')
-parser.add_argument('--label_len', type=int, default=0, help='start token length of Informer decoder')
-parser.add_argument('--pred_len', type=int, default=1, help='prediction sequence length')
-# Informer decoder input: concat[start token series(label_len), zero padding series(pred_len)]
-
-parser.add_argument('--enc_in', type=int, default=7, help='encoder input size')
-parser.add_argument('--dec_in', type=int, default=7, help='decoder input size')
-parser.add_argument('--c_out', type=int, default=7, help='output size')
-parser.add_argument('--d_model', type=int, default=32, help='dimension of model')
-parser.add_argument('--n_heads', type=int, default=8, help='num of heads')
-parser.add_argument('--e_layers', type=int, default=2 , help='num of encoder layers')
-parser.add_argument('--d_layers', type=int, default=1, help='num of decoder layers')
-parser.add_argument('--s_layers', type=str, default='3,2,1', help='num of stack encoder layers')
-parser.add_argument('--d_ff', type=int, default=128, help='dimension of fcn')
-parser.add_argument('--factor', type=int, default=5, help='probsparse attn factor')
-parser.add_argument('--padding', type=int, default=0, help='padding type')
-parser.add_argument('--distil', action='store_false', help='whether to use distilling in encoder, using this argument means not using distilling', default=True)
-parser.add_argument('--dropout', type=float, default=0.05, help='dropout')
-parser.add_argument('--attn', type=str, default='prob', help='attention used in encoder, options:[prob, full]')
-parser.add_argument('--embed', type=str, default='timeF', help='time features encoding, options:[timeF, fixed, learned]')
-parser.add_argument('--activation', type=str, default='gelu',help='activation')
-parser.add_argument('--output_attention', action='store_true', help='whether to output attention in ecoder')
-parser.add_argument('--do_predict', action='store_true', help='whether to predict unseen future data')
-parser.add_argument('--mix', action='store_false', help='use mix attention in generative decoder', default=True)
-parser.add_argument('--cols', type=str, nargs='+', help='certain cols from the data files as the input features')
-parser.add_argument('--num_workers', type=int, default=0, help='data loader num workers')
-parser.add_argument('--itr', type=int, default=2, help='experiments times')
-parser.add_argument('--train_epochs', type=int, default=3, help='train epochs')
-parser.add_argument('--batch_size', type=int, default=32, help='batch size of train input data')
-parser.add_argument('--patience', type=int, default=3, help='early stopping patience')
-parser.add_argument('--learning_rate', type=float, default=0.003, help='optimizer learning rate')
-parser.add_argument('--learning_rate_w', type=float, default=0.001, help='optimizer learning rate')
-parser.add_argument('--learning_rate_bias', type=float, default=0.001, help='optimizer learning rate')
-parser.add_argument('--weight_decay', type=float, default=1e-3, help='optimizer learning rate')
-parser.add_argument('--des', type=str, default='test',help='exp description')
-parser.add_argument('--loss', type=str, default='mse',help='loss function')
-parser.add_argument('--lradj', type=str, default='type1',help='adjust learning rate')
-parser.add_argument('--use_amp', action='store_true', help='use automatic mixed precision training', default=False)
-parser.add_argument('--inverse', action='store_true', help='inverse output data', default=False)
-parser.add_argument('--method', type=str, default='onenet_fsnet')
-
-# PatchTST
-parser.add_argument('--fc_dropout', type=float, default=0.05, help='fully connected dropout')
-parser.add_argument('--head_dropout', type=float, default=0.0, help='head dropout')
-parser.add_argument('--patch_len', type=int, default=16, help='patch length')
-parser.add_argument('--stride', type=int, default=8, help='stride')
-parser.add_argument('--padding_patch', default='end', help='None: None; end: padding on the end')
-parser.add_argument('--revin', type=int, default=0, help='RevIN; True 1 False 0')
-parser.add_argument('--affine', type=int, default=0, help='RevIN-affine; True 1 False 0')
-parser.add_argument('--subtract_last', type=int, default=0, help='0: subtract mean; 1: subtract last')
-parser.add_argument('--decomposition', type=int, default=0, help='decomposition; True 1 False 0')
-parser.add_argument('--kernel_size', type=int, default=25, help='decomposition-kernel')
-parser.add_argument('--tcn_output_dim', type=int, default=320, help='decomposition-kernel')
-parser.add_argument('--tcn_layer', type=int, default=2, help='decomposition-kernel')
-parser.add_argument('--tcn_hidden', type=int, default=160, help='decomposition-kernel')
-parser.add_argument('--individual', type=int, default=1, help='individual head; True 1 False 0')
-
-parser.add_argument('--teacher_forcing', action='store_true', help='use teacher forcing during forecasting', default=False)
-parser.add_argument('--online_learning', type=str, default='full')
-parser.add_argument('--opt', type=str, default='adam')
-
-parser.add_argument('--test_bsz', type=int, default=1)
-parser.add_argument('--n_inner', type=int, default=1)
-parser.add_argument('--channel_cross', type=bool, default=False)
-
-parser.add_argument('--use_gpu', type=bool, default=True, help='use gpu')
-parser.add_argument('--gpu', type=int, default=0, help='gpu')
-parser.add_argument('--use_multi_gpu', action='store_true', help='use multiple gpus', default=False)
-parser.add_argument('--devices', type=str, default='0,1,2,3',help='device ids of multile gpus')
-
-parser.add_argument('--finetune', action='store_true', default=False)
-parser.add_argument('--finetune_model_seed', type=int)
-
-parser.add_argument('--aug', type=int, default=0, help='Training with augmentation data aug iterations')
-parser.add_argument('--lr_test', type=float, default=1e-3, help='learning rate during test')
-
-# supplementary config for FEDformer model
-parser.add_argument('--version', type=str, default='Wavelets',
-                    help='for FEDformer, there are two versions to choose, options: [Fourier, Wavelets]')
-parser.add_argument('--mode_select', type=str, default='random',
-                    help='for FEDformer, there are two mode selection method, options: [random, low]')
-parser.add_argument('--modes', type=int, default=64, help='modes to be selected random 64')
-parser.add_argument('--L', type=int, default=3, help='ignore level')
-parser.add_argument('--base', type=str, default='legendre', help='mwt base')
-parser.add_argument('--cross_activation', type=str, default='tanh',
-                    help='mwt cross atention activation function tanh or softmax')
-parser.add_argument('--moving_avg', default=[24], help='window size of moving average')
-
-parser.add_argument('--gamma', type=float, default=0.1)
-parser.add_argument('--m', type=int, default=24)
-parser.add_argument('--loss_aug', type=float, default=0.5, help='weight for augmentation loss')
-parser.add_argument('--use_adbfgs', action='store_true', help='use the Adbfgs optimizer', default=True)
-parser.add_argument('--period_len', type=int, default=12)
-parser.add_argument('--mlp_depth', type=int, default=3)
-parser.add_argument('--mlp_width', type=int, default=256)
-parser.add_argument('--station_lr', type=float, default=0.0001)
-
-
-parser.add_argument('--sleep_interval', type=int, default=1, help='latent dimension of koopman embedding')
-parser.add_argument('--sleep_epochs', type=int, default=1, help='latent dimension of koopman embedding')
-parser.add_argument('--sleep_kl_pre', type=float, default=0, help='latent dimension of koopman embedding')
-parser.add_argument('--delay_fb', action='store_true', default=False, help='use delayed feedback')
-parser.add_argument('--online_adjust', type=float, default=0.0, help='latent dimension of koopman embedding')
-parser.add_argument('--offline_adjust', type=float, default=0.0, help='latent dimension of koopman embedding')
-parser.add_argument('--online_adjust_var', type=float, default=0.0, help='latent dimension of koopman embedding')
-parser.add_argument('--var_weight', type=float, default=0.0, help='latent dimension of koopman embedding')
-parser.add_argument('--alpha_w', type=float, default=0.0001, help='spectrum filter ratio')
-parser.add_argument('--alpha_d', type=float, default=0.003, help='spectrum filter ratio')
-parser.add_argument('--test_lr', type=float, default=0.1, help='spectrum filter ratio')
-
-
-args = parser.parse_args()
-
-args.use_gpu = True if torch.cuda.is_available() and args.use_gpu else False
-args.test_bsz = args.batch_size if args.test_bsz == -1 else args.test_bsz
-if args.use_gpu and args.use_multi_gpu:
-    args.devices = args.devices.replace(' ','')
-    device_ids = args.devices.split(',')
-    args.device_ids = [int(id_) for id_ in device_ids]
-    args.gpu = args.device_ids[0]
-    
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='[Informer] Long Sequences Forecasting')
+
+    parser.add_argument('--data', type=str, default='finance', help='data')
+    parser.add_argument('--root_path', type=str, default='./data/', help='root path of the data file')
+    parser.add_argument('--data_path', type=str, default='finance.csv', help='data file')    
+    parser.add_argument('--features', type=str, default='MS', help='forecasting task, options:[M, S, MS]; M:multivariate predict multivariate, S:univariate predict univariate, MS:multivariate predict univariate')
+    parser.add_argument('--target', type=str, default='Close', help='target feature in S or MS task')
+    parser.add_argument('--freq', type=str, default='b', help='freq for time features encoding, options:[s:secondly, t:minutely, h:hourly, d:daily, b:business days, w:weekly, m:monthly], you can also use more detailed freq like 15min or 3h')
+    parser.add_argument('--checkpoints', type=str, default='./checkpoints/', help='location of model checkpoints')
+    parser.add_argument('--stream_source', type=str, default=None, help='live feed for the online phase instead of the test split: csv being appended to, named pipe or unix:<socket path>')
+    parser.add_argument('--stream_scale_window', type=int, default=256, help='number of recent bars used for the rolling scaler of the live feed')
+    parser.add_argument('--stream_poll', type=float, default=0.5, help='seconds between polls of an appended csv feed')
+    parser.add_argument('--stream_log_every', type=int, default=100, help='print running stream metrics every n bars')
+    parser.add_argument('--data_cache', type=str, default=None, help='folder for memory-mapped preprocessed datasets, disabled if not set')
+
+    parser.add_argument('--seq_len', type=int, default=96, help='input sequence length of Informer encoder')
+    parser.add_argument('--label_len', type=int, default=0, help='start token length of Informer decoder')
+    parser.add_argument('--pred_len', type=int, default=1, help='prediction sequence length')
+    # Informer decoder input: concat[start token series(label_len), zero padding series(pred_len)]
+
+    parser.add_argument('--enc_in', type=int, default=7, help='encoder input size')
+    parser.add_argument('--dec_in', type=int, default=7, help='decoder input size')
+    parser.add_argument('--c_out', type=int, default=7, help='output size')
+    parser.add_argument('--d_model', type=int, default=32, help='dimension of model')
+    parser.add_argument('--n_heads', type=int, default=8, help='num of heads')
+    parser.add_argument('--e_layers', type=int, default=2 , help='num of encoder layers')
+    parser.add_argument('--d_layers', type=int, default=1, help='num of decoder layers')
+    parser.add_argument('--s_layers', type=str, default='3,2,1', help='num of stack encoder layers')
+    parser.add_argument('--d_ff', type=int, default=128, help='dimension of fcn')
+    parser.add_argument('--factor', type=int, default=5, help='probsparse attn factor')
+    parser.add_argument('--padding', type=int, default=0, help='padding type')
+    parser.add_argument('--distil', action='store_false', help='whether to use distilling in encoder, using this argument means not using distilling', default=True)
+    parser.add_argument('--dropout', type=float, default=0.05, help='dropout')
+    parser.add_argument('--attn', type=str, default='prob', help='attention used in encoder, options:[prob, full]')
+    parser.add_argument('--embed', type=str, default='timeF', help='time features encoding, options:[timeF, fixed, learned]')
+    parser.add_argument('--activation', type=str, default='gelu',help='activation')
+    parser.add_argument('--output_attention', action='store_true', help='whether to output attention in ecoder')
+    parser.add_argument('--do_predict', action='store_true', help='whether to predict unseen future data')
+    parser.add_argument('--mix', action='store_false', help='use mix attention in generative decoder', default=True)
+    parser.add_argument('--cols', type=str, nargs='+', help='certain cols from the data files as the input features')
+    parser.add_argument('--num_workers', type=int, default=0, help='data loader num workers')
+    parser.add_argument('--batched_windows', action='store_true', help='serve whole batches of strided windows instead of collating single samples, not for kdd17 / stocknet', default=False)
+    parser.add_argument('--itr', type=int, default=2, help='experiments times')
+    parser.add_argument('--train_epochs', type=int, default=3, help='train epochs')
+    parser.add_argument('--batch_size', type=int, default=32, help='batch size of train input data')
+    parser.add_argument('--patience', type=int, default=3, help='early stopping patience')
+    parser.add_argument('--learning_rate', type=float, default=0.003, help='optimizer learning rate')
+    parser.add_argument('--learning_rate_w', type=float, default=0.001, help='optimizer learning rate')
+    parser.add_argument('--learning_rate_bias', type=float, default=0.001, help='optimizer learning rate')
+    parser.add_argument('--weight_decay', type=float, default=1e-3, help='optimizer learning rate')
+    parser.add_argument('--des', type=str, default='test',help='exp description')
+    parser.add_argument('--loss', type=str, default='mse',help='loss function')
+    parser.add_argument('--lradj', type=str, default='type1',help='adjust learning rate')
+    parser.add_argument('--use_amp', action='store_true', help='use automatic mixed precision training', default=False)
+    parser.add_argument('--inverse', action='store_true', help='inverse output data', default=False)
+    parser.add_argument('--inverse_metrics', action='store_true', help='compute the test metrics on the inverse-scaled predictions and targets, for datasets that scale their target (not finance, kdd17, stocknet)')
+    parser.add_argument('--metrics_sync', type=int, default=256, help='test steps whose metrics are buffered on the device between host syncs')
+    parser.add_argument('--sink_chunk', type=int, default=1024, help='test rows staged on the device between writes to the memory-mapped preds/trues files')
+    parser.add_argument('--profile', action='store_true', help='time the phases of every online step and print p50/p95/p99 per phase after the test')
+    parser.add_argument('--profile_sync', action='store_true', help='synchronize the device at phase boundaries so gpu time is charged to the right phase')
+    parser.add_argument('--profile_trace', type=str, default=None, help='with --profile, export a torch.profiler chrome trace of a window of online steps to this folder')
+    parser.add_argument('--profile_trace_start', type=int, default=10, help='first online step of the traced window')
+    parser.add_argument('--profile_trace_steps', type=int, default=5, help='number of traced online steps')
+    parser.add_argument('--method', type=str, default='onenet_fsnet')
+
+    # PatchTST
+    parser.add_argument('--fc_dropout', type=float, default=0.05, help='fully connected dropout')
+    parser.add_argument('--head_dropout', type=float, default=0.0, help='head dropout')
+    parser.add_argument('--patch_len', type=int, default=16, help='patch length')
+    parser.add_argument('--stride', type=int, default=8, help='stride')
+    parser.add_argument('--padding_patch', default='end', help='None: None; end: padding on the end')
+    parser.add_argument('--revin', type=int, default=0, help='RevIN; True 1 False 0')
+    parser.add_argument('--affine', type=int, default=0, help='RevIN-affine; True 1 False 0')
+    parser.add_argument('--subtract_last', type=int, default=0, help='0: subtract mean; 1: subtract last')
+    parser.add_argument('--decomposition', type=int, default=0, help='decomposition; True 1 False 0')
+    parser.add_argument('--kernel_size', type=int, default=25, help='decomposition-kernel')
+    parser.add_argument('--tcn_output_dim', type=int, default=320, help='decomposition-kernel')
+    parser.add_argument('--tcn_layer', type=int, default=2, help='decomposition-kernel')
+    parser.add_argument('--tcn_hidden', type=int, default=160, help='decomposition-kernel')
+    parser.add_argument('--individual', type=int, default=1, help='individual head; True 1 False 0')
+
+    parser.add_argument('--teacher_forcing', action='store_true', help='use teacher forcing during forecasting', default=False)
+    parser.add_argument('--online_learning', type=str, default='full')
+    parser.add_argument('--opt', type=str, default='adam')
+
+    parser.add_argument('--test_bsz', type=int, default=1)
+    parser.add_argument('--lockstep', action='store_true', help='online phase with all tickers of a panel dataset advancing together in one batched step, each on its own copy of the model, combiner and optimizer state (onenet_fsnet)', default=False)
+    parser.add_argument('--fused_combiner', action='store_true', help='onenet online step with one backward and one optimizer step for the model, decision and weight losses', default=False)
+    parser.add_argument('--lazy_threshold', type=float, default=0., help='onenet skips the cold branch while the combination weight puts at least this much on the other one for every channel, 0 disables')
+    parser.add_argument('--lazy_refresh', type=int, default=10, help='run both branches after this many lazy steps so the combination weight is re-estimated')
+    parser.add_argument('--causal_conv', action='store_true', help='left padded (causal) convolutions in the onenet feature encoder', default=False)
+    parser.add_argument('--incremental_encoder', action='store_true', help='online phase steps the causal feature encoder over the newest bar only, needs --causal_conv, --test_bsz 1, --n_inner 1, no --delay_fb and a --seq_len of at least the encoder\'s receptive field (8189 bars); activations queued before an online update are not recomputed', default=False)
+    parser.add_argument('--calib_cache', action='store_true', help='reuse the calibrated fsnet conv weights between gradient updates instead of recomputing them on every forward', default=False)
+    parser.add_argument('--resume_from', type=str, default=None, help='online snapshot to resume the test stream from, instead of training (onenet_fsnet, fsnet, fsnet_d3a, onenet_d3a)')
+    parser.add_argument('--snapshot_every', type=int, default=0, help='snapshot the online state every n test windows, 0 disables (onenet_fsnet, fsnet, fsnet_d3a, onenet_d3a)')
+    parser.add_argument('--snapshot_path', type=str, default=None, help='{step} is replaced by the window count, defaults to <checkpoints>/<setting>/online_snapshot_{step}.pt')
+    parser.add_argument('--snapshot_mmap', action='store_true', help='memory-map the snapshot when resuming')
+    parser.add_argument('--async_checkpoint', action='store_true', help='write checkpoints and online snapshots on a background thread')
+    parser.add_argument('--checkpoint_keep', type=int, default=3, help='number of online snapshots kept on disk')
+    parser.add_argument('--n_inner', type=int, default=1)
+    parser.add_argument('--channel_cross', type=bool, default=False)
+
+    parser.add_argument('--use_gpu', type=bool, default=True, help='use gpu')
+    parser.add_argument('--gpu', type=int, default=0, help='gpu')
+    parser.add_argument('--use_multi_gpu', action='store_true', help='use multiple gpus', default=False)
+    parser.add_argument('--devices', type=str, default='0,1,2,3',help='device ids of multile gpus')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads when running on cpu')
+
+    parser.add_argument('--finetune', action='store_true', default=False)
+    parser.add_argument('--finetune_model_seed', type=int)
+
+    parser.add_argument('--aug', type=int, default=0, help='Training with augmentation data aug iterations')
+    parser.add_argument('--lr_test', type=float, default=1e-3, help='learning rate during test')
+
+    # supplementary config for FEDformer model
+    parser.add_argument('--version', type=str, default='Wavelets',
+                        help='for FEDformer, there are two versions to choose, options: [Fourier, Wavelets]')
+    parser.add_argument('--mode_select', type=str, default='random',
+                        help='for FEDformer, there are two mode selection method, options: [random, low]')
+    parser.add_argument('--modes', type=int, default=64, help='modes to be selected random 64')
+    parser.add_argument('--L', type=int, default=3, help='ignore level')
+    parser.add_argument('--base', type=str, default='legendre', help='mwt base')
+    parser.add_argument('--cross_activation', type=str, default='tanh',
+                        help='mwt cross atention activation function tanh or softmax')
+    parser.add_argument('--moving_avg', default=[24], help='window size of moving average')
+
+    parser.add_argument('--gamma', type=float, default=0.1)
+    parser.add_argument('--m', type=int, default=24)
+    parser.add_argument('--loss_aug', type=float, default=0.5, help='weight for augmentation loss')
+    parser.add_argument('--use_adbfgs', action='store_true', help='use the Adbfgs optimizer', default=True)
+    parser.add_argument('--adbfgs_flat', action='store_true', help='keep the Adbfgs params and state in flat arenas, one update per arena', default=False)
+    parser.add_argument('--period_len', type=int, default=12)
+    parser.add_argument('--mlp_depth', type=int, default=3)
+    parser.add_argument('--mlp_width', type=int, default=256)
+    parser.add_argument('--station_lr', type=float, default=0.0001)
+
+
+    parser.add_argument('--replay_priority', action='store_true', help='replay buffer samples proportionally to the online loss (er, derpp, onenet_d3a)', default=False)
+    parser.add_argument('--priority_alpha', type=float, default=0.6, help='prioritized replay exponent, 0 is uniform')
+    parser.add_argument('--priority_beta', type=float, default=0.4, help='prioritized replay importance-sampling exponent')
+    parser.add_argument('--sleep_interval', type=int, default=1, help='latent dimension of koopman embedding')
+    parser.add_argument('--sleep_epochs', type=int, default=1, help='latent dimension of koopman embedding')
+    parser.add_argument('--sleep_kl_pre', type=float, default=0, help='latent dimension of koopman embedding')
+    parser.add_argument('--sleep_async', action='store_true', help='d3a sleep stages train a copy of the model in the background while the online phase goes on')
+    parser.add_argument('--sleep_merge', type=str, default='swap', help='how a background sleep stage is merged back, options:[swap, delta]')
+    parser.add_argument('--delay_fb', action='store_true', default=False, help='use delayed feedback')
+    parser.add_argument('--delayed_update', action='store_true', help='online phase forecasts every window at once and trains on it once its horizon has been observed (onenet_fsnet), not with --snapshot_every / --resume_from')
+    parser.add_argument('--update_thread', action='store_true', help='with --delayed_update, train a shadow model on a background thread and publish it to the serving one')
+    parser.add_argument('--update_backlog', type=int, default=1, help='windows that may wait for the update thread before the forecasts block, 0 is unbounded')
+    parser.add_argument('--online_adjust', type=float, default=0.0, help='latent dimension of koopman embedding')
+    parser.add_argument('--offline_adjust', type=float, default=0.0, help='latent dimension of koopman embedding')
+    parser.add_argument('--online_adjust_var', type=float, default=0.0, help='latent dimension of koopman embedding')
+    parser.add_argument('--var_weight', type=float, default=0.0, help='latent dimension of koopman embedding')
+    parser.add_argument('--detector', type=str, default='stepd', help='drift detector triggering the sleep stage, options:[stepd, adwin, page_hinkley, ddm, kswin]')
+    parser.add_argument('--detector_log', type=str, default=None, help='append every online loss seen by the detector to this file, for benchmarks/replay_detectors.py')
+    parser.add_argument('--alpha_w', type=float, default=0.0001, help='spectrum filter ratio')
+    parser.add_argument('--alpha_d', type=float, default=0.003, help='spectrum filter ratio')
+    parser.add_argument('--test_lr', type=float, default=0.1, help='spectrum filter ratio')
+    return parser
+
 
 data_parser = {
     'ETTh1':{'data':'ETTh1.csv','T':'OT','M':[7,7,7],'S':[1,1,1],'MS':[7,7,1]},
@@ -208,62 +239,105 @@ data_parser = {
     'Illness': {'data': 'national_illness.csv', 'T':'OT', 'M':[7,7,7]},
     'Traffic': {'data': 'traffic.csv', 'T':'OT', 'M':[862,862,862]},
     'finance': {'data': 'finance.csv', 'T': 'Close', 'M': [6, 6, 6], 'S': [1, 1, 1], 'MS': [6, 6, 1]},
+    # folders of ticker csvs; the header-less preprocessed files are named 0..12, the target 12 is the close price
+    'kdd17': {'data': 'kdd17/ourpped', 'T': '12', 'MS': [12, 12, 1]},
+    'stocknet': {'data': 'stocknet-dataset/price/ourpped', 'T': '12', 'MS': [12, 12, 1]},
 }
-if args.data in data_parser.keys():
-    data_info = data_parser[args.data]
-    args.data_path = data_info['data']
-    args.target = data_info['T']
-    args.enc_in, args.dec_in, args.c_out = data_info[args.features]
-
-args.s_layers = [int(s_l) for s_l in args.s_layers.replace(' ','').split(',')]
-args.detail_freq = args.freq
-args.freq = args.freq[-1:]
-
-print('Args in experiment:')
-print(args)
-
-#Exp = Exp_TS2VecSupervised
-Exp = getattr(importlib.import_module('exp.exp_{}'.format(args.method)), 'Exp_TS2VecSupervised')
-
-metrics ,preds, true, mae, mse = [], [], [], [], []
-
-for ii in range(args.itr):
-    print('\n ====== Run {} ====='.format(ii))
-    # setting record of experiments
-    #method_name = 'ts2vec_finetune' if args.finetune else 'ts2vec_supervised'
-    method_name = args.method
-    uid = uuid.uuid4().hex[:4]
-    suffix = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M") + "_" + uid
-    setting = '{}_{}_pl{}_ol{}_opt{}_tb{}_{}'.format(method_name, args.data, args.pred_len,args.online_learning, args.opt, args.test_bsz, suffix)
-
-    init_dl_program(args.gpu, seed=ii)
-    args.finetune_model_seed = ii
-    exp = Exp(args) # set experiments
-    print('>>>>>>>start training : {}>>>>>>>>>>>>>>>>>>>>>>>>>>'.format(setting))
-    print('Total parameters ', sum(p.numel() for p in exp.model.parameters() if p.requires_grad))
-    # exit()
-    exp.train(setting)
-    
-    print('>>>>>>>testing : {}<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'.format(setting))
-    m, mae_, mse_, p, t = exp.test(setting)
-    metrics.append(m)
-    if str(args.data) == 'Traffic':
-        preds=[0]
-        true=[0]
-    else:
-        preds.append(p)
-        true.append(t)
-
-    mae.append(mae_)
-    mse.append(mse_)
-    torch.cuda.empty_cache()
-
-folder_path = './results/' + setting + '/'
-if not os.path.exists(folder_path):
-    os.makedirs(folder_path)
-np.save(folder_path + 'metrics.npy', np.array(metrics))
-np.save(folder_path + 'preds.npy', np.array(preds))
-np.save(folder_path + 'trues.npy', np.array(true))
-np.save(folder_path + 'mae.npy', np.array(mae))
-np.save(folder_path + 'mse.npy', np.array(mse))
 
+
+def prepare_args(args):
+    """The settings main.py derives from the parsed arguments: device, test batch size, dataset shapes and frequencies."""
+    args.use_gpu = True if torch.cuda.is_available() and args.use_gpu else False
+    args.test_bsz = args.batch_size if args.test_bsz == -1 else args.test_bsz
+    if args.use_gpu and args.use_multi_gpu:
+        args.devices = args.devices.replace(' ','')
+        device_ids = args.devices.split(',')
+        args.device_ids = [int(id_) for id_ in device_ids]
+        args.gpu = args.device_ids[0]
+
+    if args.data in data_parser.keys():
+        data_info = data_parser[args.data]
+        args.data_path = data_info['data']
+        args.target = data_info['T']
+        args.enc_in, args.dec_in, args.c_out = data_info[args.features]
+
+    args.s_layers = [int(s_l) for s_l in args.s_layers.replace(' ','').split(',')]
+    args.detail_freq = args.freq
+    args.freq = args.freq[-1:]
+    return args
+
+
+def main():
+    parser = get_parser()
+    args = prepare_args(parser.parse_args())
+
+    print('Args in experiment:')
+    print(args)
+
+    #Exp = Exp_TS2VecSupervised
+    Exp = getattr(importlib.import_module('exp.exp_{}'.format(args.method)), 'Exp_TS2VecSupervised')
+    if args.stream_source and not hasattr(Exp, 'stream'):
+        # checked before training, which a live feed would otherwise only fail after
+        parser.error('--stream_source is not supported by --method {}, only by onenet_fsnet'.format(args.method))
+    if args.batched_windows and args.data in ('kdd17', 'stocknet'):
+        # WindowBatches strides over one series (data_x / data_y), a panel holds one per ticker
+        parser.error('--batched_windows is not supported by the panel datasets (--data kdd17 / stocknet)')
+    snapshot_flags = args.resume_from or args.snapshot_every
+    if snapshot_flags and not getattr(Exp, 'online_snapshots', False):
+        # --resume_from skips train(), the snapshot is the only source of the model
+        parser.error('--resume_from / --snapshot_every are not supported by --method {}, only by onenet_fsnet, fsnet, '
+                     'fsnet_d3a and onenet_d3a'.format(args.method))
+    if snapshot_flags and (args.lockstep or args.stream_source):
+        parser.error('--resume_from / --snapshot_every only apply to the test() loop, not to --lockstep or --stream_source')
+    if snapshot_flags and args.delayed_update:
+        # a snapshot holds neither the windows waiting for their labels nor the shadow copy of the update thread
+        parser.error('--delayed_update can not be snapshotted or resumed: no --snapshot_every / --resume_from')
+
+    metrics, mae, mse = [], [], []
+
+    for ii in range(args.itr):
+        print('\n ====== Run {} ====='.format(ii))
+        # setting record of experiments
+        #method_name = 'ts2vec_finetune' if args.finetune else 'ts2vec_supervised'
+        method_name = args.method
+        uid = uuid.uuid4().hex[:4]
+        suffix = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M") + "_" + uid
+        setting = '{}_{}_pl{}_ol{}_opt{}_tb{}_{}'.format(method_name, args.data, args.pred_len,args.online_learning, args.opt, args.test_bsz, suffix)
+
+        init_dl_program(args.gpu if args.use_gpu else 'cpu', seed=ii, max_threads=args.threads)
+        args.finetune_model_seed = ii
+        exp = Exp(args) # set experiments
+        print('>>>>>>>start training : {}>>>>>>>>>>>>>>>>>>>>>>>>>>'.format(setting))
+        print('Total parameters ', sum(p.numel() for p in exp.model.parameters() if p.requires_grad))
+        # exit()
+        if args.resume_from:
+            # the snapshot holds the trained and adapted model, only the online phase is left
+            print('>>>>>>>skipping training, resuming from : {}'.format(args.resume_from))
+        else:
+            exp.train(setting)
+
+        if args.stream_source:
+            print('>>>>>>>streaming : {}<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'.format(setting))
+            metrics.append(exp.stream(setting))
+            # a live feed is consumed once
+            break
+
+        print('>>>>>>>testing : {}<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'.format(setting))
+        # the predictions are written to ./results/<setting>/ by the test loop as they are made
+        m, mae_, mse_, p, t = exp.test(setting)
+        metrics.append(m)
+
+        mae.append(mae_)
+        mse.append(mse_)
+        torch.cuda.empty_cache()
+
+    folder_path = './results/' + setting + '/'
+    if not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+    np.save(folder_path + 'metrics.npy', np.array(metrics))
+    np.save(folder_path + 'mae.npy', np.array(mae))
+    np.save(folder_path + 'mse.npy', np.array(mse))
+
+
+if __name__ == '__main__':
+    main()
@@ -31,7 +31,7 @@ class SamePadConv(nn.Module):
         self.n_chunks = in_channels
         self.chunk_in_d = self.dim // self.n_chunks
         self.chunk_out_d = int(in_channels*kernel_size// self.n_chunks)
-        self.grads = torch.Tensor(sum(self.grad_dim)).fill_(0).cuda()
+        self.register_buffer('grads', torch.zeros(sum(self.grad_dim)), persistent=False)
         nh=64
         self.controller = nn.Sequential(nn.Linear(self.chunk_in_d, nh), nn.SiLU())
         self.calib_w = nn.Linear(nh, self.chunk_out_d)
@@ -33,7 +33,7 @@ def generate_binomial_mask(B, T, p=0.5):
 
 
 class TSEncoder(nn.Module):
-    def __init__(self, input_dims, output_dims, hidden_dims=64, depth=10, mask_mode='binomial', gamma=0.9):
+    def __init__(self, input_dims, output_dims, hidden_dims=64, depth=10, mask_mode='binomial', gamma=0.9, causal=False):
         super().__init__()
         self.input_dims = input_dims
         self.output_dims = output_dims
@@ -43,7 +43,7 @@ class TSEncoder(nn.Module):
         self.feature_extractor = DilatedConvEncoder(
             hidden_dims,
             [hidden_dims] * depth + [output_dims],
-            kernel_size=3, gamma=gamma
+            kernel_size=3, gamma=gamma, causal=causal
         )
         self.repr_dropout = nn.Dropout(p=0.1)
 
@@ -56,7 +56,7 @@ class TSEncoder(nn.Module):
     def forward_time(self, x, mask=None):  # x: B x T x input_dims
         x = x.transpose(1, 2)
         nan_mask = ~x.isnan().any(axis=-1)
-        x[~nan_mask] = 0
+        x.masked_fill_(~nan_mask.unsqueeze(-1), 0)  # not x[~nan_mask] = 0, which vmap can not batch
         x = self.input_fc(x)  # B x T x Ch
         
         # generate & apply mask
@@ -78,8 +78,8 @@ class TSEncoder(nn.Module):
             mask = x.new_full((x.size(0), x.size(1)), True, dtype=torch.bool)
             mask[:, -1] = False
         
-        mask &= nan_mask
-        x[~mask] = 0
+        mask = mask & nan_mask
+        x.masked_fill_(~mask.unsqueeze(-1), 0)
         
         # conv encoder
         x = x.transpose(1, 2)  # B x Ch x T
@@ -89,7 +89,7 @@ class TSEncoder(nn.Module):
         return x
     def forward(self, x, mask=None):  # x: B x T x input_dims
             nan_mask = ~x.isnan().any(axis=-1)
-            x[~nan_mask] = 0
+            x.masked_fill_(~nan_mask.unsqueeze(-1), 0)
             x = self.input_fc(x)  # B x T x Ch
             
             # generate & apply mask
@@ -111,8 +111,8 @@ class TSEncoder(nn.Module):
                 mask = x.new_full((x.size(0), x.size(1)), True, dtype=torch.bool)
                 mask[:, -1] = False
             
-            mask &= nan_mask
-            x[~mask] = 0
+            mask = mask & nan_mask
+            x.masked_fill_(~mask.unsqueeze(-1), 0)
             
             # conv encoder
             x = x.transpose(1, 2)  # B x Ch x T
@@ -120,6 +120,25 @@ class TSEncoder(nn.Module):
             x = x.transpose(1, 2)  # B x T x Co
             
             return x
+
+    def prime(self, x, mask=None):
+        # forward over a window that leaves the causal convs ready for forward_step
+        self.feature_extractor.caching(True)
+        try:
+            return self.forward(x, mask)
+        finally:
+            self.feature_extractor.caching(False)
+
+    def forward_step(self, x):  # x: B x 1 x input_dims, the time step right after the last one seen
+        nan_mask = ~x.isnan().any(axis=-1)
+        x[~nan_mask] = 0
+        x = self.input_fc(x)  # B x 1 x Ch
+        x[~nan_mask] = 0
+
+        x = x.transpose(1, 2)  # B x Ch x 1
+        x = self.repr_dropout(self.feature_extractor.step(x))  # B x Co x 1
+        return x.transpose(1, 2)  # B x 1 x Co
+
 class BandedFourierLayer(nn.Module):
 
     def __init__(self, in_channels, out_channels, band, num_bands, freq_mixing=False, bias=True, length=201):
@@ -12,11 +12,45 @@ def normalize(W):
     W = W/ W_norm
     return W
 
+def memory_read(W, q, w, b, f, tau):
+    """
+    The associative memory of SamePadConv on a trigger: reads the two slots of W closest
+    to the controller output q, blends them into w, b, f and writes q's attention back.
+    Returns the new w, b, f and W.
+    """
+    dim = w.size(0)
+    # read
+    att = q @ W
+    att = F.softmax(att/0.5, dim=0)
+
+    v, idx = torch.topk(att, 2)
+    ww = torch.index_select(W, 1, idx)
+    old_w = ww @ idx.unsqueeze(1).float()
+    # write memory
+    s_att = torch.zeros_like(att).scatter(0, idx, v)
+    new_w = old_w @ s_att.unsqueeze(0)
+    mask = torch.ones_like(W).scatter(1, idx.unsqueeze(0).expand(W.size(0), -1), tau)
+    W = normalize(mask * W + (1-mask) * new_w)
+    # retrieve
+    ll = torch.split(old_w, dim)
+    nw,nb, nf = w.size(1), b.size(1), f.size(1)
+    o_w, o_b, o_f = torch.cat(ll[:nw]), torch.cat(ll[nw:nw+nb]), torch.cat(ll[-nf:])
+
+    w = tau * w + (1-tau)*o_w.view(w.size())
+    b = tau * b + (1-tau)*o_b.view(b.size())
+    f = tau * f + (1-tau)*o_f.view(f.size())
+    return w, b, f, W
+
 class SamePadConv(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel_size, dilation=1, groups=1, gamma=0.9):
+    def __init__(self, in_channels, out_channels, kernel_size, dilation=1, groups=1, gamma=0.9, causal=False):
         super().__init__()
         self.receptive_field = (kernel_size - 1) * dilation + 1
         padding = self.receptive_field // 2
+        # causal: all the padding goes to the left and is applied in forward, so the
+        # output at t only sees inputs up to t and can be computed incrementally by step
+        self.causal = causal
+        if causal:
+            padding = 0
         self.conv = nn.Conv1d(
             in_channels, out_channels, kernel_size,
             padding=padding,
@@ -40,8 +74,10 @@ class SamePadConv(nn.Module):
         self.chunk_in_d = self.dim // self.n_chunks
         self.chunk_out_d = int(in_channels*kernel_size// self.n_chunks)
         
-        self.grads = torch.Tensor(sum(self.grad_dim)).fill_(0).cuda()
-        self.f_grads = torch.Tensor(sum(self.grad_dim)).fill_(0).cuda()
+        # runtime state, follows model.to(device) but stays out of the checkpoints as before
+        self.register_buffer('grads', torch.zeros(sum(self.grad_dim)), persistent=False)
+        self.register_buffer('f_grads', torch.zeros(sum(self.grad_dim)), persistent=False)
+        self.register_buffer('q_ema', None, persistent=False)
         nh=64
         self.controller = nn.Sequential(nn.Linear(self.chunk_in_d, nh), nn.SiLU())
         self.calib_w = nn.Linear(nh, self.chunk_out_d)
@@ -63,6 +99,14 @@ class SamePadConv(nn.Module):
         self.cos = nn.CosineSimilarity(dim=0, eps=1e-6)
         self.trigger = 0
         self.tau = 0.75
+        self.caching = False
+        self.queue = None
+        # calibration cache, see calibrated
+        self.calib_cache = False
+        self.calib = None
+        self.grad_version = 0
+        # (weight, bias, scale) computed by the caller, used instead of calibrated's own, see chunks
+        self.calib_given = None
     def ctrl_params(self):
         c_iter = chain(self.controller.parameters(), self.calib_w.parameters(), 
                 self.calib_b.parameters(), self.calib_f.parameters())
@@ -71,76 +115,136 @@ class SamePadConv(nn.Module):
 
     def store_grad(self):
         #print('storing grad')
+        if self.conv.weight.grad is None:
+            # frozen layer, e.g. the encoder with online_learning='regressor'
+            return
+        self.grad_version += 1
         grad = self.conv.weight.grad.data.clone()
         grad = nn.functional.normalize(grad)
         grad = grad.view(-1)
-        self.f_grads = self.f_gamma * self.f_grads + (1-self.f_gamma) * grad
+        # in place, grads and f_grads may be views into a PadConvRegistry arena
+        self.f_grads.copy_(self.f_gamma * self.f_grads + (1-self.f_gamma) * grad)
         if not self.training: 
             e = self.cos(self.f_grads, self.grads)
             
             if e < -self.tau:
                 self.trigger = 1
-        self.grads = self.gamma * self.grads + (1-self.gamma) * grad
+        self.grads.copy_(self.gamma * self.grads + (1-self.gamma) * grad)
         
     def fw_chunks(self):
-        x = self.grads.view(self.n_chunks, -1)
+        trigger, self.trigger = self.trigger, 0
+        w, b, f, self.q_ema, W = self.chunks(self.grads, self.q_ema, trigger)
+        if trigger == 1:
+            self.W.data = W
+        return w, b, f
+
+    def chunks(self, grads, q_ema, trigger):
+        """
+        fw_chunks for the gradient EMA grads and the smoothed controller output q_ema,
+        without touching the layer's state: returns w, b, f, the new q_ema and the
+        memory W, rewritten by the read when trigger is 1. trigger may also be a bool
+        tensor, with one flag per ticker under vmap (see exp_onenet_fsnet's lockstep
+        phase), the memory read is then kept where it is set.
+        """
+        x = grads.view(self.n_chunks, -1)
         rep = self.controller(x)
         w = self.calib_w(rep)
         b = self.calib_b(rep)
         f = self.calib_f(rep)
         q = torch.cat([w.view(-1), b.view(-1), f.view(-1)])
-        if not hasattr(self, 'q_ema'):
-            setattr(self, 'q_ema', torch.zeros(*q.size()).float().cuda())
+        if q_ema is None:
+            q_ema = torch.zeros(*q.size(), device=q.device)
         else:
-            self.q_ema = self.f_gamma * self.q_ema + (1-self.f_gamma)*q
-            q = self.q_ema
-        if self.trigger == 1:
-            dim = w.size(0)
-            self.trigger = 0
-            # read
-            
-            att = q @ self.W
-            att = F.softmax(att/0.5)
-            
-            v, idx = torch.topk(att, 2)
-            ww = torch.index_select(self.W, 1, idx)
-            idx = idx.unsqueeze(1).float()
-            old_w = ww @ idx
-            # write memory
-            s_att = torch.zeros(att.size(0)).cuda()
-            s_att[idx.squeeze().long()] = v.squeeze()
-            W = old_w @ s_att.unsqueeze(0)
-            mask = torch.ones(W.size()).cuda()
-            mask[:, idx.squeeze().long()] = self.tau
-            self.W.data = mask * self.W.data + (1-mask) * W
-            self.W.data = normalize(self.W.data)   
-            # retrieve
-            ll = torch.split(old_w, dim)
-            nw,nb, nf = w.size(1), b.size(1), f.size(1)
-            o_w, o_b, o_f = torch.cat(*[ll[:nw]]), torch.cat(*[ll[nw:nw+nb]]), torch.cat(*[ll[-nf:]])
-            
-            try:
-                w = self.tau * w + (1-self.tau)*o_w.view(w.size())
-                b = self.tau * b + (1-self.tau)*o_b.view(b.size())
-                f = self.tau * f + (1-self.tau)*o_f.view(f.size())
-            except:
-                pdb.set_trace()
+            q_ema = self.f_gamma * q_ema + (1-self.f_gamma)*q
+            q = q_ema
+        W = self.W
+        if torch.is_tensor(trigger):
+            mw, mb, mf, mW = memory_read(W, q, w, b, f, self.tau)
+            w, b, f = torch.where(trigger, mw, w), torch.where(trigger, mb, b), torch.where(trigger, mf, f)
+            W = torch.where(trigger, mW, W)
+        elif trigger == 1:
+            w, b, f, W = memory_read(W, q, w, b, f, self.tau)
         f = f.view(-1).unsqueeze(0).unsqueeze(2)
-       
-        return w.unsqueeze(0) ,b.view(-1),f
 
-    def forward(self, x):
+        return w.unsqueeze(0), b.view(-1), f, q_ema, W
+
+    def _calib_key(self):
+        return (self.grad_version, self.trigger,
+                tuple((p.data_ptr(), p._version) for p in self.parameters()))
+
+    def calibrated(self):
+        """
+        Calibrated conv weight, bias and output scale from fw_chunks. With calib_cache
+        they are reused until store_grad, a memory trigger or an update of any parameter
+        of the layer, as long as no gradient has to flow through them. q_ema then moves
+        once per cached version instead of once per forward; in the online phase, with
+        one forward per gradient update, that is the same.
+        """
+        if self.calib_given is not None:
+            return self.calib_given
+        if self.calib_cache:
+            key = self._calib_key()
+            needs_grad = torch.is_grad_enabled() and any(p.requires_grad for p in self.parameters())
+            if not needs_grad and self.calib is not None and self.calib[0] == key:
+                return self.calib[1]
+        trigger = self.trigger
         w,b,f = self.fw_chunks()
-        d0, d1 = self.conv.weight.shape[1:]
-        
-        cw = self.conv.weight * w
-        #cw = self.conv.weight
+        out = (self.conv.weight * w, self.bias * b, f)
+        if self.calib_cache:
+            # a memory read rewrites W, the next call computes something else
+            self.calib = None if trigger else (key, out)
+        return out
+
+    def export(self):
+        """Plain Conv1d with the current calibration folded into its weight and bias, for frozen inference."""
+        with torch.no_grad():
+            cw, cb, f = self.calibrated()
+            f = f.view(-1)
+            conv = nn.Conv1d(self.in_channels, self.out_features, self.kernel_size,
+                             padding=self.padding, dilation=self.dilation, groups=self.conv.groups).to(cw.device)
+            conv.weight.copy_(cw * f.view(-1, 1, 1))
+            conv.bias.copy_(cb * f)
+        if self.causal:
+            return nn.Sequential(nn.ConstantPad1d((self.receptive_field - 1, 0), 0.), conv)
+        return conv
+
+    def forward(self, x):
+        cw, cb, f = self.calibrated()
+        if self.causal:
+            if self.caching:
+                self.prime_queue(x)
+            x = F.pad(x, (self.receptive_field - 1, 0))
         try:
-            conv_out = F.conv1d(x, cw, padding=self.padding, dilation=self.dilation, bias = self.bias * b)
+            conv_out = F.conv1d(x, cw, padding=self.padding, dilation=self.dilation, bias = cb)
             out =  f * conv_out
         except: pdb.set_trace()
         return out
 
+    def prime_queue(self, x):
+        """
+        Keeps the last receptive_field input columns of x (B x C x T) for step, in a ring
+        where the column of time t sits at t % receptive_field. Times before the start
+        of x are zeros, like the causal padding.
+        """
+        rf = self.receptive_field
+        self.t = x.size(2)
+        self.queue = F.pad(x.detach(), (rf, 0))[:, :, -rf:].roll(self.t % rf, dims=2).contiguous()
+
+    def step(self, x):
+        """
+        Output for one new column x (B x C x 1) of a causal conv primed with prime_queue:
+        the kernel taps read the queued columns, so the cost does not depend on the
+        length of the window. Only the new column carries gradients.
+        """
+        cw, cb, f = self.calibrated()
+        rf = self.receptive_field
+        taps = [(self.t - j * self.dilation) % rf for j in range(self.kernel_size - 1, 0, -1)]
+        past = self.queue.index_select(2, torch.tensor(taps, device=x.device))
+        conv_out = F.conv1d(torch.cat([past, x], dim=2), cw, bias = cb)
+        self.queue[:, :, self.t % rf] = x.detach()[:, :, 0]
+        self.t += 1
+        return f * conv_out
+
     def representation(self, x):
         out = self.conv(x)
         if self.remove > 0:
@@ -153,11 +257,126 @@ class SamePadConv(nn.Module):
             out = out[:, :, : -self.remove]
         return out
     
+class PadConvRegistry():
+    """
+    The SamePadConv layers of one or more modules, collected once. Their grads and
+    f_grads become views into two flat arenas, ordered so that layers with the same
+    weight shape are adjacent, and store_grad runs the normalize, the EMA updates and
+    the cosine trigger test of all layers as a few batched ops, with one host sync
+    for the triggers instead of one per layer.
+    """
+    def __init__(self, *modules):
+        self.layers, self.segments = [], []
+        for module in modules:
+            layers = [layer for layer in module.modules() if isinstance(layer, SamePadConv)]
+            shapes = list(dict.fromkeys(tuple(layer.conv.weight.shape) for layer in layers))
+            layers.sort(key=lambda layer: shapes.index(tuple(layer.conv.weight.shape)))
+            self.segments.append((len(self.layers), len(self.layers) + len(layers)))
+            self.layers += layers
+        if self.layers:
+            self._bind()
+
+    def _bind(self):
+        sizes = [layer.dim for layer in self.layers]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).tolist()
+        self.grads = torch.cat([layer.grads for layer in self.layers])
+        self.f_grads = torch.cat([layer.f_grads for layer in self.layers])
+        self.scratch = torch.empty_like(self.grads)
+        for layer, grads, f_grads in zip(self.layers, self.grads.split(sizes), self.f_grads.split(sizes)):
+            layer.grads, layer.f_grads = grads, f_grads
+        self.tau = torch.tensor([layer.tau for layer in self.layers], device=self.grads.device)
+        self.gamma = self._per_element([layer.gamma for layer in self.layers], sizes)
+        self.f_gamma = self._per_element([layer.f_gamma for layer in self.layers], sizes)
+        self.eps = self.layers[0].cos.eps
+        self._blocks = {}
+
+    def _per_element(self, values, sizes):
+        # a python float when all layers agree, which keeps the update identical to SamePadConv.store_grad
+        if len(set(values)) == 1:
+            return values[0]
+        return torch.repeat_interleave(torch.tensor(values, device=self.grads.device), torch.tensor(sizes, device=self.grads.device))
+
+    def blocks(self, a, b):
+        """(first layer, last layer + 1, weight shape) of the runs of equal shapes in layers a..b."""
+        if (a, b) not in self._blocks:
+            blocks = []
+            for i in range(a, b):
+                shape = tuple(self.layers[i].conv.weight.shape)
+                if blocks and blocks[-1][2] == shape:
+                    blocks[-1][1] = i + 1
+                else:
+                    blocks.append([i, i + 1, shape])
+            self._blocks[(a, b)] = blocks
+        return self._blocks[(a, b)]
+
+    def _store(self, a, b):
+        # block by block: each block is a handful of ops and stays in cache between them
+        fired = []
+        for start, end, shape in self.blocks(a, b):
+            lo, hi = self.offsets[start], self.offsets[end]
+            gamma = self.gamma if isinstance(self.gamma, float) else self.gamma[lo:hi]
+            f_gamma = self.f_gamma if isinstance(self.f_gamma, float) else self.f_gamma[lo:hi]
+            grads, f_grads, grad = self.grads[lo:hi], self.f_grads[lo:hi], self.scratch[lo:hi]
+            # F.normalize of every layer gradient in the block at once
+            block = grad.view(end - start, *shape)
+            torch.stack([layer.conv.weight.grad for layer in self.layers[start:end]], out=block)
+            block.div_(block.norm(2, 2, keepdim=True).clamp_min(1e-12))
+
+            f_grads.copy_(f_gamma * f_grads + (1-f_gamma) * grad)
+            if not all(layer.training for layer in self.layers[start:end]):
+                x, y = f_grads.view(end - start, -1), grads.view(end - start, -1)
+                e = (x * y).sum(1) / (x.norm(dim=1) * y.norm(dim=1)).clamp_min(self.eps)
+                fired.append((start, e < -self.tau[start:end]))
+            grads.copy_(gamma * grads + (1-gamma) * grad)
+
+        if fired:
+            # one host sync for all the layers in eval mode
+            layers = [layer for start, f in fired for layer in self.layers[start:start + len(f)]]
+            for layer, fire in zip(layers, torch.cat([f for _, f in fired]).tolist()):
+                if fire and not layer.training:
+                    layer.trigger = 1
+        for layer in self.layers[a:b]:
+            layer.grad_version += 1
+
+    def store_grad(self, segments=None):
+        """SamePadConv.store_grad for every layer, or for the layers of the given module indices."""
+        if self.layers and self.layers[0].grads.data_ptr() != self.grads.data_ptr():
+            # model.to(device) replaced the buffers, the arenas follow them
+            self._bind()
+        if segments is None and self.layers and all(layer.conv.weight.grad is not None for layer in self.layers):
+            self._store(0, len(self.layers))
+            return
+        for index, (a, b) in enumerate(self.segments):
+            if segments is not None and index not in segments:
+                continue
+            has_grad = [layer.conv.weight.grad is not None for layer in self.layers[a:b]]
+            if all(has_grad) and b > a:
+                self._store(a, b)
+            elif any(has_grad):
+                for layer in self.layers[a:b]:
+                    layer.store_grad()
+
+def set_calibration_cache(module, on=True):
+    for layer in module.modules():
+        if isinstance(layer, SamePadConv):
+            layer.calib_cache = on
+            layer.calib = None
+
+
+def freeze_calibration(module):
+    """Replaces every SamePadConv in module by its export(), in place. The result no longer adapts."""
+    for name, child in module.named_children():
+        if isinstance(child, SamePadConv):
+            setattr(module, name, child.export())
+        else:
+            freeze_calibration(child)
+    return module
+
 class ConvBlock(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel_size, dilation, final=False, gamma=0.9):
+    def __init__(self, in_channels, out_channels, kernel_size, dilation, final=False, gamma=0.9, causal=False):
         super().__init__()
-        self.conv1 = SamePadConv(in_channels, out_channels, kernel_size, dilation=dilation, gamma=gamma)
-        self.conv2 = SamePadConv(out_channels, out_channels, kernel_size, dilation=dilation, gamma=gamma)
+        self.conv1 = SamePadConv(in_channels, out_channels, kernel_size, dilation=dilation, gamma=gamma, causal=causal)
+        self.conv2 = SamePadConv(out_channels, out_channels, kernel_size, dilation=dilation, gamma=gamma, causal=causal)
         self.projector = nn.Conv1d(in_channels, out_channels, 1) if in_channels != out_channels or final else None
     
     def ctrl_params(self):  
@@ -178,16 +397,25 @@ class ConvBlock(nn.Module):
         x = self.conv2(x)
         return x + residual
 
+    def step(self, x):
+        residual = x if self.projector is None else self.projector(x)
+        x = F.gelu(x)
+        x = self.conv1.step(x)
+        x = F.gelu(x)
+        x = self.conv2.step(x)
+        return x + residual
+
 class DilatedConvEncoder(nn.Module):
-    def __init__(self, in_channels, channels, kernel_size, gamma=0.9):
+    def __init__(self, in_channels, channels, kernel_size, gamma=0.9, causal=False):
         super().__init__()
+        self.causal = causal
         self.net = nn.Sequential(*[
             ConvBlock(
                 channels[i-1] if i > 0 else in_channels,
                 channels[i],
                 kernel_size=kernel_size,
                 dilation=2**i,
-                final=(i == len(channels)-1), gamma=gamma
+                final=(i == len(channels)-1), gamma=gamma, causal=causal
             )
             for i in range(len(channels))
         ])
@@ -200,3 +428,47 @@ class DilatedConvEncoder(nn.Module):
             yield p
     def forward(self, x):
         return self.net(x)
+
+    def convs(self):
+        for l in self.net:
+            yield l.conv1
+            yield l.conv2
+
+    @property
+    def receptive_field(self):
+        # inputs, up to and including the newest, that the last output column depends on
+        return 1 + sum(conv.receptive_field - 1 for conv in self.convs())
+
+    def caching(self, on):
+        # while on, forward also fills the activation queue of every conv for step
+        assert self.causal or not on, 'incremental encoding needs causal=True'
+        for conv in self.convs():
+            conv.caching = on
+
+    def prime(self, x):
+        self.caching(True)
+        try:
+            return self.net(x)
+        finally:
+            self.caching(False)
+
+    def reset(self):
+        for conv in self.convs():
+            conv.queue = None
+
+    def primed(self, batch_size):
+        queue = self.net[0].conv1.queue
+        return queue is not None and queue.size(0) == batch_size
+
+    def step(self, x):
+        """
+        Output for one new time step x (B x C x 1) after prime. Each layer reads its
+        earlier inputs from its queue (fast-wavenet style), so a step costs O(depth)
+        instead of O(depth * T). It equals the last column of forward over the
+        newest window of T >= receptive_field steps, as long as the weights did
+        not change meanwhile; over a shorter window forward zero-pads the history
+        that the queues still hold.
+        """
+        for l in self.net:
+            x = l.step(x)
+        return x
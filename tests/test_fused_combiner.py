@@ -0,0 +1,60 @@
+"""
+--fused_combiner against the three pass online step of onenet_fsnet: from the same
+state, _ol_fused_batch and _ol_full_batch leave the same parameters and optimizer
+moments behind.
+
+    python -m pytest -q tests
+"""
+import copy
+
+import pytest
+import torch
+
+from benchmarks.common import make_args, make_exp, synthetic_windows
+
+
+def params(exp):
+    named = [('model.' + n, p) for n, p in exp.model.named_parameters()]
+    named += [('decision.' + n, p) for n, p in exp.decision.named_parameters()]
+    return named + [('weight', exp.weight)]
+
+
+def moments(exp, opts):
+    """Optimizer state of every parameter that has one, whichever of opts holds it."""
+    out = {}
+    for name, p in params(exp):
+        for opt in opts:
+            # the fused optimizer holds an empty state for the params that never got a gradient
+            if opt.state.get(p):
+                out[name] = opt.state[p]
+    return out
+
+
+@pytest.mark.parametrize('individual', [0, 1])
+def test_fused_matches_three_passes(individual):
+    torch.manual_seed(0)
+    args = make_args('onenet_fsnet', use_gpu=False, features='M', enc_in=7, dec_in=7, c_out=7, individual=individual)
+    full = make_exp(args)
+    fused = copy.deepcopy(full)
+    fused.args = copy.copy(args)
+    fused.args.fused_combiner = True
+    fused.opt_fused = fused._fuse_optimizers()
+
+    windows = synthetic_windows(args, 3)
+    outputs = []
+    for exp in (full, fused):
+        # same dropout masks in the decision MLP
+        torch.manual_seed(1)
+        outputs.append([exp._ol_one_batch(None, *window)[0].detach() for window in windows])
+    for a, b in zip(*outputs):
+        torch.testing.assert_close(b, a)
+
+    for (name, a), (_, b) in zip(params(full), params(fused)):
+        torch.testing.assert_close(b, a, msg=name)
+    torch.testing.assert_close(fused.bias, full.bias)
+    full_moments = moments(full, (full.opt, full.opt_bias, full.opt_w))
+    fused_moments = moments(fused, (fused.opt_fused,))
+    assert set(full_moments) == set(fused_moments) and full_moments
+    for name, state in full_moments.items():
+        for key, value in state.items():
+            torch.testing.assert_close(fused_moments[name][key], value, msg='{} {}'.format(name, key))
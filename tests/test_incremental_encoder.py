@@ -0,0 +1,62 @@
+"""
+The incremental step of the causal FSNet encoder against re-encoding the current
+window, as the online phase does without --incremental_encoder.
+
+    python -m pytest -q tests
+"""
+import copy
+import pytest
+import torch
+
+from models.ts2vec.fsnet import TSEncoder
+
+
+def make_encoder(depth):
+    torch.manual_seed(0)
+    encoder = TSEncoder(input_dims=5, output_dims=16, hidden_dims=8, depth=depth, causal=True).eval()
+    # a fresh calibration scales the convs to almost nothing and leaves only the residual
+    # path, the plain weights make every tap of every layer count
+    with torch.no_grad():
+        for conv in encoder.feature_extractor.convs():
+            w, b, f = conv.calibrated()
+            conv.calib_given = (conv.conv.weight.detach(), torch.randn_like(b) * 0.1, torch.ones_like(f))
+    return encoder
+
+
+def run(encoder, x, seq_len, steps):
+    """Last column of the windowed forward and of the incremental step, for every step after the first window."""
+    full, incremental = copy.deepcopy(encoder), copy.deepcopy(encoder)
+    pairs = []
+    with torch.no_grad():
+        full(x[:, :seq_len].clone(), mask='all_true')
+        incremental.prime(x[:, :seq_len].clone(), mask='all_true')
+        for s in range(1, steps + 1):
+            y_full = full(x[:, s:seq_len + s].clone(), mask='all_true')[:, -1]
+            y_step = incremental.forward_step(x[:, seq_len + s - 1:seq_len + s].clone())[:, -1]
+            pairs.append((y_full, y_step))
+    return pairs
+
+
+def test_step_matches_window():
+    encoder = make_encoder(depth=3)
+    seq_len = encoder.feature_extractor.receptive_field
+    x = torch.randn(2, seq_len + 20, 5)
+    for y_full, y_step in run(encoder, x, seq_len, 20):
+        torch.testing.assert_close(y_step, y_full, rtol=1e-4, atol=1e-5)
+
+
+def test_step_keeps_history_beyond_short_window():
+    # the queues still hold what forward zero-pads: a window below the receptive field can not match
+    encoder = make_encoder(depth=3)
+    seq_len = encoder.feature_extractor.receptive_field // 2
+    x = torch.randn(2, seq_len + 20, 5)
+    y_full, y_step = run(encoder, x, seq_len, 20)[-1]
+    assert not torch.allclose(y_step, y_full, atol=1e-5)
+
+
+def test_exp_rejects_short_window():
+    from benchmarks.common import make_args
+    from exp.exp_onenet_fsnet import Exp_TS2VecSupervised
+    args = make_args('onenet_fsnet', use_gpu=False, causal_conv=True, incremental_encoder=True, seq_len=96)
+    with pytest.raises(ValueError):
+        Exp_TS2VecSupervised(args)
@@ -0,0 +1,76 @@
+"""
+StreamingMetrics against metric() on the inverse-scaled numpy arrays.
+
+    python -m pytest -q tests
+"""
+import pickle
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from utils.metrics import StreamingMetrics, metric
+
+
+def make_data(columns):
+    mean = np.arange(1, columns + 1, dtype=np.float32) * 10
+    std = np.arange(1, columns + 1, dtype=np.float32)
+    return SimpleNamespace(scaler=SimpleNamespace(mean=mean, std=std), scale=True)
+
+
+def expected(preds, trues, data, c_out, pred_len):
+    mean, std = data.scaler.mean[-c_out:], data.scaler.std[-c_out:]
+    values = []
+    for pred, true in zip(preds, trues):
+        pred = pred.numpy().reshape(len(pred), pred_len, c_out) * std + mean
+        true = true.numpy().reshape(len(true), pred_len, c_out) * std + mean
+        values.append(metric(pred, true))
+    return np.mean(values, axis=0)
+
+
+@pytest.mark.parametrize('c_out', [1, 3])
+@pytest.mark.parametrize('pred_len', [1, 4])
+def test_inverse_flattened_horizon(c_out, pred_len):
+    torch.manual_seed(0)
+    # MS/S scale the inputs on 3 columns and predict the last one
+    data = make_data(3)
+    preds = [torch.randn(2, pred_len * c_out) for _ in range(5)]
+    trues = [torch.randn(2, pred_len * c_out) for _ in range(5)]
+    metrics = StreamingMetrics(sync_every=2, data=data, c_out=c_out)
+    for pred, true in zip(preds, trues):
+        metrics.update(pred, true)
+    np.testing.assert_allclose(metrics.mean(), expected(preds, trues, data, c_out, pred_len), rtol=1e-5)
+
+
+def test_inverse_unflattened():
+    torch.manual_seed(0)
+    data = make_data(3)
+    pred, true = torch.randn(2, 4, 3), torch.randn(2, 4, 3)
+    metrics = StreamingMetrics(data=data, c_out=3)
+    metrics.update(pred, true)
+    np.testing.assert_allclose(metrics.mean(), expected([pred], [true], data, 3, 4), rtol=1e-5)
+
+
+def test_inverse_rejects_partial_horizon():
+    metrics = StreamingMetrics(data=make_data(3), c_out=3)
+    with pytest.raises(ValueError):
+        metrics.update(torch.randn(2, 7), torch.randn(2, 7))
+
+
+def test_inverse_rejects_unscaled_targets():
+    data = make_data(3)
+    data.target_scaled = False
+    with pytest.raises(ValueError):
+        StreamingMetrics(data=data, c_out=1)
+
+
+def test_pickle_keeps_inverse():
+    torch.manual_seed(0)
+    data = make_data(3)
+    pred, true = torch.randn(2, 8), torch.randn(2, 8)
+    metrics = StreamingMetrics(data=data, c_out=2)
+    metrics.update(pred, true)
+    restored = pickle.loads(pickle.dumps(metrics))
+    restored.update(pred, true)
+    np.testing.assert_allclose(restored.mean(), expected([pred], [true], data, 2, 4), rtol=1e-5)
@@ -0,0 +1,31 @@
+"""
+The OneNet online step under --features MS: every input channel goes in, only
+the target (the last channel) is forecast, trained on and scored.
+
+    python -m pytest -q tests
+"""
+import pytest
+import torch
+
+from benchmarks.common import make_args, make_exp, synthetic_windows
+
+# the methods whose time-axis branch forecasts every input channel
+METHODS = ['onenet_fsnet', 'onenet_tcn', 'onenet_tcn_minus', 'onenet_d3a', 'onenet_egd', 'onenet_gate',
+           'onenet_weight', 'onenet_linear_regression', 'patch_fsnet_time', 'patch_tcn_time']
+
+
+@pytest.mark.parametrize('individual', [0, 1])
+@pytest.mark.parametrize('method', METHODS)
+def test_ms_forecasts_the_target(method, individual):
+    torch.manual_seed(0)
+    args = make_args(method, use_gpu=False, features='MS', enc_in=3, dec_in=3, c_out=1, seq_len=48,
+                     pred_len=2, individual=individual)
+    exp = make_exp(args)
+    if method == 'onenet_linear_regression':
+        # a weight pair per output, not make_exp's combiner weight
+        exp.weight = torch.full((args.c_out, 2) if individual else (2,), 0.5)
+    for batch_x, batch_y, batch_x_mark, batch_y_mark in synthetic_windows(args, 3):
+        pred, true = exp._process_one_batch(None, batch_x, batch_y, batch_x_mark, batch_y_mark, mode='test')
+        assert pred.shape == true.shape == (1, args.pred_len)
+        torch.testing.assert_allclose(true.cpu(), batch_y[:, -args.pred_len:, -1].float())
+        assert torch.isfinite(pred).all()
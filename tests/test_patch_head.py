@@ -0,0 +1,22 @@
+"""
+The per-channel (individual) Flatten_Head_TCN against the shared head with the
+same weights.
+
+    python -m pytest -q tests
+"""
+import torch
+
+from layers.PatchTST_backbone import Flatten_Head_TCN
+
+
+def test_individual_matches_shared():
+    torch.manual_seed(0)
+    bs, n_vars, d_model, patch_num, d_tcn, target_window = 2, 3, 4, 5, 6, 7
+    x = torch.randn(bs, n_vars, d_model, patch_num)
+    z_tcn = torch.randn(bs, n_vars, d_tcn)
+    nf = d_model * patch_num + d_tcn
+    shared = Flatten_Head_TCN(False, n_vars, nf, target_window).eval()
+    individual = Flatten_Head_TCN(True, n_vars, nf, target_window).eval()
+    for linear in individual.linears:
+        linear.load_state_dict(shared.linear.state_dict())
+    torch.testing.assert_allclose(individual(x, z_tcn), shared(x, z_tcn))
@@ -0,0 +1,58 @@
+"""
+Resuming the online phase from a utils.snapshot file against the uninterrupted
+run: the windows after the snapshot must be predicted and scored identically.
+
+    python -m pytest -q tests
+"""
+import importlib
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from benchmarks.common import make_args
+from benchmarks.suite import write_data
+
+EVERY, RESUME_AT = 20, 60
+
+
+def build(method, root, **overrides):
+    data_path, target, n = write_data('synthetic', str(root), 240, 3)
+    # a short replay interval and the online adjustment, so that the detector, the
+    # replay buffers and the sleep stages all carry state across the snapshot
+    args = make_args(method, data='custom', root_path=str(root), data_path=data_path, target=target,
+                     features='M', enc_in=n, dec_in=n, c_out=n, seq_len=24, pred_len=1, use_gpu=False,
+                     use_adbfgs=False, sleep_interval=8, online_adjust=0.5, alpha_d=0.05,
+                     checkpoints=os.path.join(str(root), 'checkpoints'),
+                     detector_log=os.path.join(str(root), 'detector.log'), **overrides)
+    torch.manual_seed(0)
+    np.random.seed(0)
+    return importlib.import_module('exp.exp_' + method).Exp_TS2VecSupervised(args)
+
+
+@pytest.mark.parametrize('method', ['fsnet_d3a', 'onenet_d3a'])
+def test_resume_matches_uninterrupted(method, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    snapshot = os.path.join(str(tmp_path), 'snapshot_{step}.pt')
+    exp = build(method, tmp_path, snapshot_every=EVERY, snapshot_path=snapshot,
+                checkpoint_keep=100, async_checkpoint=False)
+    # the optimizers train() would have left behind
+    exp._select_optimizer()
+    if hasattr(exp, 'decision'):
+        exp.opt_bias = torch.optim.Adam(exp.decision.parameters(), lr=exp.args.learning_rate_bias)
+    torch.manual_seed(1)
+    result, _, MSE, preds, trues = exp.test('full')
+    assert exp.detector.shift_cnt > 0, 'no sleep stage ran, the test would not cover its state'
+
+    # a fresh process: different initial weights and RNG streams, restored from the file
+    resumed = build(method, tmp_path, resume_from=snapshot.format(step=RESUME_AT))
+    torch.manual_seed(2)
+    resumed_result, _, resumed_MSE, resumed_preds, resumed_trues = resumed.test('resumed')
+
+    np.testing.assert_array_equal(resumed_trues, trues)
+    np.testing.assert_array_equal(resumed_preds[RESUME_AT:], preds[RESUME_AT:])
+    np.testing.assert_array_equal(resumed_MSE, MSE)
+    # every metric but the wall time
+    np.testing.assert_array_equal(resumed_result[:5], result[:5])
+    assert resumed.detector.shift_cnt == exp.detector.shift_cnt
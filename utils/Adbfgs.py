@@ -9,7 +9,9 @@ class Adbfgs(Optimizer):
     def __init__(self, params, lr=1e-4, betas=(0.965, 0.99, 0.92,0.0), rho = 0.04,
          weight_decay=1e-1, *, maximize: bool = False,
          capturable: bool = False,
-         if_acc: bool = True
+         if_acc: bool = True,
+         foreach: Optional[bool] = None,
+         flat: bool = False
          ):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
@@ -23,8 +25,11 @@ class Adbfgs(Optimizer):
             raise ValueError("Invalid weight_decay value: {}".format(weight_decay))
         defaults = dict(lr=lr, betas=betas, rho=rho, 
                         weight_decay=weight_decay, 
-                        maximize=maximize, capturable=capturable)
+                        maximize=maximize, capturable=capturable, foreach=foreach)
         super(Adbfgs, self).__init__(params, defaults)
+        # flat: each param group and its state live in contiguous arenas, see _flat_arena
+        self.flat = flat and not capturable
+        self._arenas = {}
         
 
     def __setstate__(self, state):
@@ -32,6 +37,9 @@ class Adbfgs(Optimizer):
         for group in self.param_groups:
             group.setdefault('maximize', False)
             group.setdefault('capturable', False)
+            group.setdefault('foreach', None)
+        self.__dict__.setdefault('flat', False)
+        self._arenas = {}
         state_values = list(self.state.values())
         step_is_tensor = (len(state_values) != 0) and torch.is_tensor(state_values[0]['step'])
         if not step_is_tensor:
@@ -59,6 +67,54 @@ class Adbfgs(Optimizer):
                 state['hessian'].mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
 
 
+    def load_state_dict(self, state_dict):
+        super(Adbfgs, self).load_state_dict(state_dict)
+        # the loaded state replaced the arena views, repack on the next step
+        self._arenas = {}
+
+    _state_keys = ['exp_avg', 'exp_avg_diff', 'exp_avg_s', 'exp_avg_h', 'neg_pre_grad', 'hessian']
+
+    def _flat_arena(self, index, group):
+        """
+        Packs the trainable params of a group and their state into one flat tensor
+        each; the params (.data) and state entries become views into them, so the
+        update is a handful of ops over whole arenas. Params with requires_grad=False
+        (e.g. the FSNet memory W, whose .data is rebound) are left to the per-parameter
+        path. None if the group cannot be packed.
+        """
+        if index in self._arenas:
+            return self._arenas[index]
+        params = [p for p in group['params'] if p.requires_grad]
+        if not params:
+            self._arenas[index] = None
+            return None
+        first = params[0]
+        if any(p.dtype != first.dtype or p.device != first.device or torch.is_complex(p) for p in params):
+            self._arenas[index] = None
+            return None
+
+        numels = [p.numel() for p in params]
+        arena = {'params': params, 'packed': set(map(id, params)), 'numels': numels}
+        flat = torch.empty(sum(numels), dtype=first.dtype, device=first.device)
+        for p, view in zip(params, flat.split(numels)):
+            view.copy_(p.detach().reshape(-1))
+            p.data = view.view_as(p)
+        arena['param'] = flat
+        for key in self._state_keys:
+            flat = torch.zeros(sum(numels), dtype=first.dtype, device=first.device)
+            for p, view in zip(params, flat.split(numels)):
+                state = self.state[p]
+                if key in state:
+                    view.copy_(state[key].reshape(-1))
+                state[key] = view.view_as(p)
+            arena[key] = flat
+        for p in params:
+            self.state[p].setdefault('step', torch.tensor(0.))
+        arena['steps'] = [self.state[p]['step'] for p in params]
+        arena['grad'] = torch.empty_like(arena['param'])
+        self._arenas[index] = arena
+        return arena
+
     @torch.no_grad()
     def step(self, closure=None, bs=5120):
         loss = None
@@ -66,7 +122,23 @@ class Adbfgs(Optimizer):
             with torch.enable_grad():
                 loss = closure()
 
-        for group in self.param_groups:
+        for index, group in enumerate(self.param_groups):
+            beta1, beta2, beta3, beta4= group['betas']
+            arena = self._flat_arena(index, group) if self.flat else None
+            packed = ()
+            if arena is not None and all(p.grad is not None for p in arena['params']):
+                torch.cat([p.grad.reshape(-1) for p in arena['params']], out=arena['grad'])
+                _flat_adbfgs(arena,
+                             beta1=beta1,
+                             beta2=beta2,
+                             beta3=beta3,
+                             beta4=beta4,
+                             rho=group['rho'],
+                             lr=group['lr'],
+                             weight_decay=group['weight_decay'],
+                             maximize=group['maximize'])
+                packed = arena['packed']
+
             params_with_grad = []
             grads = []
             exp_avgs = [] # g
@@ -81,7 +153,7 @@ class Adbfgs(Optimizer):
             
 
             for p in group['params']:
-                if p.grad is None:
+                if p.grad is None or id(p) in packed:
                     continue
                 params_with_grad.append(p)
                 
@@ -115,6 +187,8 @@ class Adbfgs(Optimizer):
                 if self.defaults['capturable']:
                     bs = torch.ones((1,), dtype=torch.float, device=p.device) * bs
 
+            if not params_with_grad:
+                continue
             adbfgs(params_with_grad,
                   grads,
                   exp_avgs,
@@ -132,7 +206,8 @@ class Adbfgs(Optimizer):
                   lr=group['lr'],
                   weight_decay=group['weight_decay'],
                   maximize=group['maximize'],
-                  capturable=group['capturable'])
+                  capturable=group['capturable'],
+                  foreach=group['foreach'])
 
         return loss
 
@@ -145,6 +220,7 @@ def adbfgs(params: List[Tensor],
           neg_pre_grads:  List[Tensor],
           state_steps: List[Tensor],
           capturable: bool = False,
+          foreach: Optional[bool] = None,
           *,
           bs: int,
           beta1: float,
@@ -159,8 +235,13 @@ def adbfgs(params: List[Tensor],
     if not all(isinstance(t, torch.Tensor) for t in state_steps):
         raise RuntimeError("API has changed, `state_steps` argument must contain a list of singleton tensors")
 
-    
-    func = _single_tensor_adbfgs
+    if foreach is None:
+        # like torch.optim, the foreach kernels only pay off on cuda
+        foreach = not capturable and all(p.is_cuda for p in params)
+    if foreach and not capturable:
+        func = _multi_tensor_adbfgs
+    else:
+        func = _single_tensor_adbfgs
 
     func(params,
          grads,
@@ -294,5 +375,109 @@ def _single_tensor_adbfgs(params: List[Tensor],
             # param.addcmul_(tmp.sign(), ratio, value=step_size_neg)
             # ratio = (exp_avg.abs() / (rho * bs * hess + 1e-15)).clamp(None,1)
             # param.addcmul_(exp_avg.sign(), ratio, value=step_size_neg)
-            
-        
\ No newline at end of file
+
+
+def _foreach_clamp_max_(tensors: List[Tensor], value: float):
+    if hasattr(torch, '_foreach_clamp_max_'):
+        torch._foreach_clamp_max_(tensors, value)
+    else:
+        for t in tensors:
+            t.clamp_(None, value)
+
+
+def _foreach_sign(tensors: List[Tensor]) -> List[Tensor]:
+    if hasattr(torch, '_foreach_sign'):
+        return torch._foreach_sign(tensors)
+    return [t.sign() for t in tensors]
+
+
+def _multi_tensor_adbfgs(params: List[Tensor],
+                         grads: List[Tensor],
+                         exp_avgs: List[Tensor],
+                         exp_avg_diffs: List[Tensor],
+                         exp_avg_ss: List[Tensor],
+                         exp_avg_hs: List[Tensor],
+                         neg_pre_grads: List[Tensor],
+                         state_steps: List[Tensor],
+                         *,
+                         bs: int,
+                         beta1: float,
+                         beta2: float,
+                         beta3: float,
+                         beta4: float,
+                         rho: float,
+                         lr: float,
+                         weight_decay: float,
+                         maximize: bool,
+                         capturable: bool):
+    """
+    _single_tensor_adbfgs with one torch._foreach_* op per line of the update, giving
+    the same values element by element. Like the single tensor version, the update of
+    exp_avg_h only decays it (its .add is not in place), so that term is not computed.
+    """
+    if len(params) == 0:
+        return
+
+    if maximize:
+        grads = torch._foreach_neg(tuple(grads))
+
+    def real(tensors):
+        return [torch.view_as_real(t) if torch.is_complex(t) else t for t in tensors]
+    params, grads, exp_avgs, exp_avg_diffs = real(params), real(grads), real(exp_avgs), real(exp_avg_diffs)
+    exp_avg_ss, exp_avg_hs, neg_pre_grads = real(exp_avg_ss), real(exp_avg_hs), real(neg_pre_grads)
+
+    # update step
+    torch._foreach_add_(state_steps, 1)
+
+    # Perform stepweight decay
+    torch._foreach_mul_(params, 1 - lr * weight_decay)
+
+    torch._foreach_add_(neg_pre_grads, grads)
+    torch._foreach_mul_(exp_avgs, beta1)
+    torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+    torch._foreach_mul_(exp_avg_diffs, beta3)
+    torch._foreach_add_(exp_avg_diffs, neg_pre_grads, alpha=1 - beta3)
+    torch._foreach_zero_(neg_pre_grads)
+    torch._foreach_add_(neg_pre_grads, grads, alpha=-1.0)
+
+    step_size_neg = - lr
+    tmp = torch._foreach_add(exp_avgs, torch._foreach_mul(exp_avg_diffs, 0.5))
+    denom = torch._foreach_add(torch._foreach_mul(exp_avg_hs, rho * 1), 1e-15)
+    ratio = torch._foreach_div(torch._foreach_abs(tmp), denom)
+    _foreach_clamp_max_(ratio, 1)
+    torch._foreach_mul_(exp_avg_ss, beta4)
+    torch._foreach_addcmul_(exp_avg_ss, _foreach_sign(tmp), ratio, value=step_size_neg*(1-beta4))
+    torch._foreach_mul_(exp_avg_hs, beta2)
+    torch._foreach_add_(params, exp_avg_ss)
+
+
+def _flat_adbfgs(arena,
+                 *,
+                 beta1: float,
+                 beta2: float,
+                 beta3: float,
+                 beta4: float,
+                 rho: float,
+                 lr: float,
+                 weight_decay: float,
+                 maximize: bool):
+    """The update of _multi_tensor_adbfgs on the flat arenas of Adbfgs._flat_arena."""
+    param, grad = arena['param'], arena['grad']
+    exp_avg, exp_avg_diff, exp_avg_s = arena['exp_avg'], arena['exp_avg_diff'], arena['exp_avg_s']
+    exp_avg_h, neg_grad_or_diff = arena['exp_avg_h'], arena['neg_pre_grad']
+    if maximize:
+        grad.neg_()
+
+    torch._foreach_add_(arena['steps'], 1)
+    param.mul_(1 - lr * weight_decay)
+    neg_grad_or_diff.add_(grad)
+    exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+    exp_avg_diff.mul_(beta3).add_(neg_grad_or_diff, alpha=1 - beta3)
+    neg_grad_or_diff.zero_().add_(grad, alpha=-1.0)
+
+    step_size_neg = - lr
+    tmp = exp_avg + exp_avg_diff *0.5
+    ratio = (tmp.abs() / (rho * 1 * exp_avg_h + 1e-15)).clamp(None,1)
+    exp_avg_s.mul_(beta4).addcmul_(tmp.sign(), ratio, value=step_size_neg*(1-beta4))
+    exp_avg_h.mul_(beta2)
+    param.add_(exp_avg_s)
@@ -32,20 +32,39 @@ def ring(num_seen_examples: int, buffer_portion_size: int, task: int) -> int:
 def fifo(num_seen_examples: int, buffer_size: int) -> int:
     return num_seen_examples % buffer_size
 
+
+def reservoir_indices(positions: torch.Tensor, buffer_size: int) -> torch.Tensor:
+    """
+    Vectorized reservoir: the target index of each stream position, -1 if it is not kept.
+    """
+    rand = (torch.rand(positions.shape, device=positions.device) * (positions + 1)).long()
+    index = torch.where(positions < buffer_size, positions, rand)
+    return torch.where(index < buffer_size, index, torch.full_like(index, -1))
+
+
 class Buffer:
     """
     The memory buffer of rehearsal method.
+
+    Storage is one preallocated ring of tensors on `device`; a batch is written
+    with at most two slice copies per attribute (a single scatter for reservoir)
+    and samples are drawn on device, so neither add_data nor get_data goes
+    through the host.
     """
     def __init__(self, buffer_size, device, n_tasks=1, mode='fifo'):
         assert mode in ['ring', 'reservoir', 'fifo']
         self.buffer_size = buffer_size
         self.device = device
         self.num_seen_examples = 0
+        self.mode = mode
         self.functional_index = eval(mode)
         if mode == 'ring':
             assert n_tasks is not None
             self.task_number = n_tasks
             self.buffer_portion_size = buffer_size // n_tasks
+            # examples of the current task go to portion `task`, set by the caller
+            self.task = 0
+            self.task_seen = [0] * n_tasks
         self.attributes = ['examples', 'labels', 'logits', 'task_labels']
 
     def init_tensors(self, examples: torch.Tensor, labels: torch.Tensor,
@@ -65,45 +84,88 @@ class Buffer:
                 setattr(self, attr_str, torch.zeros((self.buffer_size,
                         *attr.shape[1:]), dtype=typ, device=self.device))
 
+    def _targets(self, n):
+        """
+        Where the next n examples go, as (buffer index, batch index) pairs. fifo and
+        ring write at most two contiguous runs, so those are slices; reservoir picks
+        scattered slots. When several rows hit the same slot the last one wins, as if
+        they had been added one by one.
+        """
+        if self.mode != 'reservoir':
+            if self.mode == 'ring':
+                seen = self.task_seen[self.task]
+                self.task_seen[self.task] += n
+                capacity, offset = self.buffer_portion_size, self.task * self.buffer_portion_size
+            else:
+                seen, capacity, offset = self.num_seen_examples, self.buffer_size, 0
+            # only the last `capacity` rows survive, and those never collide
+            first = max(n - capacity, 0)
+            start = (seen + first) % capacity
+            head = min(n - first, capacity - start)
+            targets = [(slice(offset + start, offset + start + head), slice(first, first + head))]
+            if first + head < n:
+                targets.append((slice(offset, offset + n - first - head), slice(first + head, n)))
+            return targets
+
+        seen = self.num_seen_examples
+        if n == 1:
+            index = reservoir(seen, self.buffer_size)
+            return [(slice(index, index + 1), slice(0, 1))] if index >= 0 else []
+        positions = torch.arange(seen, seen + n, device=self.device)
+        index = reservoir_indices(positions, self.buffer_size)
+        kept = index >= 0
+        winner = torch.full((self.buffer_size,), -1, dtype=torch.long, device=self.device)
+        winner.scatter_reduce_(0, index[kept], torch.arange(n, device=self.device)[kept], reduce='amax')
+        slots = (winner >= 0).nonzero().squeeze(1)
+        return [(slots, winner[slots])]
+
     def add_data(self, examples, labels=None, logits=None, task_labels=None):
         """
-        Adds the data to the memory buffer according to the reservoir strategy.
+        Adds the data to the memory buffer according to the buffer mode.
         :param examples: tensor containing the images
         :param labels: tensor containing the labels
         :param logits: tensor containing the outputs of the network
         :param task_labels: tensor containing the task labels
-        :return:
+        :return: the (buffer index, batch index) pairs that were written
         """
         if not hasattr(self, 'examples'):
             self.init_tensors(examples, labels, logits, task_labels)
 
-        for i in range(examples.shape[0]):
-            index = fifo(self.num_seen_examples, self.buffer_size)
-            self.num_seen_examples += 1
-            if index >= 0:
-                self.examples[index] = examples[i].to(self.device)
-                if labels is not None:
-                    self.labels[index] = labels[i].to(self.device)
-                if logits is not None:
-                    self.logits[index] = logits[i].to(self.device)
-                if task_labels is not None:
-                    self.task_labels[index] = task_labels[i].to(self.device)
+        targets = self._targets(examples.shape[0])
+        self.num_seen_examples += examples.shape[0]
+        for attr_str, attr in zip(self.attributes, (examples, labels, logits, task_labels)):
+            if attr is not None:
+                buffer = getattr(self, attr_str)
+                for index, rows in targets:
+                    if isinstance(index, slice):
+                        # copy_ takes care of the device and dtype
+                        buffer[index].copy_(attr[rows])
+                    else:
+                        buffer[index] = attr.to(buffer)[rows]
+        return targets
 
-    def get_data(self, size: int, transform: transforms=None) -> Tuple:
+    def _transform(self, examples, transform, batch_transform):
+        if batch_transform is not None:
+            return batch_transform(examples)
+        if transform is not None:
+            return torch.stack([transform(ee) for ee in examples])
+        return examples
+
+    def get_data(self, size: int, transform: transforms=None, batch_transform=None, generator=None) -> Tuple:
         """
         Random samples a batch of size items.
         :param size: the number of requested items
         :param transform: the transformation to be applied (data augmentation)
+        :param batch_transform: the transformation applied to the whole batch at once
+        :param generator: torch.Generator to draw from instead of the global one
         :return:
         """
-        if size > min(self.num_seen_examples, self.examples.shape[0]):
-            size = min(self.num_seen_examples, self.examples.shape[0])
+        n = min(self.num_seen_examples, self.examples.shape[0])
+        if size > n:
+            size = n
 
-        choice = np.random.choice(min(self.num_seen_examples, self.examples.shape[0]),
-                                  size=size, replace=False)
-        if transform is None: transform = lambda x: x
-        ret_tuple = (torch.stack([transform(ee.cpu())
-                            for ee in self.examples[choice]]).to(self.device),)
+        choice = torch.randperm(n, device=self.device, generator=generator)[:size]
+        ret_tuple = (self._transform(self.examples[choice], transform, batch_transform),)
         for attr_str in self.attributes[1:]:
             if hasattr(self, attr_str):
                 attr = getattr(self, attr_str)
@@ -120,15 +182,14 @@ class Buffer:
         else:
             return False
 
-    def get_all_data(self, transform: transforms=None) -> Tuple:
+    def get_all_data(self, transform: transforms=None, batch_transform=None) -> Tuple:
         """
         Return all the items in the memory buffer.
         :param transform: the transformation to be applied (data augmentation)
+        :param batch_transform: the transformation applied to the whole batch at once
         :return: a tuple with all the items in the memory buffer
         """
-        if transform is None: transform = lambda x: x
-        ret_tuple = (torch.stack([transform(ee.cpu())
-                            for ee in self.examples]).to(self.device),)
+        ret_tuple = (self._transform(self.examples, transform, batch_transform),)
         for attr_str in self.attributes[1:]:
             if hasattr(self, attr_str):
                 attr = getattr(self, attr_str)
@@ -143,6 +204,113 @@ class Buffer:
             if hasattr(self, attr_str):
                 delattr(self, attr_str)
         self.num_seen_examples = 0
+        if self.mode == 'ring':
+            self.task_seen = [0] * self.task_number
+
+
+
+class PrioritizedBuffer(Buffer):
+    """
+    Buffer that replays examples proportionally to priority = (loss + eps) ** alpha.
+
+    Priorities live in a sum-tree (a segment tree in one flat tensor, leaves at
+    [capacity, 2 * capacity)), so updates are O(log n) and sampling a batch is
+    O(batch * log n), both vectorized over the batch and kept on device. New
+    examples get the given per-sample loss, or the largest priority seen so far.
+    After get_data, `last_indices` holds the sampled slots (for update_priorities)
+    and `last_weights` the importance-sampling weights, normalized to max 1.
+    """
+    def __init__(self, buffer_size, device, n_tasks=1, mode='fifo', alpha=0.6, beta=0.4, eps=1e-6):
+        super(PrioritizedBuffer, self).__init__(buffer_size, device, n_tasks, mode)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.capacity = 1
+        while self.capacity < buffer_size:
+            self.capacity *= 2
+        self.depth = self.capacity.bit_length() - 1
+        self.tree = torch.zeros(2 * self.capacity, device=device)
+        self.max_priority = torch.ones((), device=device)
+        self.last_indices, self.last_weights = None, None
+
+    def _priority(self, losses):
+        losses = losses.detach().to(self.tree).reshape(losses.shape[0], -1).mean(1)
+        return (losses.abs() + self.eps) ** self.alpha
+
+    def _set(self, slots, priorities):
+        nodes = slots + self.capacity
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = nodes // 2
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def add_data(self, examples, labels=None, logits=None, task_labels=None, losses=None):
+        """
+        Adds the data like Buffer.add_data.
+        :param losses: per-sample loss of the examples, their initial priority
+        :return: the (buffer index, batch index) pairs that were written
+        """
+        targets = super(PrioritizedBuffer, self).add_data(examples, labels, logits, task_labels)
+        priorities = None if losses is None else self._priority(losses)
+        if priorities is not None:
+            self.max_priority = torch.maximum(self.max_priority, priorities.max())
+        for index, rows in targets:
+            if isinstance(index, slice):
+                index = torch.arange(index.start, index.stop, device=self.device)
+            if priorities is None:
+                self._set(index, self.max_priority.expand(index.shape[0]))
+            else:
+                self._set(index, priorities[rows])
+        return targets
+
+    def update_priorities(self, indices, losses):
+        """Sets the priority of the slots `indices` (e.g. last_indices) from their new per-sample loss."""
+        priorities = self._priority(losses)
+        self.max_priority = torch.maximum(self.max_priority, priorities.max())
+        self._set(indices.to(self.device), priorities)
+
+    def get_data(self, size: int, transform: transforms=None, batch_transform=None, generator=None) -> Tuple:
+        """
+        Samples size items with replacement, proportionally to their priority.
+        :param size: the number of requested items
+        :param transform: the transformation to be applied (data augmentation)
+        :param batch_transform: the transformation applied to the whole batch at once
+        :param generator: torch.Generator to draw from instead of the global one
+        :return:
+        """
+        n = min(self.num_seen_examples, self.examples.shape[0])
+        if size > n:
+            size = n
+
+        # one draw per equal-mass segment, then descend from the root
+        total = self.tree[1]
+        mass = (torch.arange(size, device=self.device) + torch.rand(size, device=self.device, generator=generator)) * total / size
+        nodes = torch.ones(size, dtype=torch.long, device=self.device)
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            right = (mass >= left).long()
+            mass = mass - left * right
+            nodes = 2 * nodes + right
+        # rounding can walk past the last filled slot
+        choice = (nodes - self.capacity).clamp(max=n - 1)
+
+        prob = self.tree[choice + self.capacity] / total
+        weights = (n * prob).clamp(min=1e-12) ** (-self.beta)
+        self.last_indices, self.last_weights = choice, weights / weights.max()
+
+        ret_tuple = (self._transform(self.examples[choice], transform, batch_transform),)
+        for attr_str in self.attributes[1:]:
+            if hasattr(self, attr_str):
+                attr = getattr(self, attr_str)
+                ret_tuple += (attr[choice],)
+
+        return ret_tuple
+
+    def empty(self) -> None:
+        super(PrioritizedBuffer, self).empty()
+        self.tree.zero_()
+        self.max_priority = torch.ones((), device=self.device)
+        self.last_indices, self.last_weights = None, None
 
 
 
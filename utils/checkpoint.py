@@ -0,0 +1,142 @@
+"""
+Checkpoint writing off the training / online loop.
+
+save() only takes a CPU copy of the state (into pinned memory for cuda tensors,
+with an asynchronous device to host copy), the serialization and the file write
+happen on a background thread. Files are written to a temp name and renamed,
+so a crash never leaves a truncated checkpoint behind.
+"""
+import os
+import copy
+import atexit
+import threading
+from collections import OrderedDict, deque
+import torch
+
+
+def cpu_copy(obj):
+    """
+    Copy of a (nested) state on the CPU that later training steps can not change.
+    CUDA tensors go to pinned memory without blocking, anything that is not a
+    tensor or a container is deep-copied.
+    """
+    if isinstance(obj, torch.Tensor):
+        obj = obj.detach()
+        if obj.is_cuda:
+            out = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=True)
+            return out.copy_(obj, non_blocking=True)
+        return obj.clone()
+    if type(obj) in (dict, OrderedDict):
+        out = type(obj)((k, cpu_copy(v)) for k, v in obj.items())
+        # state_dicts carry their version metadata here
+        if hasattr(obj, '_metadata'):
+            out._metadata = copy.deepcopy(obj._metadata)
+        return out
+    if type(obj) in (list, tuple):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def atomic_save(state, path):
+    tmp = path + '.tmp'
+    torch.save(state, tmp)
+    os.replace(tmp, path)
+
+
+class CheckpointWriter():
+    """
+    Writes checkpoints on a background thread and keeps the last `keep` distinct
+    paths, deleting older ones (a path saved again just moves to the front).
+    At most `max_pending` copies wait for the thread; past that the oldest
+    waiting one is dropped, since a newer state supersedes it, so a slow disk
+    costs memory and staleness but never stalls the loop. With background=False
+    save() writes in the caller, with the same rotation.
+    """
+    def __init__(self, keep=1, background=True, max_pending=2):
+        self.keep = keep
+        self.background = background
+        self.max_pending = max_pending
+        self.written = deque()
+        self.pending = deque()
+        self.dropped = 0
+        self.error = None
+        self.busy = False
+        self.cond = threading.Condition()
+        self.thread = None
+        if background:
+            self.thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def save(self, state, path):
+        self._raise()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if not self.background:
+            atomic_save(state, path)
+            self._rotate(path)
+            return
+        state = cpu_copy(state)
+        event = None
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            event = torch.cuda.Event()
+            event.record()
+        with self.cond:
+            if len(self.pending) >= self.max_pending:
+                self.pending.popleft()
+                self.dropped += 1
+            self.pending.append((state, path, event))
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                state, path, event = self.pending.popleft()
+                self.busy = True
+            try:
+                if path is None:
+                    return
+                if event is not None:
+                    # the non_blocking copies into pinned memory have landed
+                    event.synchronize()
+                atomic_save(state, path)
+                self._rotate(path)
+            except Exception as e:
+                self.error = e
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+    def _rotate(self, path):
+        if path in self.written:
+            self.written.remove(path)
+        self.written.append(path)
+        while len(self.written) > self.keep:
+            old = self.written.popleft()
+            if os.path.exists(old):
+                os.remove(old)
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('background checkpoint write failed') from error
+
+    def flush(self):
+        """Blocks until every checkpoint handed to save() is on disk."""
+        if self.background:
+            with self.cond:
+                while self.pending or self.busy:
+                    self.cond.wait()
+        self._raise()
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.flush()
+        with self.cond:
+            self.pending.append((None, None, None))
+            self.cond.notify_all()
+        self.thread.join()
+        self.thread = None
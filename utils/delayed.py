@@ -0,0 +1,86 @@
+"""
+Predict-now / update-later online loop for labels that arrive with a delay.
+
+A window is forecast as soon as it is observed, but its ground truth is the next
+pred_len bars, so the gradient step on it can only run pred_len windows later.
+"""
+import time
+import queue
+import threading
+from collections import deque
+
+
+class DelayedFeedback():
+    """
+    step(window) returns predict(window) right away and queues the window; once
+    `delay` newer windows have been seen its horizon is known and update(window)
+    runs, inline or, with background=True, on a worker thread (which then owns
+    whatever update touches, e.g. a shadow model it publishes from). At most
+    max_backlog windows wait for the thread, past that step() blocks until it
+    catches up, so the served model is never more than that many updates stale;
+    0 lets the backlog grow.
+    """
+    def __init__(self, predict, update, delay, background=False, max_backlog=1):
+        self.predict = predict
+        self.update = update
+        self.delay = delay
+        self.pending = deque()
+        self.background = background
+        self.error = None
+        self.stats = {'windows': 0, 'updates': 0, 'predict_time': 0., 'update_time': 0., 'max_backlog': 0}
+        self.thread = None
+        if background:
+            self.queue = queue.Queue(maxsize=max_backlog)
+            self.thread = threading.Thread(target=self._run, name='delayed-update', daemon=True)
+            self.thread.start()
+
+    def step(self, window):
+        if self.error is not None:
+            raise RuntimeError('delayed update failed') from self.error
+        t = time.perf_counter()
+        pred = self.predict(window)
+        self.stats['predict_time'] += time.perf_counter() - t
+        self.stats['windows'] += 1
+
+        self.pending.append(window)
+        if len(self.pending) > self.delay:
+            window = self.pending.popleft()
+            if self.background:
+                self.queue.put(window)
+                self.stats['max_backlog'] = max(self.stats['max_backlog'], self.queue.qsize())
+            else:
+                self._update(window)
+        return pred
+
+    def _update(self, window):
+        t = time.perf_counter()
+        self.update(window)
+        self.stats['update_time'] += time.perf_counter() - t
+        self.stats['updates'] += 1
+
+    def _run(self):
+        while True:
+            window = self.queue.get()
+            try:
+                if window is None:
+                    return
+                if self.error is None:
+                    self._update(window)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        """Waits for the queued updates; windows whose horizon was never reached stay unlabelled."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise RuntimeError('delayed update failed') from self.error
+        s = self.stats
+        print('delayed feedback: {} windows, {} updates, predict {:.2f}ms, update {:.2f}ms{}'.format(
+            s['windows'], s['updates'], 1e3 * s['predict_time'] / max(s['windows'], 1),
+            1e3 * s['update_time'] / max(s['updates'], 1),
+            ', max backlog {}'.format(s['max_backlog']) if self.background else ''))
@@ -1,5 +1,5 @@
 import numpy as np
-from scipy.stats import norm
+from scipy.stats import norm, ks_2samp
 import torch
 import os 
 import matplotlib.pyplot as plt
@@ -9,68 +9,119 @@ colors = ['gold', 'grey', '#d7191c', '#2b83ba' ]
 colors = sns.color_palette("muted", n_colors=10)
 
 class STEPD:
-    def __init__(self, new_window_size, alpha_w=0.05, alpha_d=0.003):
+    """
+    Statistical test of equal proportions: compares the mean error of the last
+    `new_window_size` steps with the mean over everything since the last reset.
+
+    Both are maintained incrementally (Welford moments for the overall window, a
+    circular buffer with a running sum for the recent one), so add_data/run_test
+    are O(1) and memory does not grow with the stream. `trace_size` > 0 also keeps
+    the last errors and input rows in preallocated buffers for plt_distribution.
+    """
+    def __init__(self, new_window_size, alpha_w=0.05, alpha_d=0.003, trace_size=0):
         self.new_window_size = new_window_size
         self.alpha_w = alpha_w
         self.alpha_d = alpha_d
+        self.warning_threshold = norm.ppf(1 - self.alpha_w / 2)
+        self.drift_threshold = norm.ppf(1 - self.alpha_d / 2)
         self.cnt, self.shift_cnt = 1, 0
-        self.data = []
-        self.data_visualize = None
+        self.window = np.zeros(new_window_size)
+        self.trace_size = trace_size
+        self.trace, self.trace_x = np.zeros(trace_size), None
+        self._clear()
+
+    def _clear(self):
+        self.window[:] = 0
+        self.n = 0
+        self.mean = np.float64(0.)
+        self.m2 = np.float64(0.)
+        self.window_sum = np.float64(0.)
 
     def add_data(self, error_rate , x):
         self.cnt += 1
-        if self.data_visualize is None:
-            self.data_visualize = x.cpu().detach()[0]
-        else:
-            self.data_visualize = torch.cat([self.data_visualize, x.cpu().detach()[0,-1,:].unsqueeze(0)], dim=0)
+        if self.trace_size:
+            row = x.detach()[0, -1].cpu().numpy()
+            if self.trace_x is None:
+                self.trace_x = np.zeros((self.trace_size, row.shape[0]), dtype=row.dtype)
+            self.trace[self.n % self.trace_size] = error_rate
+            self.trace_x[self.n % self.trace_size] = row
         # if len(self.data) > self.new_window_size and self.is_outlier(error_rate) :
         #     # 如果是异常值，不将其添加到数据中
         #     return
-        self.data.append(error_rate)
+
+        error_rate = np.float64(error_rate)
+        self.n += 1
+        delta = error_rate - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (error_rate - self.mean)
+
+        pos = (self.n - 1) % self.new_window_size
+        self.window_sum += error_rate - self.window[pos]
+        self.window[pos] = error_rate
+        if pos == self.new_window_size - 1:
+            # resum once per lap so rounding in the running sum does not accumulate
+            self.window_sum = self.window.sum()
+
+    def _ordered(self, trace):
+        k = min(self.n, self.trace_size)
+        return trace[np.arange(self.n - k, self.n) % self.trace_size]
+
+    @property
+    def data(self):
+        """The traced errors since the last reset, oldest first (at most trace_size of them)."""
+        if not self.trace_size:
+            return []
+        return list(self._ordered(self.trace))
+
+    @property
+    def data_visualize(self):
+        if self.trace_x is None or self.n == 0:
+            return None
+        return torch.from_numpy(self._ordered(self.trace_x))
 
     def reset(self):
         self.shift_cnt += 1
-        self.data = []
+        self._clear()
         self.cnt = 0
-        self.data_visualize = None
-    
+
+    def _recent(self):
+        k = min(self.n, self.new_window_size)
+        if k == self.new_window_size:
+            return self.window
+        return self.window[:k]
+
     def is_outlier(self, value, threshold=3.0):
         # 使用标准差的方法检测异常值，也许这里不需要normalize，绝对大小就能说明问题
-        mean_value = np.mean(self.data[-self.new_window_size:])
-        std_dev_value = np.std(self.data[-self.new_window_size:])
+        mean_value = np.mean(self._recent())
+        std_dev_value = np.std(self._recent())
         z_score = (value - mean_value) / (std_dev_value + 1e-4)
-        warning_threshold = norm.ppf(1 - self.alpha_w / 2)
-        return z_score > warning_threshold
+        return z_score > self.warning_threshold
     
     def run_test(self,):
-        if len(self.data) < self.new_window_size:
+        if self.n < self.new_window_size:
             # Not enough data for comparison
             return 0, None
 
-        # Extract the most recent time window and the overall time window
-        recent_window = self.data[-self.new_window_size:]
-        overall_window = self.data
-
         # Calculate the test statistic
-        mean_recent = np.mean(recent_window)
-        mean_overall = np.mean(overall_window)
-        std_dev_overall = np.std(overall_window)
-        n = len(self.data)
+        n = self.n
+        mean_recent = self.window_sum / self.new_window_size
+        mean_overall = self.mean
+        std_dev_overall = np.sqrt(max(self.m2, 0.) / n)
         theta_stepd = (mean_recent - mean_overall) / (std_dev_overall / np.sqrt(n))
 
-        # Calculate the warning and drift thresholds
-        warning_threshold = norm.ppf(1 - self.alpha_w / 2)
-        drift_threshold = norm.ppf(1 - self.alpha_d / 2)
-
         # Check for warning or drift
-        if theta_stepd > drift_threshold:
+        if theta_stepd > self.drift_threshold:
             # self.plt_distribution(self.data, c1 = colors[0], c2 = colors[1])
             # self.plt_distribution(self.data_visualize[:,0].numpy(), name='value', c1 = colors[2], c2 = colors[3])
             return 1, 3e-3
         else:
-            lr = 1e-4 + (3e-3 - 1e-4) * (theta_stepd / drift_threshold)
+            lr = 1e-4 + (3e-3 - 1e-4) * (theta_stepd / self.drift_threshold)
             return 0, max(lr, 1e-4)
 
+    def close(self):
+        # nothing held open, see LossLogger
+        pass
+
     def plt_distribution(self, data, name='error', c1 = colors[0], c2 = colors[1]):
         sns.set(style="whitegrid", font_scale=1.8)
         plt.rcParams["font.family"] = "Times New Roman"
@@ -102,4 +153,287 @@ class STEPD:
         sns.despine(offset=10, trim=True)
         plt.tight_layout()
         plt.savefig(f'imgs/drift/{name}_plot_{self.shift_cnt}.pdf')
-        plt.close()
\ No newline at end of file
+        plt.close()
+
+class Detector:
+    """
+    Common part of the streaming detectors below, with the STEPD interface:
+    add_data(error, x) per online step, run_test() -> (1, 3e-3) on drift and
+    (0, lr) otherwise ((0, None) while warming up), reset() after a sleep stage.
+    Only increases of the error count as drift, like STEPD.
+    """
+    def __init__(self, new_window_size, alpha_w=0.05, alpha_d=0.003):
+        self.new_window_size = new_window_size
+        self.alpha_w = alpha_w
+        self.alpha_d = alpha_d
+        self.cnt, self.shift_cnt = 1, 0
+        self.n = 0
+        self.drift = False
+        self._clear()
+
+    def _clear(self):
+        raise NotImplementedError
+
+    def _update(self, value):
+        """Consumes one error, returns True if it completes a drift."""
+        raise NotImplementedError
+
+    def add_data(self, error_rate, x):
+        self.cnt += 1
+        self.n += 1
+        self.drift = self._update(float(error_rate)) or self.drift
+
+    def run_test(self,):
+        if self.n < self.new_window_size:
+            return 0, None
+        if self.drift:
+            self.drift = False
+            return 1, 3e-3
+        return 0, 1e-4
+
+    def reset(self):
+        self.shift_cnt += 1
+        self.n = 0
+        self.drift = False
+        self._clear()
+        self.cnt = 0
+
+    def close(self):
+        pass
+
+
+class ADWIN(Detector):
+    """
+    ADWIN2 (Bifet & Gavalda, 2007): an adaptive window kept as an exponential
+    histogram of at most `max_buckets` buckets per power of two, so memory is
+    O(max_buckets * log(width)). Every `clock` steps the window is cut where two
+    sub-windows have significantly different means (confidence alpha_d).
+    """
+    def __init__(self, new_window_size, alpha_w=0.05, alpha_d=0.003, max_buckets=5, clock=32, min_window=5):
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self.min_window = min_window
+        super(ADWIN, self).__init__(new_window_size, alpha_w, alpha_d)
+
+    def _clear(self):
+        # levels[i] holds the buckets of 2**i elements as [total, variance], newest first
+        self.levels = []
+        self.width = 0
+        self.total = 0.
+        self.variance = 0.
+
+    def _insert(self, value):
+        if self.width > 0:
+            mean = self.total / self.width
+            self.variance += self.width * (value - mean) ** 2 / (self.width + 1)
+        self.width += 1
+        self.total += value
+        if not self.levels:
+            self.levels.append([])
+        self.levels[0].insert(0, [value, 0.])
+        for i, level in enumerate(self.levels):
+            if len(level) <= self.max_buckets:
+                break
+            # merge the two oldest buckets of this level into one of the next
+            (t2, v2), (t1, v1) = level.pop(), level.pop()
+            n = 2 ** i
+            merged = [t1 + t2, v1 + v2 + n * (t1 / n - t2 / n) ** 2 / 2]
+            if i + 1 == len(self.levels):
+                self.levels.append([])
+            self.levels[i + 1].insert(0, merged)
+
+    def _drop_oldest(self):
+        i = len(self.levels) - 1
+        t, v = self.levels[i].pop()
+        n = 2 ** i
+        self.width -= n
+        self.total -= t
+        if self.width:
+            self.variance -= v + n * self.width * (t / n - self.total / self.width) ** 2 / (n + self.width)
+            self.variance = max(self.variance, 0.)
+        else:
+            self.variance = 0.
+        if not self.levels[i]:
+            self.levels.pop()
+
+    def _cut(self):
+        """Shrinks the window while some split is significant, returns True if the error went up."""
+        increased, changed = False, True
+        while changed and self.width > 2 * self.min_window:
+            changed = False
+            n0, u0 = 0, 0.
+            delta = np.log(2 * np.log(self.width) / self.alpha_d)
+            var = self.variance / self.width
+            for i in reversed(range(len(self.levels))):
+                for t, v in reversed(self.levels[i]):
+                    n0 += 2 ** i
+                    u0 += t
+                    n1 = self.width - n0
+                    if n1 < self.min_window:
+                        break
+                    if n0 < self.min_window:
+                        continue
+                    m = 1. / (n0 - self.min_window + 1) + 1. / (n1 - self.min_window + 1)
+                    eps = np.sqrt(2 * m * var * delta) + 2. / 3 * delta * m
+                    diff = (self.total - u0) / n1 - u0 / n0
+                    if abs(diff) > eps:
+                        increased = increased or diff > 0
+                        self._drop_oldest()
+                        changed = True
+                        break
+                if changed or n1 < self.min_window:
+                    break
+        return increased
+
+    def _update(self, value):
+        self._insert(value)
+        if self.n % self.clock:
+            return False
+        return self._cut()
+
+
+class PageHinkley(Detector):
+    """
+    Page-Hinkley test for an increase of the mean, run on errors standardized by
+    their running (Welford) mean/std so `threshold` does not depend on the loss
+    scale. O(1) time and memory.
+    """
+    def __init__(self, new_window_size, alpha_w=0.05, alpha_d=0.003, delta=0.005, threshold=50., forget=0.9999):
+        self.delta = delta
+        self.threshold = threshold
+        self.forget = forget
+        super(PageHinkley, self).__init__(new_window_size, alpha_w, alpha_d)
+
+    def _clear(self):
+        self.mean, self.m2 = 0., 0.
+        self.cum, self.cum_min = 0., 0.
+
+    def _update(self, value):
+        k = self.n
+        std = np.sqrt(self.m2 / k) if k > 1 else 0.
+        z = (value - self.mean) / std if std > 0 else 0.
+        delta = value - self.mean
+        self.mean += delta / k
+        self.m2 += delta * (value - self.mean)
+
+        self.cum = self.forget * self.cum + z - self.delta
+        self.cum_min = min(self.cum_min, self.cum)
+        return k >= self.new_window_size and self.cum - self.cum_min > self.threshold
+
+
+class DDM(Detector):
+    """
+    Drift Detection Method (Gama et al., 2004) for a real-valued error: p is the
+    running mean and s = std / sqrt(n); drift when p + s exceeds the best p + s
+    seen by `drift_level` times its s. O(1) time and memory.
+    """
+    def __init__(self, new_window_size, alpha_w=0.05, alpha_d=0.003, warning_level=2., drift_level=3.):
+        self.warning_level = warning_level
+        self.drift_level = drift_level
+        super(DDM, self).__init__(new_window_size, alpha_w, alpha_d)
+
+    def _clear(self):
+        self.mean, self.m2 = 0., 0.
+        self.p_min, self.s_min = float('inf'), float('inf')
+        self.warning = False
+
+    def _update(self, value):
+        k = self.n
+        delta = value - self.mean
+        self.mean += delta / k
+        self.m2 += delta * (value - self.mean)
+        if k < self.new_window_size:
+            return False
+        s = np.sqrt(self.m2 / k / k)
+        if self.mean + s < self.p_min + self.s_min:
+            self.p_min, self.s_min = self.mean, s
+        self.warning = self.mean + s > self.p_min + self.warning_level * self.s_min
+        return self.mean + s > self.p_min + self.drift_level * self.s_min
+
+
+class KSWIN(Detector):
+    """
+    Kolmogorov-Smirnov windowing (Raab et al., 2020): the last `stat_size` errors
+    are compared with a random sample of the older part of a circular window of
+    `window_size` errors; drift if the KS test rejects at alpha_d and the recent
+    errors are larger. Memory is bounded by the window.
+    """
+    def __init__(self, new_window_size, alpha_w=0.05, alpha_d=0.003, window_size=None, stat_size=None, seed=0):
+        self.window_size = window_size or max(4 * new_window_size, 100)
+        self.stat_size = stat_size or max(self.window_size // 4, 10)
+        self.rng = np.random.RandomState(seed)
+        super(KSWIN, self).__init__(new_window_size, alpha_w, alpha_d)
+
+    def _clear(self):
+        self.window = np.zeros(self.window_size)
+
+    def _update(self, value):
+        self.window[(self.n - 1) % self.window_size] = value
+        if self.n < self.window_size:
+            return False
+        order = np.arange(self.n - self.window_size, self.n) % self.window_size
+        window = self.window[order]
+        recent, older = window[-self.stat_size:], window[:-self.stat_size]
+        sample = self.rng.choice(older, self.stat_size, replace=False)
+        _, p_value = ks_2samp(sample, recent)
+        return p_value <= self.alpha_d and recent.mean() > sample.mean()
+
+
+class LossLogger:
+    """
+    Wraps a detector and appends every error it sees to a text file, to replay offline.
+    The file is opened on the first write, so the copies taken for the online
+    snapshots hold no handle, and released by close().
+    """
+    def __init__(self, detector, path):
+        self.detector = detector
+        self.path = path
+        self.file = None
+
+    def _write(self, line):
+        if self.file is None:
+            # appending, so a restored detector keeps writing to the same log
+            self.file = open(self.path, 'a', buffering=1)
+        self.file.write(line)
+
+    def add_data(self, error_rate, x):
+        self._write('{!r}\n'.format(float(error_rate)))
+        self.detector.add_data(error_rate, x)
+
+    def reset(self):
+        self._write('reset\n')
+        self.detector.reset()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.detector.close()
+
+    def __getstate__(self):
+        return {'detector': self.detector, 'path': self.path}
+
+    def __setstate__(self, state):
+        self.detector = state['detector']
+        self.path = state['path']
+        self.file = None
+
+    def __getattr__(self, name):
+        return getattr(self.detector, name)
+
+
+DETECTORS = {
+    'stepd': STEPD,
+    'adwin': ADWIN,
+    'page_hinkley': PageHinkley,
+    'ddm': DDM,
+    'kswin': KSWIN,
+}
+
+
+def build_detector(name, new_window_size, alpha_w=0.05, alpha_d=0.003, log_path=None, **kwargs):
+    """Detector `name` from DETECTORS; with log_path every error it sees is also logged."""
+    detector = DETECTORS[name](new_window_size, alpha_w=alpha_w, alpha_d=alpha_d, **kwargs)
+    if log_path:
+        detector = LossLogger(detector, log_path)
+    return detector
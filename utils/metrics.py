@@ -1,5 +1,6 @@
 import numpy as np
 import numexpr as ne
+import torch
 import pdb
 
 def cumavg(m):
@@ -43,3 +44,99 @@ def metric(pred, true):
     mspe = MSPE(pred, true)
     
     return mae,mse,rmse,mape,mspe
+
+
+class StreamingMetrics():
+    """
+    metric() of every test step, accumulated where the predictions live. Each
+    update() writes the five values into a preallocated (sync_every, 5) buffer
+    on the prediction's device, which is copied to the host once full, so a
+    step costs a few reductions and no host sync. curves() gives the cumulative
+    averages (cumavg) of the five, mean() the running values so far.
+
+    With data (the test dataset) the metrics are computed on the inverse-scaled
+    values, with the statistics of the columns its targets were scaled with: the
+    last c_out of its scaler (the target column for MS/S), repeated over the
+    horizon for predictions flattened 'b t d -> b (t d)'. Datasets that leave
+    their targets unscaled (target_scaled = False, e.g. the finance ones) are
+    rejected.
+    """
+    def __init__(self, sync_every=256, data=None, c_out=None):
+        self.sync_every = max(sync_every, 1)
+        self.stats = None
+        self.c_out = c_out
+        if data is not None:
+            # through the WindowBatches wrapper
+            data = getattr(data, 'dataset', data)
+            if not getattr(data, 'target_scaled', True) or not getattr(data, 'scale', True):
+                raise ValueError('--inverse_metrics: {} does not scale its targets'.format(type(data).__name__))
+            if c_out is None:
+                raise ValueError('--inverse_metrics needs the number of output columns')
+            self.stats = (np.asarray(data.scaler.mean).reshape(-1), np.asarray(data.scaler.std).reshape(-1))
+        self.buf = None
+        self.n = 0
+        self.host = []
+        self.scale = None
+
+    def __len__(self):
+        return sum(len(h) for h in self.host) + self.n
+
+    def _inverse(self, x):
+        if self.scale is None or self.scale[0].device != x.device or self.scale[0].shape[-1] != x.shape[-1]:
+            if x.shape[-1] % self.c_out:
+                raise ValueError('--inverse_metrics: {} values per row is not a horizon of {} columns'.format(x.shape[-1], self.c_out))
+            # (t d) flattening, d is the fastest axis
+            horizon = x.shape[-1] // self.c_out
+            mean, std = (np.tile(v[-self.c_out:], horizon) for v in self.stats)
+            self.scale = (torch.as_tensor(mean, dtype=x.dtype, device=x.device),
+                          torch.as_tensor(std, dtype=x.dtype, device=x.device))
+        mean, std = self.scale
+        return x * std + mean
+
+    def update(self, pred, true):
+        pred, true = pred.detach(), true.detach()
+        if self.stats is not None:
+            pred, true = self._inverse(pred), self._inverse(true)
+        if self.buf is None or self.buf.device != pred.device:
+            self.sync()
+            self.buf = torch.empty(self.sync_every, 5, device=pred.device)
+        err = pred - true
+        rel = err / true
+        mse = err.square().mean()
+        self.buf[self.n] = torch.stack([err.abs().mean(), mse, mse.sqrt(), rel.abs().mean(), rel.square().mean()])
+        self.n += 1
+        if self.n == self.sync_every:
+            self.sync()
+
+    def sync(self):
+        """Moves the buffered steps to the host."""
+        if self.n:
+            self.host.append(self.buf[:self.n].to('cpu', copy=True).numpy())
+            self.n = 0
+
+    def values(self):
+        """(steps, 5) array of the per step mae, mse, rmse, mape, mspe."""
+        self.sync()
+        if len(self.host) > 1:
+            self.host = [np.concatenate(self.host)]
+        return self.host[0] if self.host else np.zeros((0, 5), dtype=np.float32)
+
+    def mean(self):
+        return tuple(self.values().mean(0)) if len(self) else (np.nan,) * 5
+
+    def curves(self):
+        """MAE, MSE, RMSE, MAPE, MSPE cumulative average curves, as cumavg of the per step lists."""
+        values = self.values()
+        return tuple(cumavg(values[:, k]) for k in range(5))
+
+    def extend(self, other):
+        self.sync()
+        self.host.append(other.values())
+
+    def __getstate__(self):
+        return {'sync_every': self.sync_every, 'stats': self.stats, 'c_out': self.c_out, 'values': self.values()}
+
+    def __setstate__(self, state):
+        self.__init__(state['sync_every'], c_out=state.get('c_out'))
+        self.stats = state['stats']
+        self.host = [state['values']]
@@ -0,0 +1,202 @@
+"""
+Per-phase timing of the online step.
+
+The exp wraps the parts of a step in `with profiler.phase(name):` and the whole
+step in `with profiler.step():`; a phase entered inside another phase counts
+towards the outer one. Disabled (the default) both return a shared no-op
+context. Enabled, every phase goes into a log-bucketed latency histogram
+(p50/p95/p99 at ~5% resolution, constant memory however long the stream), and
+optionally a window of steps is recorded with torch.profiler and exported as a
+chrome trace, with the phases as labelled ranges.
+"""
+import os
+import math
+import time
+import json
+from contextlib import nullcontext
+import numpy as np
+import torch
+
+
+_NULL = nullcontext()
+
+
+class LatencyHistogram():
+    """Counts of durations in log-spaced buckets from lo to hi seconds, bins_per_decade per factor of 10."""
+    def __init__(self, lo=1e-6, hi=1e3, bins_per_decade=50):
+        self.lo = lo
+        self.scale = bins_per_decade
+        self.counts = np.zeros(int(math.ceil(math.log10(hi / lo) * bins_per_decade)) + 1, dtype=np.int64)
+        self.n = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, t):
+        k = int(math.log10(t / self.lo) * self.scale) if t > self.lo else 0
+        self.counts[min(k, len(self.counts) - 1)] += 1
+        self.n += 1
+        self.total += t
+        self.max = max(self.max, t)
+
+    def quantile(self, q):
+        """Upper edge of the bucket holding the q-quantile."""
+        if not self.n:
+            return float('nan')
+        k = int(np.searchsorted(np.cumsum(self.counts), q * self.n))
+        return min(self.lo * 10 ** ((k + 1) / self.scale), self.max)
+
+    def summary(self):
+        return {'count': self.n, 'mean': self.total / max(self.n, 1), 'p50': self.quantile(.5),
+                'p95': self.quantile(.95), 'p99': self.quantile(.99), 'max': self.max, 'total': self.total}
+
+
+class _Phase():
+    __slots__ = ('profiler', 'name', 'start', 'label', 'nested')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.label = None
+
+    def __enter__(self):
+        p = self.profiler
+        # a phase inside another one (e.g. the encoder forwards of a sleep stage) is part of it
+        self.nested = p.depth > 0
+        p.depth += 1
+        if self.nested:
+            return self
+        if p.sync:
+            p.synchronize()
+        if p.trace is not None:
+            self.label = torch.profiler.record_function(self.name)
+            self.label.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        p = self.profiler
+        p.depth -= 1
+        if self.nested:
+            return False
+        if p.sync:
+            p.synchronize()
+        p.hist(self.name).add(time.perf_counter() - self.start)
+        if self.label is not None:
+            self.label.__exit__(*exc)
+            self.label = None
+        return False
+
+
+class _Step(_Phase):
+    __slots__ = ()
+
+    def __enter__(self):
+        p = self.profiler
+        if p.trace_dir is not None:
+            p._start_trace()
+        # the phases of the step are not nested in it
+        super().__enter__()
+        p.depth -= 1
+        return self
+
+    def __exit__(self, *exc):
+        p = self.profiler
+        p.depth += 1
+        super().__exit__(*exc)
+        p.steps += 1
+        if p.trace is not None:
+            p.trace.step()
+            if p.steps >= p.trace_end:
+                p.trace.stop()
+                p.trace = None
+        return False
+
+
+class StepProfiler():
+    """
+    Phase histograms of the online steps. With sync the device is synchronized at
+    every phase boundary, so that asynchronously launched cuda work is charged to
+    the phase that launched it (at the cost of the overlap); on the CPU timings
+    are exact either way. With trace_dir, steps [trace_start, trace_start +
+    trace_steps) are traced with torch.profiler into trace_dir/trace_<step>.json.
+    """
+    def __init__(self, enabled=False, device=None, sync=False, trace_dir=None, trace_start=10, trace_steps=5):
+        self.enabled = enabled
+        self.device = device
+        self.sync = enabled and sync and device is not None and device.type == 'cuda'
+        self.hists = {}
+        self.steps = 0
+        self.depth = 0
+        self.trace = None
+        self.trace_dir = trace_dir if enabled and trace_steps > 0 else None
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.trace_end = trace_start + trace_steps
+
+    def _start_trace(self):
+        """Starts torch.profiler at the first step, its schedule skips to the window."""
+        trace_dir, self.trace_dir = self.trace_dir, None
+        os.makedirs(trace_dir, exist_ok=True)
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device is not None and self.device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.trace = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=max(self.trace_start - 1, 0), warmup=min(self.trace_start, 1),
+                                             active=self.trace_steps, repeat=1),
+            on_trace_ready=lambda prof: prof.export_chrome_trace(os.path.join(trace_dir, 'trace_{}.json'.format(prof.step_num))),
+            record_shapes=True)
+        self.trace.start()
+
+    @classmethod
+    def from_args(cls, args, device):
+        return cls(args.profile, device, sync=args.profile_sync, trace_dir=args.profile_trace,
+                   trace_start=args.profile_trace_start, trace_steps=args.profile_trace_steps)
+
+    def __deepcopy__(self, memo):
+        # copies of the model (shadow updates, background sleep stages) run off the
+        # online step, possibly on another thread, and are not profiled
+        return StepProfiler()
+
+    def synchronize(self):
+        torch.cuda.synchronize(self.device)
+
+    def hist(self, name):
+        if name not in self.hists:
+            self.hists[name] = LatencyHistogram()
+        return self.hists[name]
+
+    def phase(self, name):
+        return _Phase(self, name) if self.enabled else _NULL
+
+    def step(self):
+        """Times a whole online step as the 'step' phase and advances the trace window."""
+        return _Step(self, 'step') if self.enabled else _NULL
+
+    def summary(self):
+        return {name: h.summary() for name, h in self.hists.items()}
+
+    def report(self, path=None):
+        """Prints the phase table (and writes the summary as json to path); the untimed rest of a step shows as 'other'."""
+        if not self.enabled or not self.steps:
+            return
+        if self.trace is not None:
+            # the stream ended inside the window
+            self.trace.stop()
+            self.trace = None
+        summary = self.summary()
+        step = summary.get('step')
+        if step is not None:
+            timed = sum(s['total'] for name, s in summary.items() if name != 'step')
+            summary['other'] = {'count': step['count'], 'mean': (step['total'] - timed) / step['count'], 'total': step['total'] - timed}
+        print('online step profile over {} steps (ms):'.format(self.steps))
+        print('  {:<14}{:>8}{:>9}{:>9}{:>9}{:>9}{:>9}{:>8}'.format('phase', 'calls', 'mean', 'p50', 'p95', 'p99', 'max', 'share'))
+        for name, s in sorted(summary.items(), key=lambda kv: (kv[0] == 'step', -kv[1]['total'])):
+            share = s['total'] / step['total'] if step and step['total'] else float('nan')
+            print('  {:<14}{:>8}{:>9.3f}{:>9}{:>9}{:>9}{:>9}{:>8.1%}'.format(
+                name, s['count'], 1e3 * s['mean'], *['{:.3f}'.format(1e3 * s[k]) if k in s else '-' for k in ('p50', 'p95', 'p99', 'max')], share))
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(summary, f, indent=1)
+        return summary
@@ -0,0 +1,158 @@
+"""
+Test predictions written to disk as they are produced instead of kept in memory.
+
+The predictions and targets of a test run go to preds.npy / trues.npy in the
+results folder, memory-mapped and preallocated for the whole run; they are
+staged on the device and written a chunk at a time. A small sink.json next to
+them records how many rows are valid, updated after every chunk, so the rows
+written before a crash can still be loaded; it is marked complete at close().
+"""
+import os
+import json
+import struct
+import numpy as np
+import torch
+from numpy.lib import format as npy_format
+
+
+NAMES = ('preds', 'trues')
+
+
+def _shrink(path, rows):
+    """Truncates the .npy at path to its first rows rows, in place."""
+    with open(path, 'r+b') as f:
+        version = npy_format.read_magic(f)
+        read_header = npy_format.read_array_header_1_0 if version == (1, 0) else npy_format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+        header = repr({'descr': npy_format.dtype_to_descr(dtype), 'fortran_order': fortran_order,
+                       'shape': (rows,) + tuple(shape[1:])})
+        # same header size, padded with spaces, so the data does not move
+        length = '<H' if version == (1, 0) else '<I'
+        header_len = offset - len(npy_format.magic(*version)) - struct.calcsize(length)
+        f.seek(0)
+        f.write(npy_format.magic(*version) + struct.pack(length, header_len))
+        f.write((header + ' ' * (header_len - len(header) - 1) + '\n').encode('latin1'))
+        f.truncate(offset + rows * int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize)
+
+
+def load_results(folder):
+    """preds and trues of a (possibly unfinished) run, memory-mapped, cut to the rows written."""
+    with open(os.path.join(folder, 'sink.json')) as f:
+        meta = json.load(f)
+    return tuple(np.load(os.path.join(folder, name + '.npy'), mmap_mode='r')[:meta['rows']] for name in NAMES), meta
+
+
+class PredictionSink():
+    """
+    append(pred, true) takes a batch of predictions and targets (first dimension
+    the batch) and copies them into a (chunk, ...) buffer on their device; a full
+    buffer is moved to the host in one copy and written to the memory-mapped
+    files, which are sized for `rows` rows and grow if more arrive. close()
+    trims them to the rows written, marks the run complete and returns both,
+    memory-mapped read-only.
+    """
+    def __init__(self, folder, rows, chunk=1024):
+        self.folder = folder
+        self.rows = rows
+        self.chunk = max(chunk, 1)
+        self.written = 0
+        self.n = 0
+        self.buf = None
+        self.files = None
+        self.shapes = None
+        self.meta = {}
+
+    def __len__(self):
+        return self.written + self.n
+
+    def path(self, name):
+        return os.path.join(self.folder, name + '.npy')
+
+    def _open(self, batch):
+        os.makedirs(self.folder, exist_ok=True)
+        self.files = [npy_format.open_memmap(self.path(name), mode='w+', dtype=np.float32, shape=(self.rows,) + tuple(x.shape[1:]))
+                      for name, x in zip(NAMES, batch)]
+        self.shapes = {name: list(x.shape[1:]) for name, x in zip(NAMES, batch)}
+        self._write_meta(complete=False)
+
+    def append(self, pred, true):
+        batch = (pred.detach(), true.detach())
+        if self.buf is None or self.buf[0].device != batch[0].device:
+            self.flush()
+            if self.files is None:
+                self._open(batch)
+            self.buf = [torch.empty((self.chunk,) + tuple(x.shape[1:]), dtype=torch.float32, device=x.device) for x in batch]
+        start = 0
+        size = len(batch[0])
+        while start < size:
+            k = min(size - start, self.chunk - self.n)
+            for buf, x in zip(self.buf, batch):
+                buf[self.n:self.n + k] = x[start:start + k]
+            self.n += k
+            start += k
+            if self.n == self.chunk:
+                self.flush()
+
+    def _grow(self, rows):
+        self.rows = max(rows, 2 * self.rows)
+        for k, name in enumerate(NAMES):
+            old = self.files[k]
+            tmp = self.path(name) + '.tmp'
+            new = npy_format.open_memmap(tmp, mode='w+', dtype=old.dtype, shape=(self.rows,) + old.shape[1:])
+            new[:self.written] = old[:self.written]
+            new.flush()
+            del old
+            os.replace(tmp, self.path(name))
+            self.files[k] = new
+
+    def flush(self):
+        """Writes the staged rows and records them in sink.json."""
+        if not self.n:
+            return
+        if self.written + self.n > self.rows:
+            self._grow(self.written + self.n)
+        for f, buf in zip(self.files, self.buf):
+            f[self.written:self.written + self.n] = buf[:self.n].cpu().numpy()
+            f.flush()
+        self.written += self.n
+        self.n = 0
+        self._write_meta(complete=False)
+
+    def _write_meta(self, complete, **meta):
+        self.meta.update(meta)
+        meta = dict(self.meta, rows=self.written, complete=complete, shape=self.shapes)
+        tmp = os.path.join(self.folder, 'sink.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f, indent=1)
+        os.replace(tmp, os.path.join(self.folder, 'sink.json'))
+
+    def close(self, **meta):
+        """Finishes the files, with `meta` added to sink.json, and returns (preds, trues)."""
+        self.flush()
+        if self.files is None:
+            return np.zeros((0,), dtype=np.float32), np.zeros((0,), dtype=np.float32)
+        # unmapped before the files are truncated
+        self.files = None
+        if self.written < self.rows:
+            for name in NAMES:
+                _shrink(self.path(name), self.written)
+        self.files = [np.load(self.path(name), mmap_mode='r') for name in NAMES]
+        self._write_meta(complete=True, **meta)
+        return tuple(self.files)
+
+    def extend(self, other):
+        """Copies the rows `other` (e.g. the sink of a run a snapshot was taken in) had written."""
+        (preds, trues), _ = load_results(other.folder)
+        for start in range(0, other.written, self.chunk):
+            end = min(start + self.chunk, other.written)
+            self.append(torch.from_numpy(np.array(preds[start:end])), torch.from_numpy(np.array(trues[start:end])))
+
+    def __getstate__(self):
+        # a reference to the rows on disk, so that snapshots stay small
+        self.flush()
+        return {'folder': self.folder, 'rows': self.rows, 'chunk': self.chunk, 'written': self.written}
+
+    def __setstate__(self, state):
+        self.__init__(state['folder'], state['rows'], state['chunk'])
+        self.written = state['written']
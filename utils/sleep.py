@@ -0,0 +1,118 @@
+"""
+Sleep-stage consolidation off the online loop for the D3A experiments.
+
+On drift the replay training runs on a copy of the model and optimizer in a
+worker thread while the foreground keeps forecasting and adapting the live
+model; the result is merged back at the next online step after it finishes.
+"""
+import copy
+import time
+import threading
+import torch
+
+
+def _graph_tensors(obj):
+    if isinstance(obj, torch.Tensor):
+        if obj.grad_fn is not None:
+            yield obj
+    elif isinstance(obj, (tuple, list)):
+        for v in obj:
+            yield from _graph_tensors(v)
+
+
+def copy_for_training(objs):
+    """
+    deepcopy of objs (e.g. a model and its optimizer, in one call so the copied
+    optimizer holds the copied parameters). Runtime state computed with grad,
+    like the FSNet calibration EMA and cache, can not be deep-copied and is
+    taken detached.
+    """
+    memo = {}
+    for module in [m for obj in objs.values() if isinstance(obj, torch.nn.Module) for m in obj.modules()]:
+        for value in list(module._buffers.values()) + list(vars(module).values()):
+            for t in _graph_tensors(value):
+                memo[id(t)] = t.detach().clone()
+    return copy.deepcopy(objs, memo)
+
+
+class BackgroundSleep():
+    """
+    start(model, opt, consolidate) copies model and opt and runs consolidate(model,
+    opt, generator) on the copies in a thread; poll(model) merges the result into
+    model once done. The worker draws its randomness from generator, seeded from
+    the global torch stream when the stage starts, so that the foreground's RNG
+    streams do not depend on the thread timing. Which online step a stage is
+    merged at still does, so runs with background stages are not bit-exact
+    reproducible; online snapshots merge a running stage before saving.
+
+    merge='swap' replaces the live parameters by the consolidated ones, dropping
+    what the foreground learned meanwhile; merge='delta' adds what the sleep
+    stage changed (consolidated - copy at start) on top of the live trained
+    parameters, keeping both, at the risk of overshooting where both moved the
+    same way. The optimizer state of the live model is kept either way.
+    """
+    def __init__(self, merge='swap'):
+        assert merge in ['swap', 'delta']
+        self.merge = merge
+        self.thread = None
+        self.result = None
+        self.error = None
+        self.stats = {'runs': 0, 'skipped': 0, 'copy_time': 0., 'background_time': 0., 'merge_time': 0.}
+
+    def busy(self):
+        return self.thread is not None
+
+    def start(self, model, opt, consolidate):
+        t = time.perf_counter()
+        copies = copy_for_training({'model': model, 'opt': opt})
+        base = [p.detach().clone() for p in model.parameters()] if self.merge == 'delta' else None
+        self.stats['copy_time'] += time.perf_counter() - t
+        self.stats['runs'] += 1
+        device = next(model.parameters()).device
+        generator = torch.Generator(device=device).manual_seed(int(torch.randint(2 ** 62, (1,))))
+
+        def run():
+            t = time.perf_counter()
+            try:
+                consolidate(copies['model'], copies['opt'], generator)
+                self.result = (copies['model'], base)
+            except Exception as e:
+                self.error = e
+            self.stats['background_time'] += time.perf_counter() - t
+
+        self.thread = threading.Thread(target=run, name='sleep-stage', daemon=True)
+        self.thread.start()
+
+    def poll(self, model, wait=False):
+        """Merges a finished sleep stage into model; True if one was merged."""
+        if self.thread is None or (self.thread.is_alive() and not wait):
+            return False
+        self.thread.join()
+        self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('background sleep stage failed') from error
+        slept, base = self.result
+        self.result = None
+        t = time.perf_counter()
+        with torch.no_grad():
+            if self.merge == 'swap':
+                for p, q in zip(model.parameters(), slept.parameters()):
+                    p.copy_(q)
+            else:
+                for p, q, b in zip(model.parameters(), slept.parameters(), base):
+                    if p.requires_grad:
+                        p.add_(q - b)
+                    else:
+                        # state rewritten outside the optimizer, e.g. the normalized FSNet memory
+                        p.copy_(q)
+        self.stats['merge_time'] += time.perf_counter() - t
+        return True
+
+    def close(self, model):
+        self.poll(model, wait=True)
+        s = self.stats
+        if s['runs'] or s['skipped']:
+            print('background sleep: {} stages ({} skipped while one was running), {:.2f}s of consolidation '
+                  'off the online loop, {:.3f}s copying and {:.3f}s merging on it'.format(
+                      s['runs'], s['skipped'], s['background_time'], s['copy_time'], s['merge_time']))
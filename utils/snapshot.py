@@ -0,0 +1,195 @@
+"""
+Snapshots of the whole online-learning state of an experiment, so that the test
+stream can be resumed mid-way after a restart instead of being replayed.
+
+model.state_dict() alone misses most of what the online phase adapts: FSNet's
+gradient EMAs, calibration EMA, memory trigger and incremental queues, the OneNet
+combination weight/bias, the optimizer moments, the replay buffers, the drift
+detector and the RNG streams. A snapshot holds all of them in one file.
+"""
+import os
+import random
+import inspect
+import numpy as np
+import torch
+from torch import nn, optim
+
+from utils.checkpoint import CheckpointWriter, atomic_save
+
+
+# attributes of an exp class, whichever of them it has
+MODULES = ('model', 'decision')
+OPTIMIZERS = ('opt', 'opt_bias', 'opt_w')
+TENSORS = ('weight', 'bias')
+OBJECTS = ('buffer', 'buffer_adjust', 'detector', 'ema_model', 'count', 'lazy', 'last_branches')
+# runtime attributes of the FSNet convs (SamePadConv)
+CONV_ATTRS = ('trigger', 'queue', 't')
+
+
+def _rng_state():
+    state = {'random': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def _set_rng_state(state):
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _runtime_state(module):
+    """The non-persistent buffers and the conv runtime attributes, which state_dict leaves out."""
+    persistent = set(module.state_dict().keys())
+    buffers = {name: buf for name, buf in module.named_buffers() if name not in persistent}
+    convs = {name: {attr: getattr(m, attr) for attr in CONV_ATTRS if hasattr(m, attr)}
+             for name, m in module.named_modules() if hasattr(m, 'trigger')}
+    return {'buffers': buffers, 'convs': convs}
+
+
+def _load_runtime_state(module, state):
+    modules = dict(module.named_modules())
+    for name, value in state['buffers'].items():
+        owner, _, attr = name.rpartition('.')
+        owner = modules[owner]
+        current = getattr(owner, attr)
+        if current is not None and current.shape == value.shape:
+            # in place, the FSNet layer registry keeps views of these
+            current.copy_(value)
+        else:
+            setattr(owner, attr, value)
+    for name, attrs in state['convs'].items():
+        conv = modules[name]
+        for attr, value in attrs.items():
+            setattr(conv, attr, value)
+        # the calibration is recomputed from the restored state on the next forward
+        if hasattr(conv, 'calib'):
+            conv.calib = None
+
+
+def save_snapshot(exp, path, writer=None, **extra):
+    """
+    Writes the online state of exp and `extra` (e.g. the stream position) to path,
+    through writer (a utils.checkpoint.CheckpointWriter) when given.
+    """
+    state = {'modules': {}, 'runtime': {}, 'optimizers': {}, 'tensors': {}, 'objects': {},
+             'rng': _rng_state(), 'extra': extra}
+    for name in MODULES:
+        module = getattr(exp, name, None)
+        if isinstance(module, nn.Module):
+            state['modules'][name] = module.state_dict()
+            state['runtime'][name] = _runtime_state(module)
+    for name in OPTIMIZERS:
+        if getattr(exp, name, None) is not None:
+            state['optimizers'][name] = getattr(exp, name).state_dict()
+    for name in TENSORS:
+        if isinstance(getattr(exp, name, None), torch.Tensor):
+            state['tensors'][name] = getattr(exp, name).detach()
+    for name in OBJECTS:
+        if hasattr(exp, name):
+            state['objects'][name] = getattr(exp, name)
+
+    if writer is not None:
+        writer.save(state, path)
+        return
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    atomic_save(state, path)
+
+
+def load_snapshot(exp, path, mmap=False, restore_rng=True):
+    """
+    Restores the state written by save_snapshot into exp, whose optimizers must
+    already exist, and returns the `extra` it was saved with. With mmap the file
+    is memory-mapped and tensors are copied into place from the page cache.
+    With restore_rng=False the RNG streams are left alone and returned in
+    extra['rng'] instead, for the caller to set with _set_rng_state.
+    """
+    kwargs = {}
+    if mmap:
+        if 'mmap' not in inspect.signature(torch.load).parameters:
+            raise RuntimeError('--snapshot_mmap needs torch >= 2.1, this is {}'.format(torch.__version__))
+        kwargs['mmap'] = True
+    state = torch.load(path, map_location=exp.device, weights_only=False, **kwargs)
+    for name, module_state in state['modules'].items():
+        module = getattr(exp, name)
+        module.load_state_dict(module_state)
+        _load_runtime_state(module, state['runtime'][name])
+    for name, opt_state in state['optimizers'].items():
+        getattr(exp, name).load_state_dict(opt_state)
+    with torch.no_grad():
+        for name, value in state['tensors'].items():
+            current = getattr(exp, name, None)
+            if isinstance(current, torch.Tensor) and current.requires_grad:
+                # held by an optimizer, e.g. the combination weight of opt_w
+                current.copy_(value)
+            else:
+                setattr(exp, name, value)
+    for name, value in state['objects'].items():
+        setattr(exp, name, value)
+    if getattr(exp, 'opt_fused', None) is not None:
+        exp.opt_fused = exp._fuse_optimizers()
+    if not restore_rng:
+        return dict(state['extra'], rng=state['rng'])
+    _set_rng_state(state['rng'])
+    return state['extra']
+
+
+class OnlineSnapshots():
+    """
+    Snapshot bookkeeping of an online test loop. With --resume_from the state is
+    restored and `records` (the PredictionSink and the StreamingMetrics)
+    are refilled up to the saved position `start`; the loop skips the windows
+    before it with skip(i). With --snapshot_every N the state is saved every N windows to
+    the snapshot path, where {step} is the window count, keeping the last
+    --checkpoint_keep files; --async_checkpoint writes them in the background.
+    """
+    def __init__(self, exp, setting, records):
+        args = exp.args
+        self.exp = exp
+        self.records = records
+        self.every = args.snapshot_every
+        self.path = args.snapshot_path or os.path.join(args.checkpoints, setting, 'online_snapshot_{step}.pt')
+        self.writer = CheckpointWriter(keep=args.checkpoint_keep, background=args.async_checkpoint) if self.every else None
+        self.start = 0
+        self.rng = None
+        if args.resume_from:
+            # train() was skipped, build the optimizers it would have left behind
+            if getattr(exp, 'opt', None) is None:
+                exp._select_optimizer()
+            if hasattr(exp, 'decision') and getattr(exp, 'opt_bias', None) is None:
+                exp.opt_bias = optim.Adam(exp.decision.parameters(), lr=args.learning_rate_bias)
+            extra = load_snapshot(exp, args.resume_from, mmap=args.snapshot_mmap, restore_rng=False)
+            self.start = extra['step']
+            self.rng = extra['rng']
+            for record, saved in zip(records, extra['records']):
+                record.extend(saved)
+            print('resumed the online phase at window {} from {}'.format(self.start, args.resume_from))
+
+    def skip(self, i):
+        """
+        True for the windows before the resume position. The RNG streams are
+        restored when it is reached: starting the test loader draws its seed
+        from them, which the saved run had done before its first window.
+        """
+        if i < self.start:
+            return True
+        if self.rng is not None:
+            _set_rng_state(self.rng)
+            self.rng = None
+        return False
+
+    def step(self, i):
+        if self.every and (i + 1) % self.every == 0:
+            # a D3A sleep stage running in the background (--sleep_async) is not part of the
+            # state and still updates the replay buffers, it is merged before the snapshot
+            sleeper = getattr(self.exp, 'sleeper', None)
+            if sleeper is not None:
+                sleeper.poll(self.exp.model, wait=True)
+            save_snapshot(self.exp, self.path.format(step=i + 1), writer=self.writer, step=i + 1, records=self.records)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
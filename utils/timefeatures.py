@@ -1,4 +1,6 @@
+import hashlib
 from typing import List
+from collections import OrderedDict
 
 import numpy as np
 import pandas as pd
@@ -111,6 +113,49 @@ def time_features_from_frequency_str(freq_str: str) -> List[TimeFeature]:
     """
     raise RuntimeError(supported_freq_msg)
 
+_calendar_fields = {
+    'month': lambda index: index.month,
+    'day': lambda index: index.day,
+    'weekday': lambda index: index.weekday,
+    'hour': lambda index: index.hour,
+    'minute': lambda index: index.minute // 15,
+}
+
+def _week_of_year(index: pd.DatetimeIndex) -> np.ndarray:
+    if hasattr(index, 'isocalendar'):
+        return index.isocalendar().week.to_numpy()
+    return index.weekofyear.to_numpy()
+
+def _encode(index: pd.DatetimeIndex, timeenc, freq):
+    if timeenc==0:
+        freq_map = {
+            'y':[],'m':['month'],'w':['month'],'d':['month','day','weekday'],
+            'b':['month','day','weekday'],'h':['month','day','weekday','hour'],
+            't':['month','day','weekday','hour','minute'],
+        }
+        fields = freq_map[freq.lower()]
+        if not fields:
+            return np.empty((len(index), 0), dtype=np.int64)
+        return np.stack([np.asarray(_calendar_fields[name](index), dtype=np.int64) for name in fields], axis=1)
+    if timeenc==1:
+        return np.vstack([feat(index) for feat in time_features_from_frequency_str(freq)]).transpose(1,0)
+
+    if timeenc == 2:
+        return np.stack([
+            index.minute.to_numpy(),
+            index.hour.to_numpy(),
+            index.dayofweek.to_numpy(),
+            index.day.to_numpy(),
+            index.dayofyear.to_numpy(),
+            index.month.to_numpy(),
+            _week_of_year(index),
+        ], axis=1).astype(np.float64)
+
+# encoded stamps of the last few date columns, the train/val/test splits and
+# Dataset_Pred of one run all encode the same column
+_cache = OrderedDict()
+_cache_size = 8
+
 def time_features(dates, timeenc=1, freq='h'):
     """
     > `time_features` takes in a `dates` dataframe with a 'dates' column and extracts the date down to `freq` where freq can be any of the following if `timeenc` is 0: 
@@ -133,31 +178,15 @@ def time_features(dates, timeenc=1, freq='h'):
 
     *minute returns a number from 0-3 corresponding to the 15 minute period it falls into.
     """
-    if timeenc==0:
-        dates['month'] = dates.date.apply(lambda row:row.month,1)
-        dates['day'] = dates.date.apply(lambda row:row.day,1)
-        dates['weekday'] = dates.date.apply(lambda row:row.weekday(),1)
-        dates['hour'] = dates.date.apply(lambda row:row.hour,1)
-        dates['minute'] = dates.date.apply(lambda row:row.minute,1)
-        dates['minute'] = dates.minute.map(lambda x:x//15)
-        freq_map = {
-            'y':[],'m':['month'],'w':['month'],'d':['month','day','weekday'],
-            'b':['month','day','weekday'],'h':['month','day','weekday','hour'],
-            't':['month','day','weekday','hour','minute'],
-        }
-        return dates[freq_map[freq.lower()]].values
-    if timeenc==1:
-        dates = pd.to_datetime(dates.date.values)
-        return np.vstack([feat(dates) for feat in time_features_from_frequency_str(freq)]).transpose(1,0)
-
-    if timeenc == 2:
-        dt = pd.to_datetime(dates.date.values)
-        return np.stack([
-            dt.minute.to_numpy(),
-            dt.hour.to_numpy(),
-            dt.dayofweek.to_numpy(),
-            dt.day.to_numpy(),
-            dt.dayofyear.to_numpy(),
-            dt.month.to_numpy(),
-            dt.weekofyear.to_numpy(),
-        ], axis=1).astype(np.float)
\ No newline at end of file
+    values = np.asarray(dates.date.values)
+    key = (timeenc, freq, len(values), hashlib.sha1(pd.util.hash_array(values).tobytes()).hexdigest())
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    stamp = _encode(pd.DatetimeIndex(pd.to_datetime(values)), timeenc, freq)
+    stamp.flags.writeable = False
+    _cache[key] = stamp
+    if len(_cache) > _cache_size:
+        _cache.popitem(last=False)
+    return stamp
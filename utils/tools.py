@@ -22,14 +22,16 @@ def adjust_learning_rate(optimizer, epoch, args, decision=False):
         print('Updating learning rate to {}'.format(lr))
 
 class EarlyStopping:
-    def __init__(self, patience=7, verbose=False, delta=0):
+    def __init__(self, patience=7, verbose=False, delta=0, writer=None):
         self.patience = patience
         self.verbose = verbose
         self.counter = 0
         self.best_score = None
         self.early_stop = False
-        self.val_loss_min = np.Inf
+        self.val_loss_min = np.inf
         self.delta = delta
+        # a utils.checkpoint.CheckpointWriter saves off the epoch loop, flush it before loading
+        self.writer = writer
 
     def __call__(self, val_loss, model, path, name='checkpoint.pth'):
         score = -val_loss
@@ -49,7 +51,10 @@ class EarlyStopping:
     def save_checkpoint(self, val_loss, model, path, name='checkpoint.pth'):
         if self.verbose:
             print(f'Validation loss decreased ({self.val_loss_min:.6f} --> {val_loss:.6f}).  Saving model ...')
-        torch.save(model.state_dict(), path+'/'+name)
+        if self.writer is not None:
+            self.writer.save(model.state_dict(), path+'/'+name)
+        else:
+            torch.save(model.state_dict(), path+'/'+name)
         self.val_loss_min = val_loss
 
 class dotdict(dict):